@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""命令行入口: python -m app [command]"""
+import sys
+import time
+import argparse
+from app import run_bot
+
+
+def rebuild_index(args):
+    from app.models.search_index import rebuild_index
+    rebuild_index()
+
+
+def backfill_stats(args):
+    # 汇总表先清空再重建, 机器人同时写入的消息会被计数两次
+    if not args.yes:
+        answer = input("backfill-stats 会清空并重建统计汇总表, 运行前必须停止机器人, 否则统计会重复计数. "
+                       "机器人已停止? [y/N] ")
+        if answer.strip().lower() not in ('y', 'yes'):
+            sys.exit(1)
+    from app.models.stats_rollup import backfill
+    backfill()
+
+
+def print_progress(all_stats):
+    done = sum(1 for stats in all_stats if stats.finished)
+    elapsed = time.time() - min(stats.started for stats in all_stats)
+    inserted = sum(stats.inserted for stats in all_stats)
+    processed = sum(stats.processed for stats in all_stats)
+    fail = sum(stats.fail for stats in all_stats)
+    rate = processed / elapsed if elapsed > 0 else 0
+    running = ', '.join(f"{stats.title} {stats.progress * 100:.0f}%"
+                        for stats in all_stats if not stats.finished and stats.progress > 0)
+    print(f"\r\033[K[{done}/{len(all_stats)}] 新增 {inserted}, 已存在 {processed - inserted}, 失败 {fail}, "
+          f"{rate:.0f} 条/秒" + (f" | {running}" if running else ''), end='', flush=True)
+
+
+def print_file_done(stats):
+    if stats.error and stats.chat_id is None:
+        print(f"\r\033[K✘ {stats.path}: {stats.error}")
+        return
+    print(f"\r\033[K{'✘' if stats.error or stats.fail else '✔'} {stats.path} ({stats.title}): "
+          f"新增 {stats.inserted}, 已存在 {stats.existing}, 失败 {stats.fail}, 新用户 {stats.users}, "
+          f"跳过 (此前已导入) {stats.skipped}, 耗时 {stats.elapsed():.1f} 秒"
+          + (f", 出错: {stats.error}" if stats.error else ''))
+
+
+def print_summary(all_stats, elapsed):
+    errors = [stats for stats in all_stats if stats.error]
+    processed = sum(stats.processed for stats in all_stats)
+    print(f"\r\033[K\n导入结果: {len(all_stats)} 个文件, 完成 {len(all_stats) - len(errors)}, 出错 {len(errors)}")
+    print(f"新增: {sum(stats.inserted for stats in all_stats)}")
+    print(f"已存在: {processed - sum(stats.inserted for stats in all_stats)}")
+    print(f"失败: {sum(stats.fail for stats in all_stats)}")
+    print(f"新用户: {sum(stats.users for stats in all_stats)}")
+    print(f"耗时: {elapsed:.1f} 秒, {processed / elapsed if elapsed > 0 else 0:.0f} 条/秒")
+    for stats in all_stats:
+        if stats.failed:
+            print(f"\n{stats.path} 失败的消息 (最多显示 {len(stats.failed)} 条):")
+            for msg in stats.failed:
+                print(f"\t{msg}")
+
+
+def import_history(args):
+    from app.models.importer import import_files, expand_paths
+    files = expand_paths(args.paths)
+    if not files:
+        print("错误: 没有找到导出文件")
+        sys.exit(1)
+    print(f"共 {len(files)} 个文件")
+    options = {name: getattr(args, name) for name in ('processes', 'writers', 'copy') if getattr(args, name)}
+    begin = time.time()
+    all_stats = import_files(files, on_progress=print_progress, on_file_done=print_file_done, **options)
+    print_summary(all_stats, time.time() - begin)
+    if any(stats.error or stats.fail for stats in all_stats):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m app')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='start the bot (default)')
+    subparsers.add_parser('rebuild-index', help='rebuild the full-text search index for existing messages') \
+        .set_defaults(func=rebuild_index)
+    backfill_parser = subparsers.add_parser(
+        'backfill-stats', help='build the statistics rollup tables from existing messages (stop the bot first)')
+    backfill_parser.add_argument('-y', '--yes', action='store_true', help='do not ask whether the bot is stopped')
+    backfill_parser.set_defaults(func=backfill_stats)
+    import_parser = subparsers.add_parser('import', help='import chat histories exported from Telegram Desktop (JSON)')
+    import_parser.add_argument('paths', nargs='+', metavar='path',
+                               help='exported result.json files, directories (searched for *.json) or glob patterns')
+    import_parser.add_argument('--processes', type=int, default=None, help='number of parser processes')
+    import_parser.add_argument('--writers', type=int, default=None, help='number of database writer connections')
+    import_parser.add_argument('--copy', action='store_true',
+                               help='PostgreSQL only: load messages and users through COPY into staging tables')
+    import_parser.set_defaults(func=import_history)
+
+    args = parser.parse_args()
+    if getattr(args, 'func', None):
+        args.func(args)
+    else:
+        run_bot()
+
+
+if __name__ == '__main__':
+    main()
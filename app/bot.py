@@ -1,3 +1,4 @@
+from telegram import Update
 from telegram.ext import Updater
 from threading import Thread
 import asyncio
@@ -8,13 +9,21 @@ from app.handlers import (
     chat_start, 
     chat_stop, 
     chat_delete, 
+    chat_member,
     msg_search,
     msg_store,
     nl_search,
-    setting_command
+    setting_command,
+    stats_command
 )
 from app.jobs.commands_set import set_bot_commands
+from app.jobs.metrics_log import log_metrics, METRICS_LOG_INTERVAL
+from app.models.ingest import ingest_queue
 from app.utils import get_text_func
+from app.utils.llm_client import llm_client
+from app.utils.chart_pool import chart_pool
+from app.utils.delete_scheduler import delete_scheduler
+from app.utils.app_context import app_context
 
 logging.basicConfig(format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -33,6 +42,9 @@ def setup_handlers(dispatcher):
     dispatcher.add_handler(bot_help.handler)
     dispatcher.add_handler(setting_command.handler)
     
+    # Keep membership cache in sync with chat member updates
+    dispatcher.add_handler(chat_member.handler)
+    
     # Search handlers
     dispatcher.add_handler(msg_search.handler)
     dispatcher.add_handler(msg_search.command_handler)
@@ -48,6 +60,10 @@ def setup_handlers(dispatcher):
     dispatcher.add_handler(nl_search.nl_page_handler)
     logger.info("Common search callback handler registered")
     
+    # Statistics handlers
+    dispatcher.add_handler(stats_command.handler)
+    dispatcher.add_handler(stats_command.callback_handler)
+    
     # Message store handler
     dispatcher.add_handler(msg_store.handler)
     
@@ -55,16 +71,29 @@ def setup_handlers(dispatcher):
     logger.info("All handlers registered successfully")
 
 def main():
+    # 渲染进程通过 fork 创建, 需要在 dispatcher 等线程启动之前
+    chart_pool.start()
+
     bot_token = os.getenv('BOT_TOKEN')
     updater = Updater(token=bot_token)
     dispatcher = updater.dispatcher
 
+    # Resolve bot identity once; handlers read it from app_context
+    app_context.load_bot_identity(updater.bot)
+
     # Set up command handlers
     setup_handlers(dispatcher)
 
     # Set bot commands
     job = updater.job_queue
     job.run_once(set_bot_commands, 30)
+    if METRICS_LOG_INTERVAL > 0:
+        job.run_repeating(log_metrics, METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL)
+
+    # Start message write pipeline
+    ingest_queue.start()
+    # Resume auto-deletions left over from the last run
+    delete_scheduler.start(updater.bot)
     
     # Start bot
     mode_env = os.getenv("BOT_MODE")
@@ -74,12 +103,20 @@ def main():
         updater.start_webhook(listen='0.0.0.0',
                             port=9968,
                             url_path=url_path,
-                            webhook_url=hook_url)
+                            webhook_url=hook_url,
+                            allowed_updates=Update.ALL_TYPES)
     else:
-        updater.start_polling()
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
     
     logger.info(_('robot start...'))
     updater.idle()
 
+    # Flush queued messages before exit
+    logger.info("Draining message write queue...")
+    ingest_queue.stop()
+    llm_client.stop()
+    delete_scheduler.stop()
+    chart_pool.stop()
+
 if __name__ == '__main__':
     main() 
\ No newline at end of file
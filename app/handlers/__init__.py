@@ -3,8 +3,10 @@ from app.handlers import (
     chat_start,
     chat_stop,
     chat_delete,
+    chat_member,
     msg_search,
     msg_store,
     nl_search,
-    setting_command
+    setting_command,
+    stats_command
 ) 
\ No newline at end of file
@@ -1,6 +1,9 @@
 from telegram.ext import CommandHandler
-from app.models import Message, Chat, DBSession
+from app.models import Message, Chat, DBSession, stats_rollup
+from app.models.search_index import remove_chat_messages
 from app.utils import check_control_permission, get_text_func
+from app.utils.chat_cache import invalidate_chat
+from app.utils.result_cache import bump_chat_versions
 
 _ = get_text_func()
 
@@ -11,6 +14,8 @@ def delete_chat_or_do_nothing(chat_id):
     if target_chat and not target_chat.enable:
         session.delete(target_chat)
         session.commit()
+        remove_chat_messages(session, chat_id)
+        stats_rollup.remove_chat(session, chat_id)
         related_messages = session.query(
             Message).filter(Message.from_chat == chat_id)
         related_messages.delete(synchronize_session=False)
@@ -19,6 +24,8 @@ def delete_chat_or_do_nothing(chat_id):
     else:
         msg_text = _('not started / not stopped!')
     session.close()
+    invalidate_chat(chat_id)
+    bump_chat_versions([chat_id])
     return msg_text
 
 
@@ -28,11 +35,12 @@ def delete(update, context):
     chat_member = context.bot.get_chat_member(
         chat_id=chat_id, user_id=from_user_id)
     # Check control permission
-    if check_control_permission(from_user_id) is True:
+    permission = check_control_permission(from_user_id)
+    if permission is True:
         pass
-    elif check_control_permission(from_user_id) is False:
+    elif permission is False:
         return
-    elif check_control_permission(from_user_id) is None:
+    elif permission is None:
         if chat_member.status != 'creator' and chat_member.status != 'administrator':
             return
     else:
@@ -0,0 +1,18 @@
+from telegram.ext import ChatMemberHandler
+from app.utils.membership import update_member_status, forget_chat, LEFT_STATUSES
+
+
+def chat_member_updated(update, context):
+    """根据成员变动更新成员资格缓存"""
+    if update.my_chat_member:
+        # 机器人自己被移出群组
+        if update.my_chat_member.new_chat_member.status in LEFT_STATUSES:
+            forget_chat(update.my_chat_member.chat.id)
+        return
+
+    member_update = update.chat_member
+    new_member = member_update.new_chat_member
+    update_member_status(member_update.chat.id, new_member.user.id, new_member.status)
+
+
+handler = ChatMemberHandler(chat_member_updated, ChatMemberHandler.ANY_CHAT_MEMBER)
@@ -3,6 +3,7 @@ import telegram.error
 
 from app.models import Chat, DBSession
 from app.utils import check_control_permission, get_text_func
+from app.utils.chat_cache import invalidate_chat
 
 _ = get_text_func()
 
@@ -23,6 +24,7 @@ def insert_chat_or_enable(chat_id, title):
             session.commit()
             msg_text = _('bot restored!')
     session.close()
+    invalidate_chat(chat_id)
     return msg_text
 
 
@@ -41,11 +43,12 @@ def start(update, context):
         return
     
     # Check control permission
-    if check_control_permission(from_user_id) is True:
+    permission = check_control_permission(from_user_id)
+    if permission is True:
         pass
-    elif check_control_permission(from_user_id) is False:
+    elif permission is False:
         return
-    elif check_control_permission(from_user_id) is None:
+    elif permission is None:
         if chat_member.status != 'creator' and chat_member.status != 'administrator':
             return
     else:
@@ -1,6 +1,7 @@
 from telegram.ext import CommandHandler
 from app.models import Chat, DBSession
 from app.utils import check_control_permission, get_text_func
+from app.utils.chat_cache import invalidate_chat
 
 _ = get_text_func()
 
@@ -16,6 +17,7 @@ def disbale_chat_or_do_nothing(chat_id):
     else:
         msg_text = _('already stopped / not started, use /start to start bot in current group!')
     session.close()
+    invalidate_chat(chat_id)
     return msg_text
 
 
@@ -25,11 +27,12 @@ def stop(update, context):
     chat_member = context.bot.get_chat_member(
         chat_id=chat_id, user_id=from_user_id)
     # Check control permission
-    if check_control_permission(from_user_id) is True:
+    permission = check_control_permission(from_user_id)
+    if permission is True:
         pass
-    elif check_control_permission(from_user_id) is False:
+    elif permission is False:
         return
-    elif check_control_permission(from_user_id) is None:
+    elif permission is None:
         if chat_member.status != 'creator' and chat_member.status != 'administrator':
             return
     else:
@@ -2,18 +2,25 @@ import math
 import re
 import os
 import logging
-import json
 from telegram import InlineQueryResultArticle, InputTextMessageContent, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import InlineQueryHandler, CommandHandler, CallbackQueryHandler, CallbackContext
 from app.models import User, Message, Chat, DBSession
-from sqlalchemy import and_, or_
+from sqlalchemy import or_
 import telegram
-from app.utils import get_text_func, auto_delete
+from app.models.search_index import keyword_filter
+from app.utils import get_text_func, auto_delete, result_cache
+from app.utils.membership import filter_member_chats
+from app.utils.search_count import count_results
+from app.utils.search_session import create_session
 from app.handlers.search_common import (
     build_search_keyboard, 
+    count_pages,
+    fetch_result_page,
     format_search_results, 
     get_filter_chats_for_user,
     handle_search_page_callback,
+    page_cursors,
+    search_flight,
     SEARCH_PAGE_SIZE
 )
 
@@ -57,93 +64,54 @@ def get_query_matches(query):
     return user, keywords, page
 
 
-def search_messages(uname, keywords, page, filter_chats):
-    messages = []
+def search_messages(uname, keywords, page, filter_chats, cursor=None, total=None):
     start = (page - 1) * SEARCH_PAGE_SIZE
     stop = page * SEARCH_PAGE_SIZE
-    session = DBSession()
     chat_ids = [chat[0] for chat in filter_chats]
-    chat_titles = [chat[1] for chat in filter_chats]
     user_ids = []
 
-    if uname:
-        user_count = session.query(User).filter(
-            or_(
-                User.fullname.like('%' + uname + '%'),
-                User.username.like('%' + uname + '%')
-            )).count()
-        if user_count >= 1:
-            for user in session.query(User).filter(
-                or_(
-                    User.fullname.like('%' + uname + '%'),
-                    User.username.like('%' + uname + '%')
-                )).all():
-                user_ids.append(user.id)
-
-    if keywords:
-        rule = and_(*[Message.text.like('%' + keyword + '%')
-                    for keyword in keywords])
-        if uname:
-            count = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).filter(Message.from_id.in_(user_ids)).count()
-            query = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).filter(Message.from_id.in_(user_ids))
-        else:
-            count = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).count()
-            query = session.query(Message).filter(
-                rule).filter(Message.from_chat.in_(chat_ids))
-    else:
-        if uname:
-            count = session.query(Message).filter(Message.from_chat.in_(
-                chat_ids)).filter(Message.from_id.in_(user_ids)).count()
-            query = session.query(Message).filter(Message.from_chat.in_(
-                chat_ids)).filter(Message.from_id.in_(user_ids))
-        else:
-            count = session.query(Message).filter(
-                Message.from_chat.in_(chat_ids)).count()
-            query = session.query(Message).filter(
-                Message.from_chat.in_(chat_ids))
-
-    for message in query.order_by(Message.date.desc()).slice(start, stop).all():
-        user = session.query(User).filter_by(id=message.from_id).one()
-        user_fullname = user.fullname
-        index = chat_ids.index(message.from_chat)
-        chat_title = chat_titles[index]
-
-        if message.type != 'text':
-            msg_text = f'[{message.type}] {message.text if message.text else ""}'
-        else:
-            msg_text = message.text
+    # 翻页和多人搜索同一个词时直接使用缓存的结果页
+    cache_key = ('search', uname, tuple(keywords or ()), tuple(chat_ids))
+    page_key = (cache_key, tuple(filter_chats), page, cursor)
+    versions, cached = result_cache.lookup(page_key, chat_ids)
+    if cached is not None:
+        return cached
 
-        if msg_text == '':
-            continue
-
-        messages.append(
-            {
-                'id': message.id,
-                'link': message.link,
-                'text': msg_text,
-                'date': message.date,
-                'user': user_fullname,
-                'chat': chat_title,
-                'type': message.type
-            }
-        )
-
-    session.close()
-    return messages, count
+    def run():
+        session = DBSession()
+        try:
+            if uname:
+                for user in session.query(User).filter(
+                    or_(
+                        User.fullname.like('%' + uname + '%'),
+                        User.username.like('%' + uname + '%')
+                    )).all():
+                    user_ids.append(user.id)
+
+            query = session.query(Message).filter(Message.from_chat.in_(chat_ids))
+            if keywords:
+                query = query.filter(keyword_filter(keywords))
+            if uname:
+                query = query.filter(Message.from_id.in_(user_ids))
+
+            messages, fetched = fetch_result_page(query, filter_chats, start, stop, cursor)
+            count = count_results(query, (cache_key, versions), start, fetched, SEARCH_PAGE_SIZE, total)
+        finally:
+            session.close()
+        result_cache.store(page_key, versions, (messages, count))
+        return messages, count
+
+    # 同时进行的相同搜索只查询一次数据库
+    return search_flight.do(page_key, run)
 
 
 def inline_caps(update, context):
     from_user_id = update.inline_query.from_user.id
     session = DBSession()
-    chats = session.query(Chat)
-    if not chats:
-        return
-
-    filter_chats = []
-    enabled_chats = [chat for chat in chats if chat.enable]
+    try:
+        enabled_chats = [(chat.id, chat.title) for chat in session.query(Chat).filter(Chat.enable == True)]
+    finally:
+        session.close()
     
     if not enabled_chats:
         results = [
@@ -158,18 +126,7 @@ def inline_caps(update, context):
             update.inline_query.id, results, cache_time=10)
         return
         
-    for chat in enabled_chats:
-        try:
-            chat_member = context.bot.get_chat_member(
-                chat_id=chat.id, user_id=from_user_id)
-            if chat_member.status not in ['left', 'kicked']:
-                filter_chats.append((chat.id, chat.title))
-        except telegram.error.BadRequest as e:
-            logging.error(f"获取群组 {chat.id} 成员信息失败: {str(e)}")
-        except telegram.error.Unauthorized as e:
-            logging.error(f"群组 {chat.id} 未授权: {str(e)}")
-        except Exception as e:
-            logging.error(f"处理群组 {chat.id} 时发生错误: {str(e)}")
+    filter_chats = filter_member_chats(context.bot, enabled_chats, from_user_id)
 
     query = update.inline_query.query
     user, keywords, page = get_query_matches(query)
@@ -201,13 +158,15 @@ def inline_caps(update, context):
             update.inline_query.id, results, cache_time=10)
         return
 
-    total_pages = math.ceil(count / SEARCH_PAGE_SIZE)
+    total_pages = count_pages(count)
 
     result_text = format_search_results(messages, page, count)
     query_params = {
         'user': user,
         'keywords': keywords
     }
+    token = create_session("search", query_params, None, count, page_cursors(page, messages),
+                           chat_ids=[chat[0] for chat in filter_chats])
 
     results = [
         InlineQueryResultArticle(
@@ -219,7 +178,7 @@ def inline_caps(update, context):
                 parse_mode='Markdown',
                 disable_web_page_preview=True
             ),
-            reply_markup=build_search_keyboard(page, total_pages, "search", query_params)
+            reply_markup=build_search_keyboard(page, total_pages, "search", token)
         )
     ]
 
@@ -245,41 +204,29 @@ def handle_search_command(update: Update, context: CallbackContext):
         return update.message.reply_text(safe_translate("You are not a member of any groups where the bot is enabled.") + "\n" + 
                                 safe_translate("Please ensure:\n1. Use /start to enable the bot\n2. Grant admin rights\n3. Disable privacy mode"))
     
-    # 保存当前群组ID到用户数据中，用于翻页时验证
-    context.user_data['last_chat_id'] = current_chat_id
-    # 明确保存当前群组ID，确保只搜索当前群组的消息
-    context.user_data['current_search_chat_id'] = current_chat_id
-    
     # 构建查询参数
     query_params = {
         'user': user,
         'keywords': keywords
     }
     
-    # 保存查询参数以便在回调数据过长时使用
-    context.user_data['last_search_params'] = query_params
-    
     logging.info(f"Executing search with params: {query_params}")
     
     try:
         messages, count = search_messages(user, keywords, page, filter_chats)
-        total_pages = math.ceil(count / SEARCH_PAGE_SIZE)
+        total_pages = count_pages(count)
         
         result_text = format_search_results(messages, page, count)
         
-        # 检查回调数据长度
-        test_query_json = json.dumps(query_params)
-        callback_data_length = len(f"search|search|1|{test_query_json}")
-        logging.info(f"Original callback data length: {callback_data_length} bytes")
-        
-        if callback_data_length > 64:
-            logging.warning("Callback data exceeds Telegram's 64 byte limit, will be compressed")
+        # 查询参数保存在搜索会话中，翻页时只需传递会话令牌，只搜索当前群组的消息
+        token = create_session("search", query_params, current_chat_id, count, page_cursors(page, messages),
+                               chat_ids=[chat[0] for chat in filter_chats])
         
         return update.message.reply_text(
             result_text,
             parse_mode='Markdown',
             disable_web_page_preview=True,
-            reply_markup=build_search_keyboard(page, total_pages, "search", query_params)
+            reply_markup=build_search_keyboard(page, total_pages, "search", token)
         )
     except Exception as e:
         logging.error(f"Search command failed: {str(e)}", exc_info=True)
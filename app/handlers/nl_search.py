@@ -1,21 +1,30 @@
 import json
 import os
-from datetime import datetime, timezone
+import re
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
 import logging
 import pytz
-import httpx
 import telegram
 import math
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext, CommandHandler, CallbackQueryHandler
 from app.models import User, Message, Chat, DBSession
-from sqlalchemy import and_, or_, func
-from app.utils import get_filter_chats, get_text_func, auto_delete
+from sqlalchemy import or_, func
+from app.models.search_index import keyword_filter
+from app.utils import get_filter_chats, get_text_func, auto_delete, schedule_delete, result_cache, metrics, parse_cache
+from app.utils.llm_client import llm_client
+from app.utils.search_count import count_results
+from app.utils.search_session import create_session
 from app.handlers.search_common import (
     build_search_keyboard, 
+    count_pages,
+    fetch_result_page,
     format_search_results, 
     get_filter_chats_for_user,
     handle_search_page_callback,
+    page_cursors,
+    search_flight,
     SEARCH_PAGE_SIZE
 )
 
@@ -31,8 +40,8 @@ def safe_translate(text):
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 DEEPSEEK_API_URL = "https://api.siliconflow.cn/v1/chat/completions"
 
-def parse_date_with_llm(query: str, current_time: datetime, from_user_id: int, reply_to_message=None, session=None) -> dict:
-    """使用DeepSeek模型解析自然语言查询"""
+def parse_date_with_llm(query: str, current_time: datetime, from_user_id: int, reply_to_message=None, session=None) -> Future:
+    """使用DeepSeek模型解析自然语言查询, 请求由 llm_client 异步执行, 返回解析结果的 Future"""
     
     # 转换为本地时间显示
     local_tz = pytz.timezone('Asia/Shanghai')
@@ -84,71 +93,184 @@ def parse_date_with_llm(query: str, current_time: datetime, from_user_id: int, r
 
 """
 
-    try:
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
+    headers = {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    data = {
+        "model": "deepseek-ai/DeepSeek-V3",
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.1,
+    }
+    
+    return llm_client.submit(DEEPSEEK_API_URL, data, headers, parse=_convert_llm_result)
+
+def _convert_llm_result(result: dict) -> dict:
+    """取出模型返回的 JSON, 并将其中的北京时间转换为UTC时间"""
+    parsed = json.loads(result['choices'][0]['message']['content'])
+    
+    if parsed.get('time_range'):
+        local_tz = pytz.timezone('Asia/Shanghai')
         
-        data = {
-            "model": "deepseek-ai/DeepSeek-V3",
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.1,
-        }
+        # 转换开始时间
+        start_local = local_tz.localize(datetime.strptime(
+            parsed['time_range']['start'], 
+            '%Y-%m-%d %H:%M:%S'
+        ))
+        parsed['time_range']['start'] = start_local.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
         
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(DEEPSEEK_API_URL, json=data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            parsed = json.loads(result['choices'][0]['message']['content'])
-            
-            # 如果有时间范围，将北京时间转换为UTC时间
-            if parsed.get('time_range'):
-                local_tz = pytz.timezone('Asia/Shanghai')
-                
-                # 转换开始时间
-                start_local = local_tz.localize(datetime.strptime(
-                    parsed['time_range']['start'], 
-                    '%Y-%m-%d %H:%M:%S'
-                ))
-                parsed['time_range']['start'] = start_local.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
-                
-                # 转换结束时间
-                end_local = local_tz.localize(datetime.strptime(
-                    parsed['time_range']['end'], 
-                    '%Y-%m-%d %H:%M:%S'
-                ))
-                parsed['time_range']['end'] = end_local.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
-            
-            return parsed
-            
-    except Exception as e:
-        logging.error(f"DeepSeek API调用失败: {str(e)}")
-        raise
+        # 转换结束时间
+        end_local = local_tz.localize(datetime.strptime(
+            parsed['time_range']['end'], 
+            '%Y-%m-%d %H:%M:%S'
+        ))
+        parsed['time_range']['end'] = end_local.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+    
+    return parsed
+
+# 预解析可以识别的相对时间, 值为 (本地时间) -> (开始, 结束)
+def _day_range(local_time, days_ago):
+    day = (local_time - timedelta(days=days_ago)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return day, day.replace(hour=23, minute=59, second=59)
+
+def _last_week(local_time):
+    monday = (local_time - timedelta(days=local_time.weekday() + 7)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return monday, (monday + timedelta(days=6)).replace(hour=23, minute=59, second=59)
+
+def _this_week(local_time):
+    monday = (local_time - timedelta(days=local_time.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return monday, local_time
+
+def _last_month(local_time):
+    month_end = local_time.replace(day=1, hour=23, minute=59, second=59, microsecond=0) - timedelta(days=1)
+    return month_end.replace(day=1, hour=0, minute=0, second=0), month_end
+
+def _this_month(local_time):
+    return local_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0), local_time
+
+RELATIVE_TIMES = {
+    '今天': lambda t: _day_range(t, 0),
+    '昨天': lambda t: _day_range(t, 1),
+    '前天': lambda t: _day_range(t, 2),
+    '最近': lambda t: (t - timedelta(days=7), t),
+    '本周': _this_week,
+    '这周': _this_week,
+    '上周': _last_week,
+    '本月': _this_month,
+    '这个月': _this_month,
+    '上个月': _last_month,
+}
+
+# 出现这些字时查询可能指定了用户、群组或是一句完整的话, 交给 LLM 解析
+NL_MARKERS = ('我', '你', '他', '她', '谁', '说', '发', '的', '什么', '哪', '关于', '群', '@')
+
+# 预解析不认识的时间表达 (最近一周/昨天晚上/上周五/去年/2024年3月 等), 交给 LLM 解析, 不能当作关键词
+TIME_HINT = re.compile(
+    r'\d+\s*(?:年|月|日|号|周|天|点|时|小时|分钟|星期)'
+    r'|\d{1,4}[-/.]\d{1,2}'
+    r'|[零一二两三四五六七八九十几半]+\s*(?:个?月|年|周|天|日|号|点|小时|分钟|星期|礼拜)'
+    r'|[去今前明]年|年[初中底末]|[上下这本]个?月|月[初中底末]'
+    r'|周[一二三四五六日天末]|星期|礼拜'
+    r'|早上|上午|中午|下午|晚上|傍晚|凌晨|夜里|半夜|[今昨前]晚'
+    r'|[之以]前|[之以]后|以来|刚才|刚刚|天前'
+)
+
+def _is_time_like(word):
+    """word 不是 RELATIVE_TIMES 中的词, 但可能表示时间"""
+    return any(time_word in word for time_word in RELATIVE_TIMES) or TIME_HINT.search(word) is not None
+
+def quick_parse(query: str, current_time: datetime):
+    """
+    不调用 LLM 解析简单的查询: 最多一个相对时间 (昨天/上周/最近/上个月等) 加上空格分隔的关键词;
+    其余的词只要可能表示时间, 就交给 LLM 解析
+    
+    Returns:
+        dict: 与 parse_date_with_llm 格式相同的解析结果, 无法解析时返回 None
+    """
+    time_words = []
+    keywords = []
+    for word in query.split():
+        if word in RELATIVE_TIMES:
+            time_words.append(word)
+        elif any(marker in word for marker in NL_MARKERS) or _is_time_like(word):
+            return None
+        else:
+            keywords.append(word)
+    if len(time_words) > 1 or not (time_words or keywords):
+        return None
+    
+    parsed = {'keywords': keywords, 'time_range': None, 'user': None, 'chat': None}
+    if time_words:
+        local_time = current_time.astimezone(pytz.timezone('Asia/Shanghai'))
+        start, end = RELATIVE_TIMES[time_words[0]](local_time)
+        parsed['time_range'] = {
+            'start': start.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S'),
+            'end': end.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+        }
+    return parsed
 
-def search_messages_with_parsed_data(parsed_data: dict, filter_chats, session, page=1, page_size=SEARCH_PAGE_SIZE):
+def _completed(parsed):
+    future = Future()
+    future.set_result(parsed)
+    return future
+
+def parse_query(query: str, current_time: datetime, from_user_id: int, reply_to_message=None, session=None):
+    """
+    解析自然语言查询, 依次尝试预解析、解析缓存和 LLM
+    
+    Returns:
+        tuple: (解析结果的 Future, 缓存键)
+        缓存键只在调用 LLM 时返回, 解析完成后由调用方在工作线程中 parse_cache.put, 不在 LLM 事件循环线程中访问数据库
+    """
+    parsed = quick_parse(query, current_time)
+    if parsed is not None:
+        metrics.incr('nlsearch.parse.quick')
+        return _completed(parsed), None
+    
+    # 相对时间依赖当前时间, 按小时划分缓存; "我"和"他"依赖当前用户和被回复的用户
+    reply_user_id = reply_to_message.from_user.id \
+        if reply_to_message and getattr(reply_to_message, 'from_user', None) else None
+    time_bucket = current_time.astimezone(pytz.timezone('Asia/Shanghai')).strftime('%Y%m%d%H')
+    key = '|'.join([' '.join(query.lower().split()), str(from_user_id), str(reply_user_id), time_bucket])
+    parsed = parse_cache.get(key)
+    if parsed is not None:
+        metrics.incr('nlsearch.parse.cache_hit')
+        return _completed(parsed), None
+    
+    metrics.incr('nlsearch.parse.llm')
+    return parse_date_with_llm(query, current_time, from_user_id, reply_to_message, session), key
+
+def search_messages_with_parsed_data(parsed_data: dict, filter_chats, session, page=1, page_size=SEARCH_PAGE_SIZE,
+                                     cursor=None, total=None):
     """使用解析后的数据搜索消息"""
-    messages = []
     start = (page - 1) * page_size
     stop = page * page_size
     
     chat_ids = [chat[0] for chat in filter_chats]
-    chat_titles = [chat[1] for chat in filter_chats]
     user_ids = []
 
-    # 首先获取用户ID列表
-    if parsed_data.get('user'):
-        user_query = parsed_data['user'].strip().lower()
-        user_count = session.query(User).filter(
-            or_(
-                func.lower(User.fullname).like(f"%{user_query}%"),
-                func.lower(User.username).like(f"%{user_query}%")
-            )
-        ).count()
-        
-        if user_count >= 1:
+    # 添加群组过滤
+    if parsed_data.get('chat'):
+        chat_query = parsed_data['chat'].strip().lower()
+        chat_ids = [chat[0] for chat in filter_chats 
+                    if chat_query in chat[1].lower()]
+        if not chat_ids:
+            return [], 0
+
+    # 翻页和重复的查询直接使用缓存的结果页
+    cache_key = ('nlsearch', json.dumps(parsed_data, sort_keys=True), tuple(chat_ids))
+    page_key = (cache_key, tuple(filter_chats), page, page_size, cursor)
+    versions, cached = result_cache.lookup(page_key, chat_ids)
+    if cached is not None:
+        return cached
+
+    def run():
+        # 获取用户ID列表
+        if parsed_data.get('user'):
+            user_query = parsed_data['user'].strip().lower()
             for user in session.query(User).filter(
                 or_(
                     func.lower(User.fullname).like(f"%{user_query}%"),
@@ -156,86 +278,36 @@ def search_messages_with_parsed_data(parsed_data: dict, filter_chats, session, p
                 )
             ).all():
                 user_ids.append(user.id)
-        else:
-            logging.info(f"No users found matching query: {user_query}")
-            return [], 0
 
-    # 构建基本查询
-    if parsed_data.get('keywords'):
-        keyword_conditions = []
-        for keyword in parsed_data['keywords']:
-            keyword = keyword.strip().lower()
-            keyword_conditions.append(func.lower(Message.text).like(f"%{keyword}%"))
-        rule = and_(*keyword_conditions)
-        
-        if parsed_data.get('user'):
-            count = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).filter(Message.from_id.in_(user_ids)).count()
-            query = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).filter(Message.from_id.in_(user_ids))
-        else:
-            count = session.query(Message).filter(rule).filter(
-                Message.from_chat.in_(chat_ids)).count()
-            query = session.query(Message).filter(
-                rule).filter(Message.from_chat.in_(chat_ids))
-    else:
-        if parsed_data.get('user'):
-            count = session.query(Message).filter(Message.from_chat.in_(
-                chat_ids)).filter(Message.from_id.in_(user_ids)).count()
-            query = session.query(Message).filter(Message.from_chat.in_(
-                chat_ids)).filter(Message.from_id.in_(user_ids))
-        else:
-            count = session.query(Message).filter(
-                Message.from_chat.in_(chat_ids)).count()
-            query = session.query(Message).filter(
-                Message.from_chat.in_(chat_ids))
+            if not user_ids:
+                logging.info(f"No users found matching query: {user_query}")
+                return [], 0
 
-    # 添加时间范围过滤
-    if parsed_data.get('time_range'):
-        query = query.filter(
-            Message.date >= parsed_data['time_range']['start'],
-            Message.date <= parsed_data['time_range']['end']
-        )
-        # 重新计算总数
-        count = query.count()
-
-    # 添加群组过滤
-    if parsed_data.get('chat'):
-        chat_query = parsed_data['chat'].strip().lower()
-        matching_chats = [chat[0] for chat in filter_chats 
-                         if chat_query in chat[1].lower()]
-        if matching_chats:
-            query = query.filter(Message.from_chat.in_(matching_chats))
-            # 重新计算总数
-            count = query.count()
-        else:
-            return [], 0
+        # 构建查询，所有条件添加完后只计数一次
+        query = session.query(Message).filter(Message.from_chat.in_(chat_ids))
+        if parsed_data.get('keywords'):
+            query = query.filter(keyword_filter([keyword.strip().lower() for keyword in parsed_data['keywords']],
+                                            ignore_case=True))
+        if parsed_data.get('user'):
+            query = query.filter(Message.from_id.in_(user_ids))
 
-    # 获取分页数据
-    for message in query.order_by(Message.date.desc()).slice(start, stop).all():
-        user = session.query(User).filter_by(id=message.from_id).one()
-        chat_title = next(chat[1] for chat in filter_chats if chat[0] == message.from_chat)
-        
-        if message.type != 'text':
-            msg_text = f'[{message.type}] {message.text if message.text else ""}'
-        else:
-            msg_text = message.text
+        # 添加时间范围过滤
+        if parsed_data.get('time_range'):
+            query = query.filter(
+                Message.date >= parsed_data['time_range']['start'],
+                Message.date <= parsed_data['time_range']['end']
+            )
 
-        if msg_text == '':
-            continue
+        # 获取分页数据
+        messages, fetched = fetch_result_page(query, filter_chats, start, stop, cursor)
+        count = count_results(query, (cache_key, versions), start, fetched, page_size, total)
+        result_cache.store(page_key, versions, (messages, count))
 
-        messages.append({
-            'id': message.id,
-            'link': message.link,
-            'text': msg_text,
-            'date': message.date,
-            'user': user.fullname,
-            'chat': chat_title,
-            'type': message.type
-        })
+        logging.info(f"Retrieved {len(messages)} messages for page {page}")
+        return messages, count
 
-    logging.info(f"Retrieved {len(messages)} messages for page {page}")
-    return messages, count
+    # 同时进行的相同搜索只查询一次数据库
+    return search_flight.do(page_key, run)
 
 def format_parsed_data(parsed_data: dict) -> str:
     """格式化解析后的查询数据"""
@@ -330,76 +402,84 @@ def handle_nl_search(update: Update, context: CallbackContext):
         status_message = update.message.reply_text(safe_translate("Analyzing your query..."))
         logging.info("Calling DeepSeek API for query analysis")
         
-        try:
-            # 获取回复的消息（如果有）
-            reply_to_message = update.message.reply_to_message
-            
-            parsed_data = parse_date_with_llm(
-                query, 
-                current_time, 
-                from_user_id,
-                reply_to_message,
-                session
-            )
-            logging.info(f"Successfully parsed query: {parsed_data}")
-            
-            # 保存查询数据用于翻页，确保深拷贝并且所有字符串都被规范化
-            saved_query = json.loads(json.dumps(parsed_data))
-            if saved_query.get('user'):
-                saved_query['user'] = saved_query['user'].strip()
-            if saved_query.get('chat'):
-                saved_query['chat'] = saved_query['chat'].strip()
-            if saved_query.get('keywords'):
-                saved_query['keywords'] = [k.strip() for k in saved_query['keywords']]
-            
-            # 保存查询数据和当前群组ID到用户数据中
-            context.user_data['last_nl_query'] = saved_query
-            context.user_data['last_chat_id'] = current_chat_id
-            
-            # 保存查询参数以便在回调数据过长时使用
-            context.user_data['last_search_params'] = saved_query
-            # 明确保存当前群组ID，确保只搜索当前群组的消息
-            context.user_data['current_search_chat_id'] = current_chat_id
-        except Exception as e:
-            logging.error(f"Query parsing failed: {str(e)}", exc_info=True)
-            status_message.delete()
-            return update.message.reply_text(
-                safe_translate("Sorry, I couldn't understand your query. Please try again with a different wording.")
-            )
+        # 获取回复的消息（如果有）
+        reply_to_message = update.message.reply_to_message
+        future, cache_key = parse_query(
+            query, 
+            current_time, 
+            from_user_id,
+            reply_to_message,
+            session
+        )
+    except Exception as e:
+        logging.error(f"Natural language search failed: {str(e)}", exc_info=True)
+        if 'status_message' in locals():
+            try:
+                status_message.delete()
+            except:
+                pass
+        return update.message.reply_text(
+            safe_translate("An error occurred while processing your search. Please try again later.")
+        )
+    finally:
+        if 'session' in locals():
+            session.close()
+    
+    if future.done():
+        return finish_nl_search(future, update, status_message, filter_chats, cache_key)
+    
+    # 等待 LLM 时不占用 dispatcher 的工作线程，解析完成后再取一个工作线程执行搜索并更新状态消息
+    def on_parsed(done):
+        context.dispatcher.run_async(finish_nl_search_async, done, update, context, status_message, filter_chats,
+                                     cache_key)
+    future.add_done_callback(on_parsed)
+    # 状态消息会被编辑为搜索结果，由 auto_delete 按时删除
+    return status_message
+
+def finish_nl_search_async(future, update, context, status_message, filter_chats, cache_key=None):
+    sent_message = finish_nl_search(future, update, status_message, filter_chats, cache_key)
+    if sent_message and sent_message.message_id != status_message.message_id:
+        # 编辑失败时发送的新消息同样需要自动删除
+        schedule_delete(context.bot, sent_message.chat_id, sent_message.message_id, 120)
+
+def finish_nl_search(future, update, status_message, filter_chats, cache_key=None):
+    """查询解析完成后执行搜索，并将状态消息编辑为搜索结果; 提供 cache_key 时缓存 LLM 的解析结果"""
+    current_chat_id = filter_chats[0][0]
+    try:
+        parsed_data = future.result()
+        logging.info(f"Successfully parsed query: {parsed_data}")
+        if cache_key:
+            parse_cache.put(cache_key, parsed_data)
         
+        # 保存查询数据用于翻页，确保深拷贝并且所有字符串都被规范化
+        saved_query = json.loads(json.dumps(parsed_data))
+        if saved_query.get('user'):
+            saved_query['user'] = saved_query['user'].strip()
+        if saved_query.get('chat'):
+            saved_query['chat'] = saved_query['chat'].strip()
+        if saved_query.get('keywords'):
+            saved_query['keywords'] = [k.strip() for k in saved_query['keywords']]
+    except Exception as e:
+        logging.error(f"Query parsing failed: {str(e)}", exc_info=True)
+        status_message.delete()
+        return update.message.reply_text(
+            safe_translate("Sorry, I couldn't understand your query. Please try again with a different wording.")
+        )
+    
+    session = DBSession()
+    try:
         # 执行搜索
         logging.info("Executing database search")
         messages, count = search_messages_with_parsed_data(saved_query, filter_chats, session, page=1)
-        total_pages = math.ceil(count / SEARCH_PAGE_SIZE)
+        total_pages = count_pages(count)
         logging.info(f"Found {count} messages")
         
         # 格式化结果
         result_text = format_parsed_data(saved_query) + format_search_results(messages, 1, count)
         
-        # 检查回调数据长度
-        test_query_json = json.dumps(saved_query)
-        callback_data_length = len(f"search|nlsearch|1|{test_query_json}")
-        logging.info(f"Original callback data length: {callback_data_length} bytes")
-        logging.info(f"Original query content: {test_query_json}")
-        
-        if callback_data_length > 64:
-            logging.warning("Callback data exceeds Telegram's 64 byte limit, will be compressed")
-            
-            # 压缩查询参数
-            from app.handlers.search_common import compress_query_params, further_compress_params
-            compressed = compress_query_params(saved_query)
-            compressed_json = json.dumps(compressed)
-            compressed_length = len(f"search|nlsearch|1|{compressed_json}")
-            
-            logging.info(f"Compressed callback data length: {compressed_length} bytes")
-            logging.info(f"Compressed query content: {compressed_json}")
-            
-            if compressed_length > 64:
-                further_compressed = further_compress_params(compressed)
-                further_compressed_json = json.dumps(further_compressed)
-                further_compressed_length = len(f"search|nlsearch|1|{further_compressed_json}")
-                logging.info(f"Further compressed callback data length: {further_compressed_length} bytes")
-                logging.info(f"Further compressed query content: {further_compressed_json}")
+        # 查询数据保存在搜索会话中，翻页时只搜索当前群组的消息
+        token = create_session("nlsearch", saved_query, current_chat_id, count, page_cursors(1, messages),
+                               chat_ids=[chat[0] for chat in filter_chats])
         
         # 发送结果
         try:
@@ -407,7 +487,7 @@ def handle_nl_search(update: Update, context: CallbackContext):
                 result_text,
                 parse_mode='Markdown',
                 disable_web_page_preview=True,
-                reply_markup=build_search_keyboard(1, total_pages, "nlsearch", saved_query)
+                reply_markup=build_search_keyboard(1, total_pages, "nlsearch", token)
             )
             logging.info("Search results sent successfully")
             return sent_message
@@ -419,24 +499,22 @@ def handle_nl_search(update: Update, context: CallbackContext):
                 result_text,
                 parse_mode='Markdown',
                 disable_web_page_preview=True,
-                reply_markup=build_search_keyboard(1, total_pages, "nlsearch", saved_query)
+                reply_markup=build_search_keyboard(1, total_pages, "nlsearch", token)
             )
             logging.info("Search results sent as new message")
             return sent_message
         
     except Exception as e:
         logging.error(f"Natural language search failed: {str(e)}", exc_info=True)
-        if 'status_message' in locals():
-            try:
-                status_message.delete()
-            except:
-                pass
+        try:
+            status_message.delete()
+        except:
+            pass
         return update.message.reply_text(
             safe_translate("An error occurred while processing your search. Please try again later.")
         )
     finally:
-        if 'session' in locals():
-            session.close()
+        session.close()
 
 # 导出handlers
 nl_search_handler = CommandHandler('nlsearch', handle_nl_search)
@@ -1,14 +1,19 @@
-import json
 import html
 import logging
 import math
+import calendar
 import pytz
 import telegram
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+from sqlalchemy import and_, or_
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
-from app.models import Chat, DBSession
+from app.models import Chat, Message, User, DBSession
 from app.utils import get_text_func, auto_delete
+from app.utils.membership import filter_member_chats
+from app.utils.search_count import SearchTotal
+from app.utils.search_session import get_session, session_total, session_cursor, update_session
+from app.utils.singleflight import SingleFlight
 
 # Initialize translation function
 _ = get_text_func()
@@ -22,7 +27,85 @@ def safe_translate(text):
 # Default search page size
 SEARCH_PAGE_SIZE = 25
 
-def build_search_keyboard(page, total_pages, search_type, query_params):
+# 翻页游标方向
+CURSOR_AFTER = 'a'
+CURSOR_BEFORE = 'b'
+
+# 合并同时进行的相同搜索
+search_flight = SingleFlight('search.singleflight')
+
+def fetch_result_page(query, filter_chats, start, stop, cursor=None):
+    """
+    取出一页搜索结果
+    
+    只查询展示需要的列，并在同一条查询中 LEFT JOIN 取出发送者名称，避免逐条查询用户。
+    提供游标时按 (date, _id) 定位翻页，深页与第一页的开销相同；否则按 start/stop 偏移分页。
+    
+    Args:
+        query: 已添加过滤条件的 Message 查询
+        filter_chats: [(chat_id, chat_title), ...]
+        start, stop: 分页切片位置
+        cursor: encode_cursor 生成的翻页游标
+    
+    Returns:
+        tuple: (消息字典列表, 从数据库取出的行数)
+        没有文本的消息也在列表中, 标记为 hidden, 不展示, 但翻页游标需要以实际取出的第一行和最后一行为准
+    """
+    chat_titles = dict(filter_chats)
+    newest_first = True
+    decoded = decode_cursor(cursor) if cursor else None
+    if decoded:
+        direction, date, _id = decoded
+        if direction == CURSOR_AFTER:
+            query = query.filter(or_(Message.date < date, and_(Message.date == date, Message._id < _id)))
+        else:
+            query = query.filter(or_(Message.date > date, and_(Message.date == date, Message._id > _id)))
+            newest_first = False
+        start, stop = 0, stop - start
+    
+    if newest_first:
+        order = (Message.date.desc(), Message._id.desc())
+    else:
+        order = (Message.date.asc(), Message._id.asc())
+    
+    # 先在子查询中只按 (date, _id) 分页，再为这一页的消息关联发送者
+    page_ids = query.with_entities(Message._id) \
+        .order_by(*order) \
+        .slice(start, stop).subquery()
+    rows = query.session.query(
+        Message._id, Message.id, Message.link, Message.text, Message.date, Message.type, Message.from_chat,
+        User.fullname
+    ).join(page_ids, Message._id == page_ids.c._id) \
+        .outerjoin(User, User.id == Message.from_id) \
+        .order_by(*order).all()
+    if not newest_first:
+        rows.reverse()
+    
+    messages = []
+    for _id, msg_id, link, text, date, msg_type, from_chat, fullname in rows:
+        if msg_type != 'text':
+            msg_text = f'[{msg_type}] {text if text else ""}'
+        else:
+            msg_text = text
+
+        messages.append({
+            'hidden': not msg_text,
+            '_id': _id,
+            'id': msg_id,
+            'link': link,
+            'text': msg_text,
+            'date': date,
+            'user': fullname,
+            'chat': chat_titles.get(from_chat, ''),
+            'type': msg_type
+        })
+    return messages, len(rows)
+
+def count_pages(total_count):
+    """计算总页数，总数为估计值时页数同样显示为“至少”"""
+    return SearchTotal(math.ceil(total_count / SEARCH_PAGE_SIZE), exact=getattr(total_count, 'exact', True))
+
+def build_search_keyboard(page, total_pages, search_type, token):
     """
     构建通用的翻页键盘
     
@@ -30,7 +113,7 @@ def build_search_keyboard(page, total_pages, search_type, query_params):
         page: 当前页码
         total_pages: 总页数
         search_type: 搜索类型，'search' 或 'nlsearch'
-        query_params: 包含搜索参数的字典
+        token: 搜索会话令牌，查询参数和翻页游标保存在会话中
     
     Returns:
         InlineKeyboardMarkup: 翻页键盘
@@ -38,46 +121,10 @@ def build_search_keyboard(page, total_pages, search_type, query_params):
     keyboard = []
     buttons = []
     
-    # 记录原始查询参数大小
-    original_json = json.dumps(query_params)
-    original_size = len(original_json)
-    logging.info(f"Original query params size: {original_size} bytes")
-    
-    # 压缩查询参数以避免回调数据过长
-    compressed_params = compress_query_params(query_params)
-    
-    # 将查询参数序列化为JSON字符串
-    query_json = json.dumps(compressed_params)
-    compressed_size = len(query_json)
-    logging.info(f"Compressed query params size: {compressed_size} bytes (减少了 {original_size - compressed_size} bytes)")
-    
-    # 确保回调数据不超过64字节
-    max_callback_length = 64
-    callback_data = f"search|{search_type}|{page}|{query_json}"
-    
-    if len(callback_data) > max_callback_length:
-        # 如果超过限制，进一步压缩
-        logging.warning(f"Callback data too long: {len(callback_data)} bytes")
-        compressed_params = further_compress_params(compressed_params)
-        query_json = json.dumps(compressed_params)
-        further_compressed_size = len(query_json)
-        callback_data = f"search|{search_type}|{page}|{query_json}"
-        logging.info(f"Further compressed to: {len(callback_data)} bytes (减少了 {compressed_size - further_compressed_size} bytes)")
-        
-        # 如果还是太长，使用最小化的回调数据
-        if len(callback_data) > max_callback_length:
-            # 最后的手段：只保留页码信息，丢弃查询参数
-            callback_data = f"search|{search_type}|{page}|{{}}"
-            logging.warning(f"Using minimal callback data: {len(callback_data)} bytes")
-    
     if page > 1:
-        prev_callback = f"search|{search_type}|{page-1}|{query_json}"
-        if len(prev_callback) > max_callback_length:
-            prev_callback = f"search|{search_type}|{page-1}|{{}}"
-        
         buttons.append(InlineKeyboardButton(
             "⬅️", 
-            callback_data=prev_callback
+            callback_data=f"search|{search_type}|{page - 1}|{token}"
         ))
     
     buttons.append(InlineKeyboardButton(
@@ -86,155 +133,59 @@ def build_search_keyboard(page, total_pages, search_type, query_params):
     ))
     
     if page < total_pages:
-        next_callback = f"search|{search_type}|{page+1}|{query_json}"
-        if len(next_callback) > max_callback_length:
-            next_callback = f"search|{search_type}|{page+1}|{{}}"
-            
         buttons.append(InlineKeyboardButton(
             "➡️", 
-            callback_data=next_callback
+            callback_data=f"search|{search_type}|{page + 1}|{token}"
         ))
     
     keyboard.append(buttons)
     return InlineKeyboardMarkup(keyboard)
 
-def compress_query_params(params):
-    """压缩查询参数，移除不必要的数据"""
-    compressed = {}
-    
-    # 复制必要的字段
-    if 'keywords' in params and params['keywords']:
-        # 限制关键词长度
-        compressed['k'] = [k[:10] for k in params['keywords'][:3]] if params['keywords'] else None
-    
-    if 'time_range' in params and params['time_range']:
-        # 将日期时间转换为时间戳
-        time_range = params['time_range']
-        compressed['t'] = {}
-        
-        if 'start' in time_range:
-            try:
-                # 解析日期时间字符串为datetime对象
-                start_dt = datetime.strptime(time_range['start'], '%Y-%m-%d %H:%M:%S')
-                # 转换为时间戳
-                compressed['t']['s'] = int(start_dt.timestamp())
-            except:
-                # 解析失败时不包含此字段
-                pass
-                
-        if 'end' in time_range:
-            try:
-                # 解析日期时间字符串为datetime对象
-                end_dt = datetime.strptime(time_range['end'], '%Y-%m-%d %H:%M:%S')
-                # 转换为时间戳
-                compressed['t']['e'] = int(end_dt.timestamp())
-            except:
-                # 解析失败时不包含此字段
-                pass
-    
-    if 'user' in params and params['user']:
-        # 限制用户名长度
-        compressed['u'] = params['user'][:10] if params['user'] else None
-    
-    if 'chat' in params and params['chat']:
-        # 限制群组名长度
-        compressed['c'] = params['chat'][:10] if params['chat'] else None
-    
-    return compressed
+def page_cursors(page, messages):
+    """根据当前页取出的第一行和最后一行（包括不展示的消息）生成前后两页的游标，格式为 {页码: 游标}"""
+    if not messages:
+        return {}
+    return {
+        page - 1: encode_cursor(CURSOR_BEFORE, messages[0]['date'], messages[0]['_id']),
+        page + 1: encode_cursor(CURSOR_AFTER, messages[-1]['date'], messages[-1]['_id'])
+    }
 
-def further_compress_params(params):
-    """进一步压缩参数，用于处理极端情况"""
-    # 如果还是太长，只保留最基本的信息
-    minimal = {}
-    
-    # 只保留用户名，最多3个字符
-    if 'u' in params and params['u']:
-        minimal['u'] = params['u'][:3]
-    
-    # 时间范围保留时间戳
-    if 't' in params:
-        minimal['t'] = {}
-        if 's' in params['t']:
-            minimal['t']['s'] = params['t']['s']
-        if 'e' in params['t']:
-            minimal['t']['e'] = params['t']['e']
-    
-    # 完全省略关键词和群组
-    
-    return minimal
+def _to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if not number:
+            return result
 
-def decompress_query_params(compressed_params):
-    """将压缩的查询参数还原为原始格式"""
-    original = {}
-    
-    if 'k' in compressed_params:
-        original['keywords'] = compressed_params['k']
-    
-    if 't' in compressed_params:
-        # 还原时间范围
-        time_range = compressed_params['t']
-        original['time_range'] = {}
-        
-        # 处理时间戳
-        if 's' in time_range:
-            try:
-                # 如果是整数时间戳
-                if isinstance(time_range['s'], int):
-                    # 从时间戳创建datetime对象
-                    start_dt = datetime.fromtimestamp(time_range['s'])
-                    original['time_range']['start'] = start_dt.strftime('%Y-%m-%d %H:%M:%S')
-                # 兼容旧格式 (短日期格式 MM-DD)
-                elif isinstance(time_range['s'], str) and len(time_range['s']) <= 5:
-                    year = datetime.now().year
-                    original['time_range']['start'] = f"{year}-{time_range['s']} 00:00:00"
-                # 兼容旧格式 (完整日期)
-                elif isinstance(time_range['s'], str):
-                    original['time_range']['start'] = f"{time_range['s']} 00:00:00"
-            except:
-                # 解析失败时使用默认值
-                original['time_range']['start'] = "2000-01-01 00:00:00"
-        
-        if 'e' in time_range:
-            try:
-                # 如果是整数时间戳
-                if isinstance(time_range['e'], int):
-                    # 从时间戳创建datetime对象
-                    end_dt = datetime.fromtimestamp(time_range['e'])
-                    original['time_range']['end'] = end_dt.strftime('%Y-%m-%d %H:%M:%S')
-                # 兼容旧格式 (短日期格式 MM-DD)
-                elif isinstance(time_range['e'], str) and len(time_range['e']) <= 5:
-                    year = datetime.now().year
-                    original['time_range']['end'] = f"{year}-{time_range['e']} 23:59:59"
-                # 兼容旧格式 (完整日期)
-                elif isinstance(time_range['e'], str):
-                    original['time_range']['end'] = f"{time_range['e']} 23:59:59"
-            except:
-                # 解析失败时使用当前时间
-                original['time_range']['end'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # 如果只有结束日期，设置开始日期为结束日期的前一天
-        if 'end' in original['time_range'] and 'start' not in original['time_range']:
-            try:
-                end_dt = datetime.strptime(original['time_range']['end'], '%Y-%m-%d %H:%M:%S')
-                start_dt = end_dt - timedelta(days=1)
-                original['time_range']['start'] = start_dt.strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                original['time_range']['start'] = "2000-01-01 00:00:00"
-        
-        # 如果只有开始日期，设置结束日期为开始日期的当天结束
-        if 'start' in original['time_range'] and 'end' not in original['time_range']:
-            original['time_range']['end'] = original['time_range']['start'].replace("00:00:00", "23:59:59")
-    
-    if 'u' in compressed_params:
-        original['user'] = compressed_params['u']
-    
-    if 'c' in compressed_params:
-        original['chat'] = compressed_params['c']
+def encode_cursor(direction, date, _id):
+    """
+    将 (date, _id) 编码为翻页游标，例如 'ar8kq2o.1z4x'
     
-    return original
+    Args:
+        direction: CURSOR_AFTER 取更早的消息（下一页），CURSOR_BEFORE 取更新的消息（上一页）
+        date: 消息时间（UTC）
+        _id: 消息主键
+    """
+    timestamp = calendar.timegm(date.utctimetuple())
+    return f"{direction}{_to_base36(timestamp)}.{_to_base36(_id)}"
+
+def decode_cursor(cursor):
+    """解析翻页游标，无效时返回 None"""
+    try:
+        direction = cursor[0]
+        timestamp, _id = cursor[1:].split('.')
+        if direction not in (CURSOR_AFTER, CURSOR_BEFORE):
+            return None
+        date = datetime.fromtimestamp(int(timestamp, 36), timezone.utc).replace(tzinfo=None)
+        return direction, date, int(_id, 36)
+    except (IndexError, ValueError, OverflowError):
+        return None
 
 def format_search_results(messages, page, total_count):
     """格式化搜索结果文本"""
+    messages = [msg for msg in messages if not msg['hidden']]
     if not messages:
         return safe_translate("No results found")
     
@@ -287,44 +238,19 @@ def get_filter_chats_for_user(context, from_user_id, current_chat_id=None):
         list: 可搜索的群组列表，格式为 [(chat_id, chat_title), ...]
     """
     session = DBSession()
-    filter_chats = []
     
     try:
         # 如果指定了当前群组，只搜索当前群组
         if current_chat_id:
-            current_chat = session.query(Chat).filter_by(id=current_chat_id).first()
-            if current_chat and current_chat.enable:
-                try:
-                    chat_member = context.bot.get_chat_member(
-                        chat_id=current_chat_id, 
-                        user_id=from_user_id
-                    )
-                    if chat_member.status not in ['left', 'kicked']:
-                        filter_chats.append((current_chat_id, current_chat.title))
-                except telegram.error.BadRequest as e:
-                    logging.error(f"获取群组 {current_chat_id} 成员信息失败: {str(e)}")
-                except Exception as e:
-                    logging.error(f"验证用户群组成员资格时出错: {str(e)}")
+            enabled_chats = session.query(Chat).filter_by(id=current_chat_id, enable=True).all()
         else:
             # 否则搜索所有启用的群组
-            enabled_chats = [chat for chat in session.query(Chat).all() if chat.enable]
-            
-            for chat in enabled_chats:
-                try:
-                    chat_member = context.bot.get_chat_member(
-                        chat_id=chat.id, user_id=from_user_id)
-                    if chat_member.status not in ['left', 'kicked']:
-                        filter_chats.append((chat.id, chat.title))
-                except telegram.error.BadRequest as e:
-                    logging.error(f"获取群组 {chat.id} 成员信息失败: {str(e)}")
-                except telegram.error.Unauthorized as e:
-                    logging.error(f"群组 {chat.id} 未授权: {str(e)}")
-                except Exception as e:
-                    logging.error(f"处理群组 {chat.id} 时发生错误: {str(e)}")
+            enabled_chats = session.query(Chat).filter(Chat.enable == True).all()
+        enabled_chats = [(chat.id, chat.title) for chat in enabled_chats]
     finally:
         session.close()
         
-    return filter_chats
+    return filter_member_chats(context.bot, enabled_chats, from_user_id)
 
 @auto_delete(timeout=120, delete_command=False)  # Callback queries don't need to delete the command
 def handle_search_page_callback(update: Update, context: CallbackContext):
@@ -342,13 +268,13 @@ def handle_search_page_callback(update: Update, context: CallbackContext):
         return
     
     try:
-        # 解析回调数据
+        # 解析回调数据，格式为 search|类型|页码|会话令牌
         parts = query.data.split('|')
         if len(parts) != 4:
             query.answer(safe_translate("Invalid callback data"), show_alert=True)
             return
             
-        action, search_type, page, query_json = parts
+        action, search_type, page, token = parts
         
         if action != "search":
             query.answer()
@@ -356,42 +282,36 @@ def handle_search_page_callback(update: Update, context: CallbackContext):
             
         page = int(page)
         
-        # 处理空查询参数的情况
-        if query_json == "{}" or not query_json:
-            # 如果查询参数为空，使用用户数据中存储的最后一次查询
-            if 'last_search_params' not in context.user_data:
-                query.answer(safe_translate("Search parameters lost. Please search again."), show_alert=True)
-                return
-            query_params = context.user_data['last_search_params']
-            logging.info("Using cached search parameters from user_data")
-        else:
-            # 正常解析查询参数
-            compressed_params = json.loads(query_json)
-            # 解压缩查询参数
-            query_params = decompress_query_params(compressed_params)
-            # 缓存查询参数以备后用
-            context.user_data['last_search_params'] = query_params
-            logging.info(f"Decompressed query parameters: {query_params}")
+        # 从搜索会话中取出完整的查询参数
+        search_session = get_session(token)
+        if not search_session:
+            query.answer(safe_translate("Search parameters lost. Please search again."), show_alert=True)
+            return
+        query_params = search_session['params']
         
         # 获取当前用户ID
         from_user_id = update.effective_user.id
-        current_chat_id = update.effective_message.chat_id
+        # 内联模式发送的消息没有所属群组
+        current_chat_id = update.effective_message.chat_id if update.effective_message else None
         
         # 检查是否是原始搜索的群组
-        original_chat_id = context.user_data.get('last_chat_id')
-        if original_chat_id and original_chat_id != current_chat_id:
+        search_chat_id = search_session['chat_id']
+        if search_chat_id and current_chat_id and search_chat_id != current_chat_id:
             query.answer(safe_translate("Please use the search command in the original group"), show_alert=True)
             return
         
         # 获取可搜索的群组
-        # 使用current_search_chat_id确保只搜索当前群组的消息
-        search_chat_id = context.user_data.get('current_search_chat_id', original_chat_id)
         filter_chats = get_filter_chats_for_user(context, from_user_id, search_chat_id)
         
         if not filter_chats:
             query.answer(safe_translate("No searchable groups, please ensure the bot is properly enabled"), show_alert=True)
             return
         
+        # 复用会话中保存的游标和总数, 只在可搜索的群组相同时有效
+        chat_ids = [chat[0] for chat in filter_chats]
+        cursor = session_cursor(search_session, chat_ids, page)
+        total = session_total(search_session, chat_ids)
+        
         # 根据搜索类型执行不同的搜索
         if search_type == "search":
             from app.handlers.msg_search import search_messages
@@ -399,16 +319,24 @@ def handle_search_page_callback(update: Update, context: CallbackContext):
                 query_params.get('user'), 
                 query_params.get('keywords'), 
                 page, 
-                filter_chats
+                filter_chats,
+                cursor=cursor,
+                total=total
             )
         elif search_type == "nlsearch":
             from app.handlers.nl_search import search_messages_with_parsed_data
-            messages, count = search_messages_with_parsed_data(
-                query_params, 
-                filter_chats, 
-                DBSession(), 
-                page
-            )
+            session = DBSession()
+            try:
+                messages, count = search_messages_with_parsed_data(
+                    query_params, 
+                    filter_chats, 
+                    session, 
+                    page,
+                    cursor=cursor,
+                    total=total
+                )
+            finally:
+                session.close()
         else:
             query.answer(safe_translate("Invalid search type"), show_alert=True)
             return
@@ -417,7 +345,7 @@ def handle_search_page_callback(update: Update, context: CallbackContext):
             query.answer(safe_translate("No messages found matching your criteria"), show_alert=True)
             return
             
-        total_pages = math.ceil(count / SEARCH_PAGE_SIZE)
+        total_pages = count_pages(count)
         
         if page > total_pages:
             query.answer(safe_translate("Already at the last page"), show_alert=True)
@@ -425,13 +353,14 @@ def handle_search_page_callback(update: Update, context: CallbackContext):
             
         # 格式化结果
         result_text = format_search_results(messages, page, count)
+        update_session(token, search_session, chat_ids, count, page_cursors(page, messages))
         
         # 更新消息
         query.edit_message_text(
             result_text,
             parse_mode='Markdown',
             disable_web_page_preview=True,
-            reply_markup=build_search_keyboard(page, total_pages, search_type, query_params)
+            reply_markup=build_search_keyboard(page, total_pages, search_type, token)
         )
         
     except Exception as e:
@@ -1,46 +1,13 @@
-import logging
-import matplotlib.pyplot as plt
-import numpy as np
 import io
-import os
-import time
+import logging
+import threading
+from cachetools import TTLCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, CallbackQueryHandler, CallbackContext
-from app.utils import get_statistics_data, get_text_func, auto_delete
-import matplotlib
-matplotlib.use('Agg')  # 使用非交互式后端
-
-# 完全禁用字体设置，使用ASCII标签代替中文
-USE_ASCII_LABELS = True
-
-# 设置中文字体支持
-try:
-    # 尝试多种可能的中文字体
-    font_list = ['SimHei', 'Microsoft YaHei', 'WenQuanYi Micro Hei', 'PingFang SC', 'Heiti SC', 'Source Han Sans CN', 'Noto Sans CJK SC', 'Noto Sans SC', 'DejaVu Sans']
-    
-    # 检查系统中可用的字体
-    import matplotlib.font_manager as fm
-    system_fonts = set(f.name for f in fm.fontManager.ttflist)
-    logging.info(f"系统可用字体: {system_fonts}")
-    
-    # 找到第一个可用的字体
-    available_font = None
-    for font in font_list:
-        if font in system_fonts:
-            available_font = font
-            logging.info(f"找到可用字体: {font}")
-            break
-    
-    if available_font:
-        plt.rcParams['font.sans-serif'] = [available_font] + plt.rcParams['font.sans-serif']
-        plt.rcParams['axes.unicode_minus'] = False  # 用来正常显示负号
-        USE_ASCII_LABELS = False
-    else:
-        logging.warning("未找到可用的中文字体，将使用ASCII标签")
-except Exception as e:
-    logging.warning(f"设置字体时出错: {str(e)}")
-    # 使用不依赖字体的替代方案
-    plt.rcParams['font.family'] = 'sans-serif'
+from app.utils import get_statistics_data, get_text_func, auto_delete, is_bot_admin
+from app.utils import chart_cache
+from app.utils.chart_labels import use_ascii_labels, get_label
+from app.utils.chart_pool import chart_pool, ChartQueueFull
 
 # 初始化翻译函数
 _ = get_text_func()
@@ -51,277 +18,28 @@ def safe_translate(text):
         return _(text)
     return text
 
+# 各统计类型的图表标题
+CHART_TITLES = {
+    "msg_types": '消息类型分布',
+    "top_users": '最活跃的用户 (Top 10)',
+    "top_chats": '最活跃的群组 (Top 10)',
+    "time_patterns": '消息时间模式分析',
+    "msg_length": '消息长度分布'
+}
+
 # 回调数据前缀
 STATS_CALLBACK_PREFIX = "stats_"
 
 # 统计类型
 STATS_TYPES = {
-    "overview": "总览" if not USE_ASCII_LABELS else "Overview",
-    "msg_types": "消息类型" if not USE_ASCII_LABELS else "Message Types",
-    "top_users": "活跃用户" if not USE_ASCII_LABELS else "Active Users",
-    "top_chats": "活跃群组" if not USE_ASCII_LABELS else "Active Groups",
-    "time_patterns": "时间模式" if not USE_ASCII_LABELS else "Time Patterns",
-    "msg_length": "消息长度" if not USE_ASCII_LABELS else "Message Length"
+    "overview": "总览",
+    "msg_types": "消息类型",
+    "top_users": "活跃用户",
+    "top_chats": "活跃群组",
+    "time_patterns": "时间模式",
+    "msg_length": "消息长度"
 }
 
-# 中英文标签映射
-LABEL_MAP = {
-    '总消息数': 'Total Messages',
-    '总用户数': 'Total Users',
-    '总群组数': 'Total Groups',
-    '最近7天消息': 'Last 7 Days',
-    '周一': 'Mon',
-    '周二': 'Tue',
-    '周三': 'Wed',
-    '周四': 'Thu',
-    '周五': 'Fri',
-    '周六': 'Sat',
-    '周日': 'Sun',
-    '按小时分布': 'Hourly Distribution',
-    '按星期分布': 'Weekly Distribution',
-    '小时 (24小时制)': 'Hour (24h)',
-    '星期': 'Weekday',
-    '消息数量': 'Message Count',
-    '字符数范围': 'Character Range',
-    '消息类型分布': 'Message Type Distribution',
-    '最活跃的用户 (Top 10)': 'Most Active Users (Top 10)',
-    '最活跃的群组 (Top 10)': 'Most Active Groups (Top 10)',
-    '消息时间模式分析': 'Message Time Pattern Analysis',
-    '消息长度分布': 'Message Length Distribution',
-    'Telegram 机器人数据总览': 'Telegram Bot Data Overview',
-}
-
-def get_label(text):
-    """根据当前设置返回适当的标签文本"""
-    if USE_ASCII_LABELS:
-        return LABEL_MAP.get(text, text)
-    return text
-
-def generate_overview_chart(stats):
-    """生成总览统计图表"""
-    # 创建图表
-    fig, ax = plt.subplots(figsize=(10, 6))
-    
-    # 准备数据
-    if 'chat_title' in stats:
-        # 群组特定统计
-        title = f"Group '{stats['chat_title']}' Data Overview" if USE_ASCII_LABELS else f"群组 '{stats['chat_title']}' 数据总览"
-    else:
-        # 全局统计
-        title = get_label('Telegram 机器人数据总览')
-    
-    labels = [get_label('总消息数'), get_label('总用户数'), get_label('最近7天消息')]
-    values = [
-        stats['total_messages'],
-        stats['total_users'],
-        stats['recent_messages']
-    ]
-    
-    # 如果是全局统计，添加群组数量
-    if 'chat_title' not in stats:
-        labels.append(get_label('总群组数'))
-        values.append(stats['total_chats'])
-    
-    # 创建柱状图
-    colors = ['#3498db', '#2ecc71', '#f39c12']
-    if len(labels) > 3:
-        colors.append('#e74c3c')
-    
-    bars = ax.bar(labels, values, color=colors)
-    
-    # 添加数值标签
-    for bar in bars:
-        height = bar.get_height()
-        ax.text(bar.get_x() + bar.get_width()/2., height + 0.1,
-                f'{int(height):,}', ha='center', va='bottom')
-    
-    # 设置标题和标签
-    ax.set_title(title, fontsize=16)
-    ax.set_ylabel(get_label('消息数量'))
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
-def generate_message_types_chart(stats):
-    """生成消息类型分布图表"""
-    # 创建图表
-    fig, ax = plt.subplots(figsize=(10, 6))
-    
-    # 准备数据
-    msg_types = stats['message_types']
-    labels = list(msg_types.keys())
-    values = list(msg_types.values())
-    
-    # 创建饼图
-    wedges, texts, autotexts = ax.pie(
-        values, 
-        labels=labels, 
-        autopct='%1.1f%%',
-        textprops={'fontsize': 12},
-        colors=plt.cm.Paired(np.linspace(0, 1, len(labels)))
-    )
-    
-    # 设置标题
-    ax.set_title(get_label('消息类型分布'), fontsize=16)
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
-def generate_top_users_chart(stats):
-    """生成活跃用户图表"""
-    # 创建图表
-    fig, ax = plt.subplots(figsize=(12, 6))
-    
-    # 准备数据
-    top_users = stats['top_users']
-    names = [user['name'] for user in top_users]
-    counts = [user['count'] for user in top_users]
-    
-    # 创建水平条形图
-    bars = ax.barh(names, counts, color=plt.cm.viridis(np.linspace(0, 0.8, len(names))))
-    
-    # 添加数值标签
-    for i, bar in enumerate(bars):
-        width = bar.get_width()
-        ax.text(width + 3, bar.get_y() + bar.get_height()/2, f'{int(width):,}',
-                ha='left', va='center')
-    
-    # 设置标题和标签
-    ax.set_title(get_label('最活跃的用户 (Top 10)'), fontsize=16)
-    ax.set_xlabel(get_label('消息数量'))
-    
-    # 反转y轴，使最活跃的用户显示在顶部
-    ax.invert_yaxis()
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
-def generate_top_chats_chart(stats):
-    """生成活跃群组图表"""
-    # 创建图表
-    fig, ax = plt.subplots(figsize=(12, 6))
-    
-    # 准备数据
-    top_chats = stats['top_chats']
-    names = [chat['name'] for chat in top_chats]
-    counts = [chat['count'] for chat in top_chats]
-    
-    # 创建水平条形图
-    bars = ax.barh(names, counts, color=plt.cm.cool(np.linspace(0, 0.8, len(names))))
-    
-    # 添加数值标签
-    for i, bar in enumerate(bars):
-        width = bar.get_width()
-        ax.text(width + 3, bar.get_y() + bar.get_height()/2, f'{int(width):,}',
-                ha='left', va='center')
-    
-    # 设置标题和标签
-    ax.set_title(get_label('最活跃的群组 (Top 10)'), fontsize=16)
-    ax.set_xlabel(get_label('消息数量'))
-    
-    # 反转y轴，使最活跃的群组显示在顶部
-    ax.invert_yaxis()
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
-def generate_time_patterns_chart(stats):
-    """生成时间模式图表"""
-    # 创建图表
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
-    
-    # 准备小时数据
-    hour_data = stats['hour_distribution']
-    hours = list(range(24))
-    hour_counts = [hour_data.get(h, 0) for h in hours]
-    
-    # 创建小时柱状图
-    ax1.bar(hours, hour_counts, color='#3498db')
-    ax1.set_title(get_label('按小时分布'), fontsize=14)
-    ax1.set_xlabel(get_label('小时 (24小时制)'))
-    ax1.set_ylabel(get_label('消息数量'))
-    ax1.set_xticks(range(0, 24, 2))
-    
-    # 准备星期数据
-    weekday_data = stats['weekday_distribution']
-    weekdays = list(range(7))
-    weekday_names = [get_label('周一'), get_label('周二'), get_label('周三'), 
-                     get_label('周四'), get_label('周五'), get_label('周六'), 
-                     get_label('周日')]
-    weekday_counts = [weekday_data.get(w, 0) for w in weekdays]
-    
-    # 创建星期柱状图
-    ax2.bar(weekday_names, weekday_counts, color='#2ecc71')
-    ax2.set_title(get_label('按星期分布'), fontsize=14)
-    ax2.set_xlabel(get_label('星期'))
-    ax2.set_ylabel(get_label('消息数量'))
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
-def generate_message_length_chart(stats):
-    """生成消息长度分布图表"""
-    # 创建图表
-    fig, ax = plt.subplots(figsize=(10, 6))
-    
-    # 准备数据
-    length_data = stats['message_length']
-    labels = list(length_data.keys())
-    values = list(length_data.values())
-    
-    # 创建柱状图
-    bars = ax.bar(labels, values, color=plt.cm.plasma(np.linspace(0, 0.8, len(labels))))
-    
-    # 添加数值标签
-    for bar in bars:
-        height = bar.get_height()
-        ax.text(bar.get_x() + bar.get_width()/2., height + 0.1,
-                f'{int(height):,}', ha='center', va='bottom')
-    
-    # 设置标题和标签
-    ax.set_title(get_label('消息长度分布'), fontsize=16)
-    ax.set_xlabel(get_label('字符数范围'))
-    ax.set_ylabel(get_label('消息数量'))
-    
-    # 保存到内存
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
-
 def build_stats_keyboard():
     """构建统计类型选择键盘"""
     keyboard = []
@@ -333,7 +51,7 @@ def build_stats_keyboard():
             row = []
         
         row.append(InlineKeyboardButton(
-            label, callback_data=f"{STATS_CALLBACK_PREFIX}{key}"
+            get_label(label), callback_data=f"{STATS_CALLBACK_PREFIX}{key}"
         ))
     
     if row:  # 添加最后一行
@@ -341,50 +59,50 @@ def build_stats_keyboard():
     
     return InlineKeyboardMarkup(keyboard)
 
-# 设置数据过期时间（秒）
-DATA_EXPIRY_TIME = 3600  # 1小时
+# 统计消息与统计范围的关联保存时间（秒）和数量上限
+STATS_STATE_TTL = 3600  # 1小时
+STATS_STATE_SIZE = 10000
 
-def clean_expired_data(context: CallbackContext):
-    """清理过期的统计数据关联"""
-    current_time = time.time()
-    keys_to_delete = []
-    
-    # 查找所有stats_chat_id_开头的键
-    for key, value in context.bot_data.items():
-        if key.startswith('stats_chat_id_'):
-            # 检查时间戳是否存在
-            timestamp_key = f'stats_timestamp_{key[13:]}'
-            if timestamp_key in context.bot_data:
-                # 如果时间戳超过过期时间，则标记为删除
-                if current_time - context.bot_data[timestamp_key] > DATA_EXPIRY_TIME:
-                    keys_to_delete.append(key)
-                    keys_to_delete.append(timestamp_key)
-    
-    # 删除过期的数据
-    for key in keys_to_delete:
-        del context.bot_data[key]
-    
-    if keys_to_delete:
-        logging.info(f"已清理 {len(keys_to_delete) // 2} 条过期的统计数据关联")
+# (消息所在聊天ID, 消息ID) -> 统计的群组ID, 全局统计为 None; 过期自动清除
+_stats_targets = TTLCache(maxsize=STATS_STATE_SIZE, ttl=STATS_STATE_TTL)
+_stats_lock = threading.Lock()
+
+def remember_stats_target(message, chat_id):
+    """记录带统计键盘的消息对应的统计范围"""
+    with _stats_lock:
+        _stats_targets[(message.chat_id, message.message_id)] = chat_id
+
+def get_stats_target(message):
+    with _stats_lock:
+        return _stats_targets.get((message.chat_id, message.message_id))
+
+def can_view_global_stats(user_id):
+    """全局统计包含所有群组的数据, 只对 group_admins 中的机器人管理员开放 (不需要设置 enable)"""
+    return is_bot_admin(user_id)
+
+def global_stats_denied_text():
+    if use_ascii_labels():
+        return "Statistics across all groups are only available to bot administrators. Please use /stats in a group."
+    return "所有群组的统计数据仅对机器人管理员开放，请在群组中使用 /stats 命令。"
 
 @auto_delete(timeout=300)  # 设置5分钟超时
 def handle_stats_command(update: Update, context: CallbackContext):
     """处理 /stats 命令"""
-    # 清理过期数据
-    clean_expired_data(context)
-    
     # 检查是否在群组中
     chat_id = update.effective_chat.id
     is_group = chat_id < 0  # 群组ID为负数
     
+    if not is_group and not can_view_global_stats(update.effective_user.id):
+        return update.message.reply_text(global_stats_denied_text())
+    
     # 准备消息文本
     if is_group:
-        if USE_ASCII_LABELS:
+        if use_ascii_labels():
             message_text = f"📊 *{update.effective_chat.title} Statistics*\n\nPlease select a statistic type:"
         else:
             message_text = f"📊 *{update.effective_chat.title} 数据统计*\n\n请选择要查看的统计类型："
     else:
-        if USE_ASCII_LABELS:
+        if use_ascii_labels():
             message_text = "📊 *Telegram Bot Statistics*\n\nPlease select a statistic type:"
         else:
             message_text = "📊 *Telegram 数据统计*\n\n请选择要查看的统计类型："
@@ -396,19 +114,33 @@ def handle_stats_command(update: Update, context: CallbackContext):
         reply_markup=build_stats_keyboard()
     )
     
-    # 存储消息ID和聊天ID，用于后续处理
-    # 使用消息ID作为唯一标识符，避免不同群组之间的混淆
-    message_id = message.message_id
-    context.bot_data[f'stats_chat_id_{message_id}'] = chat_id if is_group else None
-    context.bot_data[f'stats_timestamp_{message_id}'] = time.time()  # 添加时间戳
+    # 记录这条消息对应的统计范围，用于后续按钮回调
+    remember_stats_target(message, chat_id if is_group else None)
+    return message
+
+def render_stats_chart(chat_id, stats_type):
+    """查询统计数据并生成图表, 返回 (PNG 字节, 标题)"""
+    stats = get_statistics_data(chat_id)
+    
+    # 在渲染进程中生成图表
+    png = chart_pool.render(stats_type, stats)
+    
+    if stats_type == "overview":
+        if chat_id:
+            caption = f"📊 {'Group' if use_ascii_labels() else '群组'} '{stats.get('chat_title', 'Current Group')}' {'Data Overview' if use_ascii_labels() else '数据总览'}"
+        else:
+            caption = "📊 " + get_label('Telegram 机器人数据总览')
+    else:
+        caption = "📊 " + get_label(CHART_TITLES[stats_type])
+    
+    # 如果是群组特定统计，在标题中添加群组名称
+    if chat_id and stats_type != "overview" and 'chat_title' in stats:
+        caption = f"{caption} - {stats['chat_title']}"
+    return png, caption
 
 def handle_stats_callback(update: Update, context: CallbackContext):
     """处理统计回调查询"""
-    # 清理过期数据
-    clean_expired_data(context)
-    
     query = update.callback_query
-    query.answer()
     
     # 获取选择的统计类型
     callback_data = query.data
@@ -417,69 +149,55 @@ def handle_stats_callback(update: Update, context: CallbackContext):
     
     stats_type = callback_data[len(STATS_CALLBACK_PREFIX):]
     
-    # 获取原始消息ID
-    original_message_id = query.message.reply_to_message.message_id if query.message.reply_to_message else None
+    # 按钮所在消息对应的统计范围
     current_chat_id = update.effective_chat.id
+    chat_id = get_stats_target(query.message)
     
-    # 如果找不到原始消息ID，则使用当前聊天ID
-    if original_message_id is None:
+    # 如果找不到存储的聊天ID，则使用当前聊天ID
+    if chat_id is None:
         chat_id = current_chat_id if current_chat_id < 0 else None
-    else:
-        # 从bot_data中获取存储的聊天ID
-        chat_id = context.bot_data.get(f'stats_chat_id_{original_message_id}')
-        
-        # 如果找不到存储的聊天ID，则使用当前聊天ID
-        if chat_id is None:
-            chat_id = current_chat_id if current_chat_id < 0 else None
-        # 如果存储的聊天ID与当前聊天ID不同，则使用当前聊天ID（防止串台）
-        elif chat_id != current_chat_id and current_chat_id < 0:
-            chat_id = current_chat_id
+    # 如果存储的聊天ID与当前聊天ID不同，则使用当前聊天ID（防止串台）
+    elif chat_id != current_chat_id and current_chat_id < 0:
+        chat_id = current_chat_id
     
-    # 获取统计数据
-    stats = get_statistics_data(chat_id)
-    
-    # 根据选择的类型生成相应的图表
-    if stats_type == "overview":
-        chart_buf = generate_overview_chart(stats)
-        if chat_id:
-            caption = f"📊 {'Group' if USE_ASCII_LABELS else '群组'} '{stats.get('chat_title', 'Current Group')}' {'Data Overview' if USE_ASCII_LABELS else '数据总览'}"
-        else:
-            caption = "📊 " + get_label('Telegram 机器人数据总览')
-    elif stats_type == "msg_types":
-        chart_buf = generate_message_types_chart(stats)
-        caption = "📊 " + get_label('消息类型分布')
-    elif stats_type == "top_users":
-        chart_buf = generate_top_users_chart(stats)
-        caption = "📊 " + get_label('最活跃的用户 (Top 10)')
-    elif stats_type == "top_chats":
-        # 如果是群组特定统计且没有群组数据，则显示提示
-        if chat_id and not stats['top_chats']:
-            query.edit_message_text("This statistic is only available in global statistics. Please use the /stats command in private chat to view statistics for all groups." if USE_ASCII_LABELS else "此统计类型仅在全局统计中可用。请在私聊中使用 /stats 命令查看所有群组的统计数据。")
-            return
-        chart_buf = generate_top_chats_chart(stats)
-        caption = "📊 " + get_label('最活跃的群组 (Top 10)')
-    elif stats_type == "time_patterns":
-        chart_buf = generate_time_patterns_chart(stats)
-        caption = "📊 " + get_label('消息时间模式分析')
-    elif stats_type == "msg_length":
-        chart_buf = generate_message_length_chart(stats)
-        caption = "📊 " + get_label('消息长度分布')
-    else:
-        query.edit_message_text("❌ " + ("Unknown statistic type" if USE_ASCII_LABELS else "未知的统计类型"))
+    if chat_id is None and not can_view_global_stats(update.effective_user.id):
+        query.answer(global_stats_denied_text(), show_alert=True)
+        return
+    if stats_type not in STATS_TYPES:
+        query.answer("❌ " + ("Unknown statistic type" if use_ascii_labels() else "未知的统计类型"), show_alert=True)
+        return
+    # 群组统计中没有群组活跃度数据
+    if stats_type == "top_chats" and chat_id:
+        query.answer("This statistic is only available in global statistics. Please use the /stats command in private chat to view statistics for all groups." if use_ascii_labels() else "此统计类型仅在全局统计中可用。请在私聊中使用 /stats 命令查看所有群组的统计数据。", show_alert=True)
         return
     
-    # 如果是群组特定统计，在标题中添加群组名称
-    if chat_id and stats_type != "overview" and 'chat_title' in stats:
-        caption = f"{caption} - {stats['chat_title']}"
+    # 数据没有变化时直接使用缓存的图表
+    try:
+        chart = chart_cache.get_chart(chat_id, stats_type, render_stats_chart)
+    except ChartQueueFull:
+        query.answer("⏳ " + ("Too many charts are being generated, please try again later" if use_ascii_labels() else "正在生成的图表较多，请稍后再试"), show_alert=True)
+        return
+    except Exception as e:
+        # 渲染进程异常退出 (BrokenProcessPool)、渲染超时或绘图出错
+        logging.error(f"生成统计图失败: {str(e)}", exc_info=True)
+        query.answer("❌ " + ("Failed to generate the chart, please try again later" if use_ascii_labels() else "生成图表失败，请稍后再试"), show_alert=True)
+        return
+    query.answer()
     
-    # 发送图表
+    # 发送图表, 已上传过的图片直接引用 file_id
     reply_message = query.message.reply_photo(
-        photo=chart_buf,
-        caption=caption,
+        photo=chart['file_id'] or io.BytesIO(chart['png']),
+        caption=chart['caption'],
         reply_markup=build_stats_keyboard()
     )
+    if reply_message and reply_message.photo and not chart['file_id']:
+        chart_cache.remember_file_id(chart, reply_message.photo[-1].file_id)
     
-    # 存储新消息的聊天ID关联
-    if reply_message and reply_message.message_id:
-        context.bot_data[f'stats_chat_id_{reply_message.message_id}'] = chat_id
-        context.bot_data[f'stats_timestamp_{reply_message.message_id}'] = time.time()  # 添加时间戳
\ No newline at end of file
+    # 记录新消息对应的统计范围
+    if reply_message:
+        remember_stats_target(reply_message, chat_id)
+
+# 导出handlers
+handler = CommandHandler('stats', handle_stats_command)
+# 图表渲染需要等待渲染进程, 不占用 dispatcher 线程
+callback_handler = CallbackQueryHandler(handle_stats_callback, pattern=f'^{STATS_CALLBACK_PREFIX}', run_async=True)
@@ -14,5 +14,6 @@ def set_bot_commands(context: CallbackContext):
         BotCommand('search', _('Search messages')),
         BotCommand('nlsearch', _('Natural language search')),
         BotCommand('setting', _('Settings & Statistics')),
+        BotCommand('stats', _('Statistics')),
     ]
     context.bot.set_my_commands(commands)
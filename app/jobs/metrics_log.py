@@ -0,0 +1,14 @@
+import os
+import logging
+from telegram.ext import CallbackContext
+from app.utils import metrics
+
+# 定期输出运行指标的间隔（秒）, 0 表示不输出
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', '300'))
+
+
+def log_metrics(context: CallbackContext):
+    """Log runtime metrics"""
+    stats = metrics.snapshot()
+    if stats:
+        logging.info("Metrics: " + ', '.join(f'{k}={v}' for k, v in sorted(stats.items())))
@@ -1 +1,2 @@
-from app.models.database import DBSession, Base, Message, User, UserAlias, Chat
+from app.models.database import engine, DBSession, Base, Message, User, UserAlias, Chat, Meta, ParsedQuery, \
+    StatsHourly, StatsUser, StatsType, StatsLength, PendingDeletion
@@ -1,9 +1,9 @@
 # coding: utf-8
 import os
-from sqlalchemy import Column, INTEGER, BIGINT, TEXT, BOOLEAN, DATETIME, TIMESTAMP, create_engine
+from sqlalchemy import Column, INTEGER, BIGINT, TEXT, BOOLEAN, DATE, DATETIME, TIMESTAMP, Index, create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import StaticPool, QueuePool
 
 # 获取数据库URL配置，默认使用SQLite
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./config/bot.db')
@@ -17,16 +17,41 @@ engine_kwargs = {
     'pool_recycle': 3600,  # 每小时回收连接
 }
 
+# SQLite 等待其他连接的写事务完成的最长时间 (秒)
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '30'))
+
 # SQLite特定配置
-if DATABASE_URL.startswith('sqlite'):
+SQLITE_MEMORY = DATABASE_URL.startswith('sqlite') and DATABASE_URL.rstrip('/') in ('sqlite:', 'sqlite:/:memory:', 'sqlite:///:memory:')
+if SQLITE_MEMORY:
+    # 内存数据库只存在于一个连接中
     engine_kwargs = {
         'echo': False,
         'connect_args': {'check_same_thread': False},
         'poolclass': StaticPool
     }
+elif DATABASE_URL.startswith('sqlite'):
+    # 写入队列、自动删除、统计图等后台线程都会访问数据库, 每个会话使用独立的连接:
+    # 共用一个连接时, 任一线程关闭会话都会回滚其他线程尚未提交的写入.
+    # WAL 模式下读取不阻塞写入, 写事务互相等待 (busy_timeout)
+    engine_kwargs = {
+        'echo': False,
+        'connect_args': {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT},
+        'poolclass': QueuePool,
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 60,
+    }
 
 engine = create_engine(DATABASE_URL, **engine_kwargs)
 
+
+if DATABASE_URL.startswith('sqlite') and not SQLITE_MEMORY:
+    @event.listens_for(engine, 'connect')
+    def _sqlite_on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+
 DBSession = sessionmaker(bind=engine)
 Base = declarative_base()
 
@@ -48,6 +73,9 @@ class Message(Base):
     from_id = Column(BIGINT, index=True)
     from_chat = Column(BIGINT, index=True)
 
+    # 按群组和时间倒序翻页 (keyset pagination)
+    __table_args__ = (Index('ix_message_chat_date', 'from_chat', 'date', '_id'),)
+
 
 class User(Base):
     __tablename__ = 'user'
@@ -75,4 +103,70 @@ class Chat(Base):
     enable = Column(BOOLEAN, index=True)
 
 
-Base.metadata.create_all(engine) 
\ No newline at end of file
+class Meta(Base):
+    __tablename__ = 'meta'
+
+    key = Column(TEXT, primary_key=True)
+    value = Column(TEXT)
+
+
+# 统计汇总表, 由写入队列随消息一起更新 (app/models/stats_rollup.py)
+class StatsHourly(Base):
+    """每个群组每天每小时的消息数 (UTC)"""
+    __tablename__ = 'stats_hourly'
+
+    chat_id = Column(BIGINT, primary_key=True)
+    day = Column(DATE, primary_key=True)
+    hour = Column(INTEGER, primary_key=True)
+    count = Column(BIGINT, nullable=False, default=0)
+
+
+class StatsUser(Base):
+    """每个群组每个用户的消息数"""
+    __tablename__ = 'stats_user'
+
+    chat_id = Column(BIGINT, primary_key=True)
+    user_id = Column(BIGINT, primary_key=True)
+    count = Column(BIGINT, nullable=False, default=0)
+
+
+class StatsType(Base):
+    """每个群组各类型的消息数"""
+    __tablename__ = 'stats_type'
+
+    chat_id = Column(BIGINT, primary_key=True)
+    type = Column(TEXT, primary_key=True)
+    count = Column(BIGINT, nullable=False, default=0)
+
+
+class StatsLength(Base):
+    """每个群组消息长度分布"""
+    __tablename__ = 'stats_length'
+
+    chat_id = Column(BIGINT, primary_key=True)
+    bucket = Column(TEXT, primary_key=True)
+    count = Column(BIGINT, nullable=False, default=0)
+
+
+class ParsedQuery(Base):
+    """自然语言查询的解析结果缓存"""
+    __tablename__ = 'parsed_query'
+
+    key = Column(TEXT, primary_key=True)
+    value = Column(TEXT)
+    expires = Column(TIMESTAMP, index=True)
+
+
+class PendingDeletion(Base):
+    """等待自动删除的机器人消息, 重启后继续删除"""
+    __tablename__ = 'pending_deletion'
+
+    chat_id = Column(BIGINT, primary_key=True)
+    message_id = Column(BIGINT, primary_key=True)
+    due = Column(TIMESTAMP, index=True)
+
+
+Base.metadata.create_all(engine)
+# create_all 不会为已存在的表补建新增的索引
+for index in Message.__table__.indexes:
+    index.create(engine, checkfirst=True) 
\ No newline at end of file
@@ -0,0 +1,720 @@
+# coding: utf-8
+"""导入 Telegram Desktop 导出的群组聊天记录 (JSON)
+
+与机器人共用 app.models 的数据库引擎和表结构, 消息写入时同时建立全文索引并累加统计汇总表,
+导入完成后无需再执行 rebuild-index / backfill-stats.
+
+- 导出文件流式读取, 内存占用与文件大小无关;
+- 可以一次导入多个文件: 解析和转换在进程池中进行, 经有界队列交给少量写入线程 (各自一个连接) 按批提交;
+  写入线程或解析进程异常退出时中止导入, 未完成的文件记录错误, 重新运行从断点继续;
+- 每批提交后记录断点, 中断后重新运行从断点继续;
+- PostgreSQL (psycopg2) 使用 copy=True (命令行 --copy) 时: 每批 COPY 到临时表后一条 INSERT ... SELECT 写入,
+  用户同样经临时表一条 INSERT ... SELECT ... ON CONFLICT 写入;
+- 其他情况: 每批一条多行 INSERT, 用户用 INSERT ... ON CONFLICT DO NOTHING 写入;
+- SQLite 使用 WAL 模式并保留默认的同步写盘设置, 机器人运行时也可以导入, 机器人的写入在每批提交期间等待.
+"""
+import os
+import io
+import glob
+import json
+import time
+import logging
+import threading
+import multiprocessing
+from queue import Empty, Full
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from sqlalchemy import insert, text
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models.database import engine, DBSession, Message, User, Chat
+from app.models.search_index import index_messages
+from app.models import stats_rollup
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+# 解析进程数和写入线程数 (每个写入线程一个数据库连接)
+IMPORT_PROCESSES = int(os.getenv('IMPORT_PROCESSES', str(min(4, os.cpu_count() or 1))))
+IMPORT_WRITERS = int(os.getenv('IMPORT_WRITERS', '2'))
+# 解析与写入之间最多排队的批次数
+IMPORT_QUEUE_BATCHES = 8
+# 进度回调的间隔（秒）
+PROGRESS_INTERVAL = 0.5
+# 每次从文件读取的字符数
+READ_CHUNK_SIZE = 1 << 20
+# 最多记录多少条失败的消息
+MAX_FAILED_SHOWN = 100
+# 每次写入或查询的用户数
+USER_LOOKUP_SIZE = 500
+
+MESSAGE_COLUMNS = ['id', 'link', 'text', 'video', 'photo', 'audio', 'voice', 'type', 'category',
+                   'from_id', 'from_chat', 'date']
+
+
+class ExportError(Exception):
+    """导出文件无法导入"""
+
+
+class ExportReader:
+    """
+    流式读取 Telegram Desktop 导出的 JSON 文件
+
+    只解析顶层对象和 messages 数组的结构, 每条消息单独用 raw_decode 解码,
+    同一时间内存中只有当前读取的一段文本, 不会载入整个文件.
+    read_header() 返回 messages 之前的字段 (name / type / id), 之后迭代得到每条消息.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.header = None
+
+    def _fill(self):
+        """读取下一段文本, 丢弃已解析的部分"""
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """跳过空白, 返回下一个字符"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ExportError("JSON 文件不完整")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ExportError(f"JSON 格式错误: 位置 {self.f.tell()} 附近应为 '{char}'")
+        self.pos += 1
+
+    def _value(self):
+        """解码一个完整的值; 数字等可能在文本末尾被截断, 需要确认后面还有内容"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ExportError(f"JSON 格式错误: {str(e)}")
+            self._fill()
+
+    def read_header(self):
+        """读取到 messages 数组开头为止"""
+        if self.header is not None:
+            return self.header
+        self.header = {}
+        self._expect('{')
+        while True:
+            if self._peek() == '}':
+                raise ExportError("导出文件中没有 messages 字段")
+            key = self._value()
+            self._expect(':')
+            if key == 'messages':
+                self._expect('[')
+                return self.header
+            self.header[key] = self._value()
+            if self._peek() == ',':
+                self.pos += 1
+
+    def __iter__(self):
+        self.read_header()
+        if self._peek() == ']':
+            return
+        while True:
+            yield self._value()
+            if self._peek() == ',':
+                self.pos += 1
+            else:
+                self._expect(']')
+                return
+
+
+def strip_user_id(id_):
+    """处理用户ID格式"""
+    id_str = str(id_)
+    if id_str.startswith('user'):
+        return int(id_str[4:])
+    return int(id_str)
+
+
+def message_text(message):
+    """处理消息文本"""
+    if isinstance(message.get('text'), list):
+        msg_text = ''.join([
+            obj['text'] if isinstance(obj, dict) else obj
+            for obj in message['text']
+        ])
+    else:
+        msg_text = message.get('text', '')
+    return msg_text or '[other msg]'
+
+
+def message_date(message):
+    """与机器人写入的时间一致, 使用 UTC; 旧版导出文件没有 date_unixtime, 只能使用导出时的本地时间"""
+    if 'date_unixtime' in message:
+        return datetime.fromtimestamp(int(message['date_unixtime']), timezone.utc).replace(tzinfo=None)
+    return datetime.strptime(message['date'], '%Y-%m-%dT%H:%M:%S')
+
+
+def convert_message(message, chat_id):
+    """转换为 (Message 字段字典, (用户 ID, 全名, 用户名))"""
+    from_id = strip_user_id(message['from_id'])
+    link_chat_id = str(chat_id)[4:]
+    row = dict(id=message['id'], link=f'https://t.me/c/{link_chat_id}/{message["id"]}', text=message_text(message),
+               video='', photo='', audio='', voice='', type='text', category='',
+               from_id=from_id, from_chat=chat_id, date=message_date(message))
+    return row, (from_id, message.get('from', ''), message.get('from', ''))
+
+
+def parse_chat_id(group_id):
+    return int(group_id) if str(group_id).startswith('-100') else int(f'-100{group_id}')
+
+
+class Checkpoint:
+    """
+    记录已导入的最后一条消息 ID, 中断后重新运行时跳过之前的消息
+
+    只有某批次之前的批次全部完成后才推进记录.
+    """
+
+    def __init__(self, path, chat_id):
+        self.path = path
+        self.chat_id = chat_id
+        self.lock = threading.Lock()
+        self.last_id = None
+        self.pending = {}  # 批次序号 -> 该批次最后一条消息 ID
+        self.next_seq = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('chat_id') == chat_id:
+                self.last_id = saved.get('last_id')
+
+    def done(self, seq, last_id):
+        """批次写入完成; 写入失败的批次 last_id 为 None, 记录停在它之前, 重新运行时会再次导入"""
+        with self.lock:
+            self.pending[seq] = last_id
+            advanced = False
+            while self.pending.get(self.next_seq) is not None:
+                self.last_id = self.pending.pop(self.next_seq)
+                self.next_seq += 1
+                advanced = True
+            if advanced:
+                with open(self.path, 'w') as f:
+                    json.dump({'chat_id': self.chat_id, 'last_id': self.last_id}, f)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportStats:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.chat_id = None
+        self.title = None
+        self.inserted = 0
+        self.existing = 0
+        self.skipped = 0
+        self.fail = 0
+        self.users = 0
+        self.failed = []
+        self.progress = 0.0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, inserted=0, existing=0, fail=0, failed=()):
+        with self.lock:
+            self.inserted += inserted
+            self.existing += existing
+            self.fail += fail
+            for message in failed:
+                if len(self.failed) < MAX_FAILED_SHOWN:
+                    self.failed.append(message)
+
+    @property
+    def processed(self):
+        return self.inserted + self.existing
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def rate(self):
+        """每秒处理的消息数"""
+        elapsed = self.elapsed()
+        return self.processed / elapsed if elapsed > 0 else 0
+
+
+def copy_text(rows):
+    """转换为 COPY 的文本格式: 制表符分隔, 转义反斜杠、制表符和换行"""
+    buf = io.StringIO()
+    for row in rows:
+        fields = []
+        for value in row:
+            if value is None:
+                fields.append('\\N')
+            else:
+                fields.append(str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                              .replace('\n', '\\n').replace('\r', '\\r'))
+        buf.write('\t'.join(fields))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+class BatchWriter:
+    """通用写入: 过滤已存在的消息后一条多行 INSERT, 同一事务内建立索引并累加汇总表"""
+
+    def open(self):
+        return DBSession()
+
+    def write(self, session, chat_id, messages):
+        """写入一批消息并提交, 返回新写入的条数; 已导入过的消息 (同一群组内 ID 相同) 跳过"""
+        try:
+            ids = [m['id'] for m in messages]
+            existing = {row[0] for row in session.query(Message.id).filter(
+                Message.from_chat == chat_id, Message.id.between(min(ids), max(ids)))}
+            messages = [m for m in messages if m['id'] not in existing]
+            if messages:
+                inserted = session.execute(insert(Message).returning(Message._id, Message.text), messages)
+                index_messages(session, inserted.all())
+                stats_rollup.add_messages(session, messages)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return len(messages)
+
+
+class SqliteBatchWriter(BatchWriter):
+    """SQLite: 加大页缓存 (连接级设置, 只影响导入进程的连接); 同步写盘保持默认, 机器人可能同时在写入"""
+
+    def open(self):
+        session = DBSession()
+        session.execute(text('PRAGMA cache_size = -262144'))  # 256MB
+        session.commit()
+        return session
+
+
+class PgCopyWriter(BatchWriter):
+    """PostgreSQL: COPY FROM STDIN 写入临时表, 再用一条 INSERT ... SELECT 跳过已存在的消息"""
+
+    def write(self, session, chat_id, messages):
+        columns = ', '.join(MESSAGE_COLUMNS)
+        try:
+            with session.connection().connection.cursor() as cur:
+                cur.execute(f"CREATE TEMP TABLE import_staging ON COMMIT DROP AS "
+                            f"SELECT {columns} FROM message WITH NO DATA")
+                cur.copy_expert(f"COPY import_staging ({columns}) FROM STDIN",
+                                copy_text([[m[c] for c in MESSAGE_COLUMNS] for m in messages]))
+            inserted = session.execute(text(f"""
+            INSERT INTO message ({columns})
+            SELECT {', '.join('s.' + c for c in MESSAGE_COLUMNS)} FROM import_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM message m WHERE m.from_chat = s.from_chat AND m.id = s.id)
+            RETURNING _id, text, from_id, date, type
+            """)).all()
+            index_messages(session, [(_id, msg_text) for _id, msg_text, _, _, _ in inserted])
+            stats_rollup.add_messages(session, [
+                dict(from_chat=chat_id, from_id=from_id, date=date, type=msg_type, text=msg_text)
+                for _, msg_text, from_id, date, msg_type in inserted])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return len(inserted)
+
+
+def use_copy(copy):
+    """COPY 只支持 PostgreSQL 的 psycopg2 驱动"""
+    return copy and engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg2'
+
+
+def create_writer(copy=False):
+    if engine.dialect.name == 'sqlite':
+        return SqliteBatchWriter()
+    if use_copy(copy):
+        return PgCopyWriter()
+    return BatchWriter()
+
+
+def ensure_chat(chat_id, title):
+    """插入群组信息, 新群组默认未启用"""
+    session = DBSession()
+    try:
+        if session.get(Chat, chat_id) is None:
+            session.add(Chat(id=chat_id, title=title, enable=False))
+            session.commit()
+    finally:
+        session.close()
+
+
+def _copy_users(session, rows):
+    """COPY 到临时表后一条 INSERT ... SELECT 写入, 返回新增的用户数"""
+    with session.connection().connection.cursor() as cur:
+        cur.execute('CREATE TEMP TABLE import_users ON COMMIT DROP AS '
+                    'SELECT id, fullname, username FROM "user" WITH NO DATA')
+        cur.copy_expert('COPY import_users (id, fullname, username) FROM STDIN',
+                        copy_text([[row['id'], row['fullname'], row['username']] for row in rows]))
+    return len(session.execute(text(
+        'INSERT INTO "user" (id, fullname, username) SELECT id, fullname, username FROM import_users '
+        'ON CONFLICT (id) DO NOTHING RETURNING id')).all())
+
+
+def add_users(users, copy=False):
+    """写入此前未出现过的用户, 已存在的用户 (包括导入期间机器人写入的) 保留机器人记录的信息; 返回新增的用户数"""
+    rows = [dict(id=user_id, fullname=fullname, username=username) for user_id, fullname, username in users.values()]
+    if use_copy(copy):
+        session = DBSession()
+        try:
+            added = _copy_users(session, rows) if rows else 0
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return added
+    if engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(User)
+    elif engine.dialect.name == 'sqlite':
+        statement = sqlite.insert(User)
+    else:
+        statement = None
+    added = 0
+    session = DBSession()
+    try:
+        for i in range(0, len(rows), USER_LOOKUP_SIZE):
+            chunk = rows[i:i + USER_LOOKUP_SIZE]
+            if statement is not None:
+                # 机器人可能同时写入同一个用户, 冲突的行直接跳过; RETURNING 只返回实际写入的行
+                added += len(session.execute(
+                    statement.on_conflict_do_nothing(index_elements=['id']).returning(User.id), chunk).all())
+                continue
+            # 其他数据库先查询已存在的用户
+            existing = {row[0] for row in session.query(User.id).filter(User.id.in_([u['id'] for u in chunk]))}
+            new_users = [user for user in chunk if user['id'] not in existing]
+            if new_users:
+                session.execute(insert(User), new_users)
+                added += len(new_users)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return added
+
+
+def read_export_header(file_path):
+    """读取导出文件开头的群组信息, 返回 (群组 ID, 群组名称)"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        header = ExportReader(f).read_header()
+    # 只支持超级群组
+    if 'type' not in header:
+        raise ExportError("只支持导入超级群组的历史记录")
+    if not header.get('name') or not header.get('id'):
+        raise ExportError("无法获取群组信息")
+    return parse_chat_id(header['id']), header['name']
+
+
+def expand_paths(paths):
+    """展开目录和通配符, 目录下递归查找 *.json; 返回去重后的文件列表"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matched = sorted(glob.glob(os.path.join(path, '**', '*.json'), recursive=True))
+        elif glob.has_magic(path):
+            matched = sorted(glob.glob(path, recursive=True))
+        else:
+            matched = [path]
+        files.extend(file_path for file_path in matched if file_path not in files)
+    return files
+
+
+_batch_queue = None
+_parse_stop = None
+
+
+def _init_parser(batch_queue, parse_stop):
+    global _batch_queue, _parse_stop
+    _batch_queue = batch_queue
+    _parse_stop = parse_stop
+
+
+def _put_batch(item):
+    """队列已满时等待写入线程跟上; 导入中止时返回 False"""
+    while not _parse_stop.is_set():
+        try:
+            _batch_queue.put(item, timeout=PROGRESS_INTERVAL)
+            return True
+        except Full:
+            continue
+    # 主进程不再读取队列, 进程退出时不等待缓冲区中的批次
+    _batch_queue.cancel_join_thread()
+    return False
+
+
+def _parse_file(index, file_path, chat_id, resume_id, batch_size):
+    """
+    解析进程: 读取并转换消息, 每批连同读取进度放入队列, 由主进程的写入线程写入
+
+    返回批次数、文件内的用户 (按 ID 去重) 以及跳过和转换失败的计数
+    """
+    result = {'batches': 0, 'users': {}, 'skipped': 0, 'fail': 0, 'failed': [], 'error': None}
+    file_size = os.path.getsize(file_path)
+    messages, last_id = [], None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for message in ExportReader(f):
+                # 只导入用户发送的消息
+                if 'from_id' not in message or 'user' not in str(message['from_id']):
+                    continue
+                if resume_id is not None and message['id'] <= resume_id:
+                    result['skipped'] += 1
+                    # 上次中止时这些消息的用户可能还没有写入
+                    try:
+                        user_id = strip_user_id(message['from_id'])
+                    except ValueError:
+                        continue
+                    result['users'][user_id] = (user_id, message.get('from', ''), message.get('from', ''))
+                    continue
+                try:
+                    row, user = convert_message(message, chat_id)
+                except Exception as e:
+                    result['fail'] += 1
+                    if len(result['failed']) < MAX_FAILED_SHOWN:
+                        result['failed'].append(f"{message.get('id')}: {str(e)}")
+                    continue
+                messages.append(row)
+                result['users'][user[0]] = user
+                last_id = message['id']
+                if len(messages) >= batch_size:
+                    if not _put_batch((index, result['batches'], messages, last_id,
+                                       f.tell() / file_size if file_size else 1.0)):
+                        result['error'] = "导入已中止"
+                        return result
+                    result['batches'] += 1
+                    messages = []
+    except Exception as e:
+        result['error'] = str(e)
+    # 文件中途出错时, 已转换的消息仍然写入
+    if messages:
+        if not _put_batch((index, result['batches'], messages, last_id, 1.0)):
+            result['error'] = "导入已中止"
+            return result
+        result['batches'] += 1
+    return result
+
+
+class _FileImport:
+    """主进程中一个文件的导入状态"""
+
+    def __init__(self, file_path):
+        self.stats = ImportStats(file_path)
+        self.checkpoint = None
+        self.job = None
+        self.lock = threading.Lock()
+        self.batches_done = 0
+        self.writing = False
+
+    def begin(self):
+        """第一批开始写入时计时, 排队等待的时间不计入该文件的耗时"""
+        with self.lock:
+            if not self.writing:
+                self.writing = True
+                self.stats.started = time.time()
+
+    def batch_done(self, progress):
+        with self.lock:
+            self.batches_done += 1
+            self.stats.progress = max(self.stats.progress, progress)
+
+    def broken(self):
+        """解析进程异常退出 (例如因内存不足被杀死), 已放入队列的批次不完整"""
+        return self.job.done() and isinstance(self.job.exception(), BrokenProcessPool)
+
+    def parsed(self):
+        """解析完成且全部批次已写入时返回解析结果, 否则返回 None"""
+        if not self.job.done():
+            return None
+        try:
+            result = self.job.result()
+        except Exception as e:
+            result = {'batches': 0, 'users': {}, 'skipped': 0, 'fail': 0, 'failed': [], 'error': str(e)}
+        with self.lock:
+            return result if self.batches_done >= result['batches'] else None
+
+    def finish(self, result, copy=False):
+        stats = self.stats
+        stats.skipped = result['skipped']
+        stats.add(fail=result['fail'], failed=result['failed'])
+        stats.error = result['error']
+        try:
+            # 用户按文件去重后一次写入
+            stats.users = add_users(result['users'], copy)
+        except Exception as e:
+            stats.error = stats.error or f"写入用户失败: {str(e)}"
+        stats.progress = 1.0
+        stats.finished = time.time()
+        if stats.fail == 0 and stats.error is None:
+            self.checkpoint.remove()
+
+    def abort(self, reason):
+        """导入中止, 保留断点, 重新运行时从断点继续"""
+        self.stats.error = reason
+        self.stats.finished = time.time()
+
+
+def _write_batches(writer, batch_queue, imports, chat_locks, stop, errors):
+    """写入线程: 从队列取出批次写入数据库, stop 被设置后退出; 无法继续写入时记录到 errors 后退出"""
+    session = None
+    try:
+        session = writer.open()
+        while not stop.is_set():
+            try:
+                item = batch_queue.get(timeout=PROGRESS_INTERVAL)
+            except Empty:
+                continue
+            index, seq, messages, last_id, progress = item
+            file_import = imports[index]
+            stats = file_import.stats
+            file_import.begin()
+            try:
+                # 同一群组的批次依次写入, 避免重复检查和汇总表更新互相冲突
+                with chat_locks[stats.chat_id]:
+                    inserted = writer.write(session, stats.chat_id, messages)
+                stats.add(inserted=inserted, existing=len(messages) - inserted)
+            except Exception as e:
+                stats.add(fail=len(messages), failed=[f"{m['id']}: {str(e)}" for m in messages])
+                last_id = None
+            file_import.checkpoint.done(seq, last_id)
+            file_import.batch_done(progress)
+    except Exception as e:
+        # 无法连接数据库或无法写入断点文件, 由主线程中止导入
+        errors.append(f"写入线程出错: {str(e)}")
+    finally:
+        if session is not None:
+            session.close()
+
+
+def _import_failure(threads, errors, remaining):
+    """写入线程或解析进程异常退出时返回原因, 此时队列不会再被取空或部分批次永远不会到达"""
+    if errors:
+        return errors[0]
+    if not all(thread.is_alive() for thread in threads):
+        return "写入线程异常退出"
+    if any(file_import.broken() for file_import in remaining):
+        return "解析进程异常退出 (可能内存不足)"
+    return None
+
+
+def import_files(paths, on_progress=None, on_file_done=None, processes=IMPORT_PROCESSES,
+                 writers=IMPORT_WRITERS, batch_size=IMPORT_BATCH_SIZE, copy=False):
+    """
+    导入多个导出文件, 返回与 paths 顺序一致的 ImportStats 列表
+
+    消息的解析和转换在进程池中进行, 转换后的批次经有界队列交给少量写入线程, 每个写入线程使用一个数据库连接.
+    无法导入的文件 stats.error 为错误信息, 不影响其他文件; 写入线程或解析进程异常退出时,
+    尚未完成的文件全部以错误结束.
+
+    Args:
+        paths: 导出的 result.json 文件列表
+        on_progress: 定期调用 on_progress(全部文件的 ImportStats 列表)
+        on_file_done: 每个文件完成后调用 on_file_done(stats)
+        processes: 解析进程数
+        writers: 写入线程数, SQLite 固定为 1
+        batch_size: 每批写入的消息数
+        copy: PostgreSQL (psycopg2) 使用 COPY 写入消息和用户, 其他数据库忽略
+    """
+    imports = [_FileImport(file_path) for file_path in paths]
+    pending = []
+    for file_import in imports:
+        stats = file_import.stats
+        try:
+            stats.chat_id, stats.title = read_export_header(stats.path)
+            ensure_chat(stats.chat_id, stats.title)
+        except (OSError, ExportError) as e:
+            stats.error = str(e)
+            stats.finished = time.time()
+            if on_file_done:
+                on_file_done(stats)
+            continue
+        file_import.checkpoint = Checkpoint(f'{stats.path}.checkpoint', stats.chat_id)
+        pending.append(file_import)
+    if not pending:
+        return [file_import.stats for file_import in imports]
+
+    if engine.dialect.name == 'sqlite':
+        # SQLite 同一时间只允许一个写事务
+        writers = 1
+    chat_locks = {file_import.stats.chat_id: threading.Lock() for file_import in pending}
+    stop = threading.Event()
+    errors = []
+
+    # 先创建解析进程再启动写入线程, fork 时主进程中没有其他线程 (fork 模式下第一次提交任务时创建全部进程);
+    # 解析进程异常退出时 ProcessPoolExecutor 的任务以 BrokenProcessPool 结束, 不会一直等待
+    context = multiprocessing.get_context('fork')
+    batch_queue = context.Queue(maxsize=IMPORT_QUEUE_BATCHES)
+    parse_stop = context.Event()
+    executor = ProcessPoolExecutor(max(1, min(processes, len(pending))), mp_context=context,
+                                   initializer=_init_parser, initargs=(batch_queue, parse_stop))
+    for index, file_import in enumerate(pending):
+        file_import.job = executor.submit(_parse_file, index, file_import.stats.path, file_import.stats.chat_id,
+                                          file_import.checkpoint.last_id, batch_size)
+    threads = []
+    try:
+        threads = [threading.Thread(target=_write_batches, name=f'ImportWriter-{i}',
+                                    args=(create_writer(copy), batch_queue, pending, chat_locks, stop, errors),
+                                    daemon=True)
+                   for i in range(max(1, writers))]
+        for thread in threads:
+            thread.start()
+
+        remaining = list(pending)
+        while remaining:
+            reason = _import_failure(threads, errors, remaining)
+            if reason:
+                logging.error(f"导入中止: {reason}")
+                for file_import in remaining:
+                    file_import.abort(reason)
+                    if on_file_done:
+                        on_file_done(file_import.stats)
+                break
+            for file_import in list(remaining):
+                result = file_import.parsed()
+                if result is not None:
+                    file_import.finish(result, copy)
+                    remaining.remove(file_import)
+                    if on_file_done:
+                        on_file_done(file_import.stats)
+            if on_progress:
+                on_progress([file_import.stats for file_import in imports])
+            if remaining:
+                time.sleep(PROGRESS_INTERVAL)
+    finally:
+        # 中断或中止时已提交的批次保留, 断点记录到最后一个完成的批次;
+        # 解析进程不再等待队列, 丢弃尚未写入的批次后结束
+        parse_stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        # 所有文件完成时队列已经为空
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=60)
+    return [file_import.stats for file_import in imports]
+
@@ -0,0 +1,194 @@
+# coding: utf-8
+"""消息写入队列
+
+store_message 只把消息放进队列, 由后台线程按数量或时间凑成一批后写入:
+消息用一条多行 INSERT 写入并累加统计汇总表, 同一批内的用户、群组信息合并后各更新一次 (未变化的由 chat_cache 过滤),
+编辑消息排在同批插入之后执行, 保证先插入后修改.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from sqlalchemy import insert
+from app.models.database import DBSession, Message, User, Chat
+from app.models.search_index import index_messages, reindex_messages
+from app.models import stats_rollup
+from app.utils import metrics, chat_cache, result_cache
+
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_INTERVAL = float(os.getenv('INGEST_FLUSH_INTERVAL', '1'))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+
+_STOP = object()
+
+
+class IngestQueue:
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_INTERVAL,
+                 max_size=INGEST_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # 队列满时 put 会阻塞, 对上游形成背压
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        metrics.register_gauge('ingest.queue_depth', self._queue.qsize)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='IngestFlusher', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=30):
+        """停止后台线程, 返回前写完队列中剩余的消息"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            logging.warning(f"写入队列未能在 {timeout} 秒内清空, 剩余 {self._queue.qsize()} 条")
+
+    def put_message(self, message, user, chat):
+        """message 为 Message 字段字典, user 为 (id, fullname, username), chat 为 (id, title)"""
+        self.start()
+        self._queue.put(('message', message, user, chat))
+
+    def put_edit(self, from_chat, msg_id, msg_text):
+        self.start()
+        self._queue.put(('edit', from_chat, msg_id, msg_text))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._flush(batch)
+        # 停止信号之后仍可能有消息进入队列, 一并写完
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            messages, edits = self._write(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                # 整批失败时逐条重试, 避免一条坏数据拖累整批消息
+                logging.warning(f"批量写入 {len(batch)} 条消息失败, 改为逐条写入: {str(e)}")
+                for item in batch:
+                    self._flush([item])
+            else:
+                metrics.incr('ingest.failed')
+                logging.error(f"写入消息失败: {item_repr(batch[0])}, {str(e)}", exc_info=True)
+            return
+
+        metrics.incr('ingest.messages', messages)
+        metrics.incr('ingest.edits', edits)
+        metrics.observe('ingest.batch_size', len(batch))
+        metrics.observe('ingest.flush_seconds', time.monotonic() - started)
+
+    def _write(self, batch):
+        messages, edits, users, chats = [], [], {}, {}
+        for item in batch:
+            if item[0] == 'message':
+                _, message, user, chat = item
+                messages.append(message)
+                # 同一批内只保留每个用户、群组最后一次出现的信息, 与缓存一致的不再查询数据库
+                if chat_cache.user_changed(*user):
+                    users[user[0]] = user
+                if chat_cache.chat_title_changed(*chat):
+                    chats[chat[0]] = chat
+            else:
+                edits.append(item[1:])
+
+        session = DBSession()
+        try:
+            if messages:
+                inserted = session.execute(insert(Message).returning(Message._id, Message.text), messages)
+                index_messages(session, inserted.all())
+                stats_rollup.add_messages(session, messages)
+            if users:
+                self._merge_users(session, users)
+            if chats:
+                self._merge_chats(session, chats)
+            for from_chat, msg_id, msg_text in edits:
+                self._apply_edit(session, from_chat, msg_id, msg_text)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        for user in users.values():
+            chat_cache.remember_user(*user)
+        for chat in chats.values():
+            chat_cache.remember_chat_title(*chat)
+        # 提交后再使这些群组缓存的搜索结果失效
+        result_cache.bump_chat_versions(
+            [message['from_chat'] for message in messages] + [edit[0] for edit in edits])
+        return len(messages), len(edits)
+
+    @staticmethod
+    def _merge_users(session, users):
+        existing = {u.id: u for u in session.query(User).filter(User.id.in_(list(users))).all()}
+        for user_id, fullname, username in users.values():
+            target_user = existing.get(user_id)
+            if not target_user:
+                session.add(User(id=user_id, fullname=fullname, username=username))
+            elif target_user.fullname != fullname or target_user.username != username:
+                target_user.fullname = fullname
+                target_user.username = username
+
+    @staticmethod
+    def _merge_chats(session, chats):
+        for target_chat in session.query(Chat).filter(Chat.id.in_(list(chats))).all():
+            title = chats[target_chat.id][1]
+            if target_chat.title != title:
+                target_chat.title = title
+
+    @staticmethod
+    def _apply_edit(session, from_chat, msg_id, msg_text):
+        query = session.query(Message) \
+            .filter(Message.from_chat == from_chat) \
+            .filter(Message.id == msg_id)
+        edited = query.with_entities(Message._id, Message.text).all()
+        query.update({"text": msg_text}, synchronize_session=False)
+        reindex_messages(session, [(_id, msg_text) for _id, _ in edited])
+        stats_rollup.edit_message(session, from_chat, [old_text for _, old_text in edited], msg_text)
+
+
+def item_repr(item):
+    if item[0] == 'message':
+        return f"chat {item[1]['from_chat']} message {item[1]['id']}"
+    return f"chat {item[1]} edited message {item[2]}"
+
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""全文索引
+
+CJK 文本按相邻二字 (bigram) 切分, 拉丁文本按单词内相邻三个字符 (trigram) 切分, 根据 DATABASE_URL 选择后端:
+
+- SQLite: FTS5 虚拟表 ``message_fts``, rowid 与 ``message._id`` 对应, 写入时同步
+- PostgreSQL: ``pg_trgm`` GIN 索引, 由数据库自动维护, 直接加速 ``LIKE '%kw%'``
+- 其他数据库或索引尚未建立: 退回 ``LIKE`` 扫描
+
+索引只用来缩小候选集, 最终仍用 ``LIKE`` 复核, 结果与直接 ``LIKE`` 一致. 拉丁文本的关键词可能只是单词的一部分
+(如 ``ello`` 命中 ``hello``), 所以按三字符片段而不是整个单词匹配; 少于三个字符的拉丁关键词无法使用索引.
+"""
+import os
+import time
+import logging
+import re
+from sqlalchemy import and_, func, text
+from app.models.database import engine, DBSession, Message, Meta
+
+# auto / fts5 / trgm / like
+SEARCH_INDEX = os.getenv('SEARCH_INDEX', 'auto')
+
+META_KEY = 'search_index'
+# 词元格式变化后需要重建索引, 旧格式的索引不再视为就绪
+FTS_FORMAT = 'fts5:trigram'
+REBUILD_BATCH_SIZE = 5000
+# 索引未就绪时, 每隔多少秒重新读取一次状态 (rebuild-index 可能在另一个进程中完成)
+READY_RECHECK_INTERVAL = 60
+
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_PATTERN = re.compile(f'([{CJK_CHARS}]+)|([^\\W_{CJK_CHARS}]+)')
+
+
+def _trigrams(word):
+    # casefold 逐字转换, 关键词转换后仍是单词转换后的子串
+    word = word.casefold()
+    return [word[i:i + 3] for i in range(len(word) - 2)]
+
+
+def tokenize(msg_text):
+    """将消息文本切分为索引词元"""
+    tokens = []
+    if not msg_text:
+        return tokens
+    for cjk, word in TOKEN_PATTERN.findall(msg_text):
+        if cjk:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            # 末尾单字也写入索引, 保证每个字都是某个词元的开头, 单字关键词可以前缀匹配
+            tokens.append(cjk[-1])
+        else:
+            tokens.extend(_trigrams(word))
+    return tokens
+
+
+def build_match_terms(keyword):
+    """
+    将关键词转换为 FTS5 查询项, 返回空列表表示该关键词无法使用索引
+
+    CJK 连续文字一定出现在消息的同一段 CJK 文字中, 相邻二字都是索引中的词元, 单字是某个词元的开头;
+    连续的拉丁文本一定是消息中某个单词的一部分, 它的每个三字符片段都是索引中的词元, 不足三个字符时不生成查询项
+    """
+    terms = []
+    for cjk, word in TOKEN_PATTERN.findall(keyword):
+        if len(cjk) > 1:
+            terms.extend(f'"{cjk[i:i + 2]}"' for i in range(len(cjk) - 1))
+        elif cjk:
+            terms.append(f'"{cjk}"*')
+        else:
+            terms.extend(f'"{trigram}"' for trigram in _trigrams(word))
+    return list(dict.fromkeys(terms))
+
+
+def like_filter(keywords, ignore_case=False):
+    if ignore_case:
+        # PostgreSQL 为 ILIKE, pg_trgm 索引同样适用; SQLite 为 lower(text) LIKE lower(kw)
+        return and_(*[Message.text.ilike('%' + keyword + '%') for keyword in keywords])
+    return and_(*[Message.text.like('%' + keyword + '%') for keyword in keywords])
+
+
+def _read_meta(key):
+    session = DBSession()
+    try:
+        row = session.get(Meta, key)
+        return row.value if row else None
+    finally:
+        session.close()
+
+
+def _write_meta(key, value):
+    session = DBSession()
+    try:
+        session.merge(Meta(key=key, value=value))
+        session.commit()
+    finally:
+        session.close()
+
+
+class LikeBackend:
+    """不使用索引, 每次搜索都全表 LIKE 扫描"""
+    name = 'like'
+    # 记录在 Meta 中的索引格式
+    index_format = 'like'
+
+    def __init__(self):
+        self._ready = False
+        self._checked_at = 0
+
+    def init(self):
+        pass
+
+    def is_ready(self):
+        if not self._ready and time.time() - self._checked_at > READY_RECHECK_INTERVAL:
+            self._checked_at = time.time()
+            self._ready = _read_meta(META_KEY) == self.index_format
+        return self._ready
+
+    def mark_ready(self):
+        _write_meta(META_KEY, self.index_format)
+        self._ready = True
+
+    def keyword_filter(self, keywords, ignore_case=False):
+        return like_filter(keywords, ignore_case)
+
+    def index_messages(self, session, rows):
+        pass
+
+    def reindex_messages(self, session, rows):
+        pass
+
+    def remove_chat_messages(self, session, chat_id):
+        pass
+
+    def rebuild(self):
+        logging.info("当前数据库未启用全文索引, 无需重建")
+
+
+class SqliteFtsBackend(LikeBackend):
+    """SQLite FTS5, 存放预先切分好的词元"""
+    name = 'fts5'
+    index_format = FTS_FORMAT
+
+    def init(self):
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'")).first()
+            if exists:
+                if not self.is_ready() and _read_meta(META_KEY):
+                    logging.warning("全文索引的格式已更新, 重建前搜索使用 LIKE, 请执行 `python -m app rebuild-index`")
+                return
+            conn.execute(text("CREATE VIRTUAL TABLE message_fts USING fts5(tokens)"))
+            has_messages = conn.execute(text("SELECT 1 FROM message LIMIT 1")).first()
+        if has_messages:
+            logging.warning("已创建全文索引表, 历史消息尚未建立索引, 请执行 `python -m app rebuild-index`")
+        else:
+            self.mark_ready()
+
+    def keyword_filter(self, keywords, ignore_case=False):
+        if not self.is_ready():
+            return like_filter(keywords, ignore_case)
+        terms = [term for keyword in keywords for term in build_match_terms(keyword)]
+        if not terms:
+            return like_filter(keywords, ignore_case)
+        candidates = text("message._id IN (SELECT rowid FROM message_fts WHERE message_fts MATCH :fts_query)") \
+            .bindparams(fts_query=' '.join(terms))
+        return and_(candidates, like_filter(keywords, ignore_case))
+
+    def index_messages(self, session, rows):
+        params = [{'rowid': _id, 'tokens': ' '.join(tokenize(msg_text))} for _id, msg_text in rows if msg_text]
+        params = [p for p in params if p['tokens']]
+        if params:
+            session.execute(text("INSERT INTO message_fts (rowid, tokens) VALUES (:rowid, :tokens)"), params)
+
+    def reindex_messages(self, session, rows):
+        rows = list(rows)
+        for _id, _ in rows:
+            session.execute(text("DELETE FROM message_fts WHERE rowid = :rowid"), {'rowid': _id})
+        self.index_messages(session, rows)
+
+    def remove_chat_messages(self, session, chat_id):
+        session.execute(text(
+            "DELETE FROM message_fts WHERE rowid IN (SELECT _id FROM message WHERE from_chat = :chat_id)"),
+            {'chat_id': chat_id})
+
+    def rebuild(self):
+        """
+        重建全部消息的索引, 机器人运行时也可以执行
+
+        只重建开始时已有的消息, 之后写入的消息由机器人建立索引. 机器人在重建期间修改的消息已经重新建立了索引,
+        因此每批先删除该范围内的索引再读取消息, 删除后持有写锁, 读取到的文本在提交前不会再被修改
+        """
+        session = DBSession()
+        try:
+            session.execute(text("DELETE FROM message_fts"))
+            max_id = session.query(func.max(Message._id)).scalar() or 0
+            session.commit()
+            total = 0
+            for start in range(0, max_id, REBUILD_BATCH_SIZE):
+                end = min(start + REBUILD_BATCH_SIZE, max_id)
+                session.execute(text("DELETE FROM message_fts WHERE rowid > :start AND rowid <= :end"),
+                                {'start': start, 'end': end})
+                rows = session.query(Message._id, Message.text) \
+                    .filter(Message._id > start, Message._id <= end).all()
+                self.index_messages(session, rows)
+                session.commit()
+                total += len(rows)
+                logging.info(f"已索引 {total} 条消息")
+            session.execute(text("INSERT INTO message_fts (message_fts) VALUES ('optimize')"))
+            session.commit()
+        finally:
+            session.close()
+        self.mark_ready()
+
+
+class PgTrgmBackend(LikeBackend):
+    """PostgreSQL pg_trgm GIN 索引, 由数据库自动维护"""
+    name = 'trgm'
+    index_format = 'trgm'
+
+    def init(self):
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_message_text_trgm'")).first()
+            has_messages = conn.execute(text("SELECT 1 FROM message LIMIT 1")).first()
+        if exists:
+            self._ready = True
+        elif has_messages:
+            logging.warning("消息表尚未建立 pg_trgm 索引, 请执行 `python -m app rebuild-index`")
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            exists = conn.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_message_text_trgm'")).first()
+            if exists:
+                conn.execute(text("REINDEX INDEX ix_message_text_trgm"))
+            else:
+                conn.execute(text("CREATE INDEX ix_message_text_trgm ON message USING gin (text gin_trgm_ops)"))
+        self.mark_ready()
+
+
+BACKENDS = {
+    'like': LikeBackend,
+    'fts5': SqliteFtsBackend,
+    'trgm': PgTrgmBackend,
+}
+
+DIALECT_BACKENDS = {
+    'sqlite': 'fts5',
+    'postgresql': 'trgm',
+}
+
+
+def _create_backend():
+    name = SEARCH_INDEX
+    if name == 'auto':
+        name = DIALECT_BACKENDS.get(engine.dialect.name, 'like')
+    backend = BACKENDS.get(name, LikeBackend)()
+    try:
+        backend.init()
+    except Exception as e:
+        logging.warning(f"全文索引 {name} 初始化失败, 使用 LIKE 搜索: {str(e)}")
+        backend = LikeBackend()
+    logging.info(f"Search index backend: {backend.name}")
+    return backend
+
+
+_backend = _create_backend()
+
+
+def get_backend():
+    return _backend
+
+
+def keyword_filter(keywords, ignore_case=False):
+    """构建关键词过滤条件, 所有关键词都需要命中; ignore_case 时忽略大小写 (ILIKE)"""
+    return get_backend().keyword_filter(keywords, ignore_case)
+
+
+def index_messages(session, rows):
+    """为新消息建立索引, rows 为 (message._id, text) 列表, 随 session 一起提交"""
+    get_backend().index_messages(session, rows)
+
+
+def reindex_messages(session, rows):
+    """消息文本被修改后重建对应的索引"""
+    get_backend().reindex_messages(session, rows)
+
+
+def remove_chat_messages(session, chat_id):
+    """删除群组消息前调用, 清理对应的索引"""
+    get_backend().remove_chat_messages(session, chat_id)
+
+
+def rebuild_index():
+    get_backend().rebuild()
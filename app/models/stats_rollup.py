@@ -0,0 +1,258 @@
+# coding: utf-8
+"""统计汇总表
+
+消息写入时按群组累加: 每天每小时的消息数、每个用户的消息数、各类型消息数和长度分布,
+/stats 和 webapp 只需读取汇总表, 不再扫描整个消息表.
+
+已有消息的数据库需要执行一次 `python -m app backfill-stats`, 完成前统计仍使用实时查询.
+backfill-stats 会清空并重建汇总表, 期间机器人写入的消息会被重复计数, 必须先停止机器人.
+"""
+import time
+import logging
+from sqlalchemy import func, case
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models.database import engine, DBSession, Message, Meta, StatsHourly, StatsUser, StatsType, StatsLength
+
+META_KEY = 'stats_rollup'
+BACKFILL_BATCH_SIZE = 10000
+# 汇总表未就绪时, 每隔多少秒重新读取一次状态 (backfill-stats 可能在另一个进程中完成)
+READY_RECHECK_INTERVAL = 60
+
+# (最小长度, 最大长度, 标签)
+LENGTH_BUCKETS = [
+    (0, 10, '0-10'),
+    (11, 50, '11-50'),
+    (51, 100, '51-100'),
+    (101, 200, '101-200'),
+    (201, 500, '201-500'),
+    (501, None, '500+')
+]
+
+ROLLUP_TABLES = [StatsHourly, StatsUser, StatsType, StatsLength]
+
+_ready = False
+_checked_at = 0
+
+
+def length_bucket(length):
+    if length is None:
+        return None
+    for low, high, label in LENGTH_BUCKETS:
+        if high is None or length <= high:
+            return label
+
+
+def length_bucket_expression(length):
+    """与 length_bucket 相同的分段, 用于在数据库中一次分组统计"""
+    whens = [(length <= high, label) for _, high, label in LENGTH_BUCKETS if high is not None]
+    return case(*whens, else_=LENGTH_BUCKETS[-1][2])
+
+
+def is_ready():
+    global _ready, _checked_at
+    if not _ready and time.time() - _checked_at > READY_RECHECK_INTERVAL:
+        _checked_at = time.time()
+        session = DBSession()
+        try:
+            row = session.get(Meta, META_KEY)
+            _ready = row is not None and row.value == 'ready'
+        finally:
+            session.close()
+    return _ready
+
+
+def _mark_ready(session):
+    global _ready
+    session.merge(Meta(key=META_KEY, value='ready'))
+    _ready = True
+
+
+def _init():
+    """新数据库直接标记为就绪, 已有消息的数据库等待 backfill-stats"""
+    session = DBSession()
+    try:
+        if session.get(Meta, META_KEY):
+            return
+        if session.query(Message._id).first():
+            logging.warning("统计汇总表尚未建立, 请执行 `python -m app backfill-stats`")
+            return
+        _mark_ready(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _upsert(session, model, counts):
+    """counts 为 {主键元组: 增量}, 累加到汇总表"""
+    if not counts:
+        return
+    keys = [column.name for column in model.__table__.primary_key.columns]
+    rows = [dict(zip(keys, key), count=count) for key, count in counts.items()]
+    if engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(model)
+    elif engine.dialect.name == 'sqlite':
+        statement = sqlite.insert(model)
+    else:
+        # 其他数据库逐行合并
+        for row in rows:
+            existing = session.get(model, tuple(row[k] for k in keys))
+            if existing:
+                existing.count += row['count']
+            else:
+                session.add(model(**row))
+        return
+    statement = statement.on_conflict_do_update(
+        index_elements=keys, set_={'count': model.__table__.c.count + statement.excluded.count})
+    session.execute(statement, rows)
+
+
+def _add(counts, key, value=1):
+    counts[key] = counts.get(key, 0) + value
+
+
+def _collect(rows):
+    """rows 为 (from_chat, from_id, date, type, 文本长度), 汇总为各表的增量"""
+    hourly, users, types, lengths = {}, {}, {}, {}
+    for chat_id, user_id, date, msg_type, length in rows:
+        if date is not None:
+            _add(hourly, (chat_id, date.date(), date.hour))
+        _add(users, (chat_id, user_id))
+        _add(types, (chat_id, msg_type or 'unknown'))
+        bucket = length_bucket(length)
+        if bucket:
+            _add(lengths, (chat_id, bucket))
+    return hourly, users, types, lengths
+
+
+def _apply(session, collected):
+    for model, counts in zip(ROLLUP_TABLES, collected):
+        _upsert(session, model, counts)
+
+
+def add_messages(session, messages):
+    """新消息写入时调用, messages 为 Message 字段字典列表, 随 session 一起提交"""
+    rows = [(m['from_chat'], m['from_id'], m['date'], m['type'], len(m['text']) if m['text'] is not None else None)
+            for m in messages]
+    _apply(session, _collect(rows))
+
+
+def edit_message(session, chat_id, old_texts, new_text):
+    """消息被编辑后调整长度分布"""
+    lengths = {}
+    for old_text in old_texts:
+        old_bucket = length_bucket(len(old_text) if old_text is not None else None)
+        if old_bucket:
+            _add(lengths, (chat_id, old_bucket), -1)
+        new_bucket = length_bucket(len(new_text) if new_text is not None else None)
+        if new_bucket:
+            _add(lengths, (chat_id, new_bucket))
+    _upsert(session, StatsLength, {key: value for key, value in lengths.items() if value})
+
+
+def remove_chat(session, chat_id):
+    """删除群组消息时调用, 清除该群组的汇总数据"""
+    for model in ROLLUP_TABLES:
+        session.query(model).filter(model.chat_id == chat_id).delete(synchronize_session=False)
+
+
+def backfill():
+    """根据消息表重新生成全部汇总数据; 运行期间不能有其他进程写入消息 (机器人需要先停止)"""
+    session = DBSession()
+    try:
+        for model in ROLLUP_TABLES:
+            session.query(model).delete(synchronize_session=False)
+        last_id, total = 0, 0
+        while True:
+            rows = session.query(Message._id, Message.from_chat, Message.from_id, Message.date, Message.type,
+                                 func.length(Message.text)) \
+                .filter(Message._id > last_id) \
+                .order_by(Message._id) \
+                .limit(BACKFILL_BATCH_SIZE).all()
+            if not rows:
+                break
+            _apply(session, _collect(row[1:] for row in rows))
+            last_id = rows[-1][0]
+            total += len(rows)
+            logging.info(f"已汇总 {total} 条消息")
+        _mark_ready(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _chat_filter(query, model, chat_id):
+    return query.filter(model.chat_id == chat_id) if chat_id else query
+
+
+def total_count(session, chat_id=None):
+    query = session.query(func.sum(StatsType.count))
+    return int(_chat_filter(query, StatsType, chat_id).scalar() or 0)
+
+
+def type_counts(session, chat_id=None):
+    query = session.query(StatsType.type, func.sum(StatsType.count)).group_by(StatsType.type)
+    return {t: int(c) for t, c in _chat_filter(query, StatsType, chat_id) if c}
+
+
+def top_users(session, chat_id=None, limit=10):
+    total = func.sum(StatsUser.count)
+    query = _chat_filter(session.query(StatsUser.user_id, total), StatsUser, chat_id)
+    query = query.group_by(StatsUser.user_id).order_by(total.desc()).limit(limit)
+    return [(user_id, int(count)) for user_id, count in query]
+
+
+def top_chats(session, limit=10):
+    total = func.sum(StatsType.count)
+    query = session.query(StatsType.chat_id, total).group_by(StatsType.chat_id).order_by(total.desc()).limit(limit)
+    return [(chat_id, int(count)) for chat_id, count in query]
+
+
+def user_count(session, chat_id):
+    return session.query(func.count(StatsUser.user_id)) \
+        .filter(StatsUser.chat_id == chat_id, StatsUser.count > 0).scalar() or 0
+
+
+def hour_distribution(session, chat_id=None):
+    query = session.query(StatsHourly.hour, func.sum(StatsHourly.count)).group_by(StatsHourly.hour)
+    return {int(h): int(c) for h, c in _chat_filter(query, StatsHourly, chat_id)}
+
+
+def daily_counts(session, chat_id=None):
+    """{日期: 消息数}, 星期和月份分布由此计算"""
+    query = session.query(StatsHourly.day, func.sum(StatsHourly.count)).group_by(StatsHourly.day)
+    return {day: int(c) for day, c in _chat_filter(query, StatsHourly, chat_id)}
+
+
+def weekday_distribution(daily):
+    """与 extract('dow') 一致, 0 表示星期日"""
+    result = {}
+    for day, count in daily.items():
+        _add(result, (day.weekday() + 1) % 7, count)
+    return dict(sorted(result.items()))
+
+
+def month_distribution(daily):
+    result = {}
+    for day, count in daily.items():
+        _add(result, day.month, count)
+    return dict(sorted(result.items()))
+
+
+def length_histogram(session, chat_id=None):
+    query = session.query(StatsLength.bucket, func.sum(StatsLength.count)).group_by(StatsLength.bucket)
+    counts = {b: int(c) for b, c in _chat_filter(query, StatsLength, chat_id)}
+    return {label: counts.get(label, 0) for _, _, label in LENGTH_BUCKETS}
+
+
+def count_since(session, since, chat_id=None):
+    """since (UTC) 之后的消息数, 精确到小时"""
+    day = since.date()
+    query = session.query(func.sum(StatsHourly.count)).filter(
+        (StatsHourly.day > day) | ((StatsHourly.day == day) & (StatsHourly.hour >= since.hour)))
+    return int(_chat_filter(query, StatsHourly, chat_id).scalar() or 0)
+
+
+_init()
@@ -1,6 +1,6 @@
 from app.utils.utils import (
-    get_text_func, _, delay_delete, auto_delete, build_menu, len_non_ascii,
-    get_bot_user_name, get_bot_id, read_config, check_control_permission,
+    get_text_func, _, schedule_delete, auto_delete, build_menu, len_non_ascii,
+    get_bot_user_name, get_bot_id, read_config, check_control_permission, is_bot_admin,
     load_chat_members, write_chat_members, get_filter_chats, is_userbot_mode,
     update_userbot_admin_id, read_userbot_admin_id, get_statistics_data
 )
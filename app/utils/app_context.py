@@ -0,0 +1,35 @@
+import logging
+import threading
+
+
+class AppContext:
+    """进程内共享的运行时信息
+
+    机器人自身的账号信息在启动时通过 get_me() 取得一次, 之后所有 handler 直接读取,
+    只有调用 refresh_bot_identity 时才会重新请求.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bot_user = None
+
+    def load_bot_identity(self, bot):
+        """启动时调用, 已经加载过则直接返回"""
+        with self._lock:
+            if self._bot_user is None:
+                self._bot_user = bot.get_me()
+                logging.info(f"Bot identity: @{self._bot_user.username} ({self._bot_user.id})")
+            return self._bot_user
+
+    def refresh_bot_identity(self, bot):
+        """重新请求 get_me(), 例如机器人用户名被修改后"""
+        with self._lock:
+            self._bot_user = None
+        return self.load_bot_identity(bot)
+
+    def bot_user(self, bot):
+        bot_user = self._bot_user
+        return bot_user if bot_user is not None else self.load_bot_identity(bot)
+
+
+app_context = AppContext()
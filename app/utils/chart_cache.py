@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from app.utils import metrics, result_cache
+
+# 统计图缓存时间（秒）; 数据变化后先返回旧图, 同时在后台重新生成
+CHART_CACHE_TTL = int(os.getenv('CHART_CACHE_TTL', '3600'))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '200'))
+# 同一张图两次后台重新生成的最小间隔（秒）, 避免活跃群组每条消息都触发渲染
+CHART_REFRESH_INTERVAL = int(os.getenv('CHART_REFRESH_INTERVAL', '60'))
+
+_lock = threading.Lock()
+# (chat_id, 统计类型) -> {'version', 'png', 'caption', 'file_id', 'rendered_at'}
+_charts = TTLCache(maxsize=CHART_CACHE_SIZE, ttl=CHART_CACHE_TTL)
+_pending = set()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ChartRefresh')
+
+metrics.register_gauge('stats.chart_cache.size', lambda: len(_charts))
+
+
+def get_chart(chat_id, stats_type, render):
+    """
+    取出统计图, 没有缓存时调用 render 生成
+
+    Args:
+        render: render(chat_id, stats_type) -> (PNG 字节, 标题)
+
+    Returns:
+        dict: 缓存项, 已上传过的图片带有 Telegram 返回的 file_id
+    """
+    key = (chat_id, stats_type)
+    version = result_cache.data_version(chat_id)
+    with _lock:
+        entry = _charts.get(key)
+    if entry is not None:
+        if entry['version'] == version:
+            metrics.incr('stats.chart_cache.hit')
+        else:
+            metrics.incr('stats.chart_cache.stale')
+            _schedule_refresh(key, entry, render)
+        return entry
+
+    metrics.incr('stats.chart_cache.miss')
+    return _render(key, version, render)
+
+
+def _render(key, version, render):
+    png, caption = render(*key)
+    entry = {'version': version, 'png': png, 'caption': caption, 'file_id': None, 'rendered_at': time.time()}
+    with _lock:
+        current = _charts.get(key)
+        # 渲染期间可能已有更新的结果
+        if current is None or current['version'] <= version:
+            _charts[key] = entry
+    return entry
+
+
+def _schedule_refresh(key, entry, render):
+    with _lock:
+        if key in _pending or time.time() - entry['rendered_at'] < CHART_REFRESH_INTERVAL:
+            return
+        _pending.add(key)
+    _executor.submit(_refresh, key, render)
+
+
+def _refresh(key, render):
+    try:
+        _render(key, result_cache.data_version(key[0]), render)
+        metrics.incr('stats.chart_cache.refreshed')
+    except Exception as e:
+        logging.error(f"后台生成统计图失败 {key}: {str(e)}")
+    finally:
+        with _lock:
+            _pending.discard(key)
+
+
+def remember_file_id(entry, file_id):
+    """图片发送后记录 file_id, 之后直接引用, 不再重复上传"""
+    with _lock:
+        entry['file_id'] = file_id
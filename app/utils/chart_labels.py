@@ -0,0 +1,112 @@
+# coding: utf-8
+"""统计图的字体和标签
+
+不导入 matplotlib: 可用的中文字体只在第一次需要时查找一次, 结果保存在 FONT_CACHE_FILE 中,
+之后启动直接读取. 安装或删除字体后删除该文件即可重新查找.
+"""
+import os
+import json
+import logging
+import threading
+
+# 按顺序尝试的中文字体
+FONT_LIST = ['SimHei', 'Microsoft YaHei', 'WenQuanYi Micro Hei', 'PingFang SC', 'Heiti SC', 'Source Han Sans CN', 'Noto Sans CJK SC', 'Noto Sans SC', 'DejaVu Sans']
+FONT_CACHE_FILE = os.getenv('CHART_FONT_CACHE', './config/.chart_font.json')
+
+_lock = threading.Lock()
+_resolved = False
+_font = None
+
+
+def _read_font_cache():
+    """返回缓存的字体名称 (可能为 None), 缓存不存在或字体文件已不存在时返回 False"""
+    try:
+        with open(FONT_CACHE_FILE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if cached.get('font') and not os.path.exists(cached.get('path') or ''):
+        return False
+    return cached.get('font')
+
+
+def _find_font():
+    import matplotlib.font_manager as fm
+    system_fonts = {f.name: f.fname for f in fm.fontManager.ttflist}
+    logging.debug(f"系统可用字体: {sorted(system_fonts)}")
+    for font in FONT_LIST:
+        if font in system_fonts:
+            logging.info(f"找到可用字体: {font}")
+            return font, system_fonts[font]
+    logging.warning("未找到可用的中文字体，将使用ASCII标签")
+    return None, None
+
+
+def resolve_font():
+    """返回可用的中文字体名称, 没有时返回 None"""
+    global _resolved, _font
+    with _lock:
+        if _resolved:
+            return _font
+        font = _read_font_cache()
+        if font is False:
+            try:
+                font, path = _find_font()
+            except Exception as e:
+                logging.warning(f"查找字体时出错: {str(e)}")
+                font, path = None, None
+            try:
+                # 多个渲染进程可能同时写入, 先写临时文件再替换
+                temp_file = f'{FONT_CACHE_FILE}.{os.getpid()}'
+                with open(temp_file, 'w') as f:
+                    json.dump({'font': font, 'path': path}, f)
+                os.replace(temp_file, FONT_CACHE_FILE)
+            except OSError as e:
+                logging.warning(f"保存字体缓存失败: {str(e)}")
+        _font, _resolved = font, True
+        return _font
+
+
+def use_ascii_labels():
+    """没有中文字体时使用英文标签"""
+    return resolve_font() is None
+
+
+# 中英文标签映射
+LABEL_MAP = {
+    '总消息数': 'Total Messages',
+    '总用户数': 'Total Users',
+    '总群组数': 'Total Groups',
+    '最近7天消息': 'Last 7 Days',
+    '周一': 'Mon',
+    '周二': 'Tue',
+    '周三': 'Wed',
+    '周四': 'Thu',
+    '周五': 'Fri',
+    '周六': 'Sat',
+    '周日': 'Sun',
+    '按小时分布': 'Hourly Distribution',
+    '按星期分布': 'Weekly Distribution',
+    '小时 (24小时制)': 'Hour (24h)',
+    '星期': 'Weekday',
+    '消息数量': 'Message Count',
+    '字符数范围': 'Character Range',
+    '消息类型分布': 'Message Type Distribution',
+    '最活跃的用户 (Top 10)': 'Most Active Users (Top 10)',
+    '最活跃的群组 (Top 10)': 'Most Active Groups (Top 10)',
+    '消息时间模式分析': 'Message Time Pattern Analysis',
+    '消息长度分布': 'Message Length Distribution',
+    'Telegram 机器人数据总览': 'Telegram Bot Data Overview',
+    '总览': 'Overview',
+    '消息类型': 'Message Types',
+    '活跃用户': 'Active Users',
+    '活跃群组': 'Active Groups',
+    '时间模式': 'Time Patterns',
+    '消息长度': 'Message Length',
+}
+
+def get_label(text):
+    """根据当前设置返回适当的标签文本"""
+    if use_ascii_labels():
+        return LABEL_MAP.get(text, text)
+    return text
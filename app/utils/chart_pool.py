@@ -0,0 +1,108 @@
+# coding: utf-8
+"""统计图渲染进程池
+
+matplotlib 绘图是纯 CPU 计算, 在 dispatcher 线程中执行会占用 GIL, 拖慢消息写入.
+这里把绘图交给独立的渲染进程: 传入统计数据字典, 返回 PNG 字节.
+
+- 进程通过 fork 创建, 需要在启动其他线程之前调用 start(); 渲染进程启动后在后台加载 matplotlib 和字体,
+  主进程不导入 matplotlib;
+- 渲染进程异常退出后, 主进程中已经有其他线程, 不能再 fork, 进程池改用 forkserver (不支持时用 spawn) 重建;
+- 同时排队的渲染任务数量有上限, 超过上限时等待一段时间后抛出 ChartQueueFull;
+- CHART_WORKERS=0 时在当前线程中渲染.
+"""
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.utils import metrics
+
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+# 正在渲染和排队的任务上限, 以及队列满时最多等待多少秒
+CHART_QUEUE_SIZE = int(os.getenv('CHART_QUEUE_SIZE', '8'))
+CHART_QUEUE_WAIT = float(os.getenv('CHART_QUEUE_WAIT', '5'))
+CHART_RENDER_TIMEOUT = float(os.getenv('CHART_RENDER_TIMEOUT', '30'))
+# 重建进程池时使用的启动方式
+REBUILD_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _warm_up():
+    """渲染进程的初始化函数, matplotlib 只在渲染进程中导入"""
+    from app.utils import charts
+    charts.warm_up()
+
+
+def _render_chart(stats_type, stats):
+    from app.utils import charts
+    return charts.render_chart(stats_type, stats)
+
+
+class ChartQueueFull(Exception):
+    """渲染队列已满"""
+
+
+class ChartPool:
+    def __init__(self, workers=CHART_WORKERS, queue_size=CHART_QUEUE_SIZE):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._queued = 0
+        metrics.register_gauge('stats.render.queued', lambda: self._queued)
+
+    def start(self, start_method='fork'):
+        """创建渲染进程, 只有在没有启动其他线程时才能使用 fork"""
+        if self.workers <= 0:
+            return
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(start_method),
+                                                 initializer=_warm_up)
+            # 第一次提交任务时会创建全部进程, 预热在渲染进程中进行, 不等待完成
+            self._executor.submit(os.getpid)
+        logging.info(f"统计图渲染进程已启动: {self.workers} 个 ({start_method})")
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def render(self, stats_type, stats):
+        """生成图表, 返回 PNG 字节"""
+        if not self._slots.acquire(timeout=CHART_QUEUE_WAIT):
+            metrics.incr('stats.render.rejected')
+            raise ChartQueueFull("统计图渲染任务过多")
+        with self._lock:
+            self._queued += 1
+        begin = time.perf_counter()
+        try:
+            return self._render(stats_type, stats)
+        finally:
+            metrics.observe('stats.render.seconds', time.perf_counter() - begin)
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+
+    def _render(self, stats_type, stats):
+        executor = self._executor
+        if executor is None:
+            return _render_chart(stats_type, stats)
+        try:
+            return executor.submit(_render_chart, stats_type, stats).result(CHART_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            # 渲染进程异常退出, 重建进程池后由下一次请求重试
+            logging.error("统计图渲染进程异常退出, 重新创建进程池")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            self.start(REBUILD_START_METHOD)
+            raise
+
+
+chart_pool = ChartPool()
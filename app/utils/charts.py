@@ -0,0 +1,237 @@
+# coding: utf-8
+"""统计图表绘制
+
+只依赖 matplotlib 的面向对象接口 (Figure), 不使用 pyplot 的全局状态,
+输入为统计数据字典, 输出 PNG 字节, 可以在渲染进程中并发执行.
+导入本模块会加载 matplotlib 和 numpy, 只在渲染时按需导入.
+"""
+import io
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # 使用非交互式后端
+from matplotlib import cm
+from matplotlib.figure import Figure
+from app.utils.chart_labels import resolve_font, use_ascii_labels, get_label
+
+# 设置中文字体支持
+_font = resolve_font()
+if _font:
+    matplotlib.rcParams['font.sans-serif'] = [_font] + matplotlib.rcParams['font.sans-serif']
+    matplotlib.rcParams['axes.unicode_minus'] = False  # 用来正常显示负号
+
+def generate_overview_chart(stats):
+    """生成总览统计图表"""
+    # 创建图表
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    
+    # 准备数据
+    if 'chat_title' in stats:
+        # 群组特定统计
+        title = f"Group '{stats['chat_title']}' Data Overview" if use_ascii_labels() else f"群组 '{stats['chat_title']}' 数据总览"
+    else:
+        # 全局统计
+        title = get_label('Telegram 机器人数据总览')
+    
+    labels = [get_label('总消息数'), get_label('总用户数'), get_label('最近7天消息')]
+    values = [
+        stats['total_messages'],
+        stats['total_users'],
+        stats['recent_messages']
+    ]
+    
+    # 如果是全局统计，添加群组数量
+    if 'chat_title' not in stats:
+        labels.append(get_label('总群组数'))
+        values.append(stats['total_chats'])
+    
+    # 创建柱状图
+    colors = ['#3498db', '#2ecc71', '#f39c12']
+    if len(labels) > 3:
+        colors.append('#e74c3c')
+    
+    bars = ax.bar(labels, values, color=colors)
+    
+    # 添加数值标签
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2., height + 0.1,
+                f'{int(height):,}', ha='center', va='bottom')
+    
+    # 设置标题和标签
+    ax.set_title(title, fontsize=16)
+    ax.set_ylabel(get_label('消息数量'))
+    
+    return _to_png(fig)
+
+def generate_message_types_chart(stats):
+    """生成消息类型分布图表"""
+    # 创建图表
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    
+    # 准备数据
+    msg_types = stats['message_types']
+    labels = list(msg_types.keys())
+    values = list(msg_types.values())
+    
+    # 创建饼图
+    wedges, texts, autotexts = ax.pie(
+        values, 
+        labels=labels, 
+        autopct='%1.1f%%',
+        textprops={'fontsize': 12},
+        colors=cm.Paired(np.linspace(0, 1, len(labels)))
+    )
+    
+    # 设置标题
+    ax.set_title(get_label('消息类型分布'), fontsize=16)
+    
+    return _to_png(fig)
+
+def generate_top_users_chart(stats):
+    """生成活跃用户图表"""
+    # 创建图表
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    
+    # 准备数据
+    top_users = stats['top_users']
+    names = [user['name'] for user in top_users]
+    counts = [user['count'] for user in top_users]
+    
+    # 创建水平条形图
+    bars = ax.barh(names, counts, color=cm.viridis(np.linspace(0, 0.8, len(names))))
+    
+    # 添加数值标签
+    for i, bar in enumerate(bars):
+        width = bar.get_width()
+        ax.text(width + 3, bar.get_y() + bar.get_height()/2, f'{int(width):,}',
+                ha='left', va='center')
+    
+    # 设置标题和标签
+    ax.set_title(get_label('最活跃的用户 (Top 10)'), fontsize=16)
+    ax.set_xlabel(get_label('消息数量'))
+    
+    # 反转y轴，使最活跃的用户显示在顶部
+    ax.invert_yaxis()
+    
+    return _to_png(fig)
+
+def generate_top_chats_chart(stats):
+    """生成活跃群组图表"""
+    # 创建图表
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    
+    # 准备数据
+    top_chats = stats['top_chats']
+    names = [chat['name'] for chat in top_chats]
+    counts = [chat['count'] for chat in top_chats]
+    
+    # 创建水平条形图
+    bars = ax.barh(names, counts, color=cm.cool(np.linspace(0, 0.8, len(names))))
+    
+    # 添加数值标签
+    for i, bar in enumerate(bars):
+        width = bar.get_width()
+        ax.text(width + 3, bar.get_y() + bar.get_height()/2, f'{int(width):,}',
+                ha='left', va='center')
+    
+    # 设置标题和标签
+    ax.set_title(get_label('最活跃的群组 (Top 10)'), fontsize=16)
+    ax.set_xlabel(get_label('消息数量'))
+    
+    # 反转y轴，使最活跃的群组显示在顶部
+    ax.invert_yaxis()
+    
+    return _to_png(fig)
+
+def generate_time_patterns_chart(stats):
+    """生成时间模式图表"""
+    # 创建图表
+    fig = Figure(figsize=(14, 6))
+    ax1, ax2 = fig.subplots(1, 2)
+    
+    # 准备小时数据
+    hour_data = stats['hour_distribution']
+    hours = list(range(24))
+    hour_counts = [hour_data.get(h, 0) for h in hours]
+    
+    # 创建小时柱状图
+    ax1.bar(hours, hour_counts, color='#3498db')
+    ax1.set_title(get_label('按小时分布'), fontsize=14)
+    ax1.set_xlabel(get_label('小时 (24小时制)'))
+    ax1.set_ylabel(get_label('消息数量'))
+    ax1.set_xticks(range(0, 24, 2))
+    
+    # 准备星期数据
+    weekday_data = stats['weekday_distribution']
+    weekdays = list(range(7))
+    weekday_names = [get_label('周一'), get_label('周二'), get_label('周三'), 
+                     get_label('周四'), get_label('周五'), get_label('周六'), 
+                     get_label('周日')]
+    weekday_counts = [weekday_data.get(w, 0) for w in weekdays]
+    
+    # 创建星期柱状图
+    ax2.bar(weekday_names, weekday_counts, color='#2ecc71')
+    ax2.set_title(get_label('按星期分布'), fontsize=14)
+    ax2.set_xlabel(get_label('星期'))
+    ax2.set_ylabel(get_label('消息数量'))
+    
+    return _to_png(fig)
+
+def generate_message_length_chart(stats):
+    """生成消息长度分布图表"""
+    # 创建图表
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    
+    # 准备数据
+    length_data = stats['message_length']
+    labels = list(length_data.keys())
+    values = list(length_data.values())
+    
+    # 创建柱状图
+    bars = ax.bar(labels, values, color=cm.plasma(np.linspace(0, 0.8, len(labels))))
+    
+    # 添加数值标签
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width()/2., height + 0.1,
+                f'{int(height):,}', ha='center', va='bottom')
+    
+    # 设置标题和标签
+    ax.set_title(get_label('消息长度分布'), fontsize=16)
+    ax.set_xlabel(get_label('字符数范围'))
+    ax.set_ylabel(get_label('消息数量'))
+    
+    return _to_png(fig)
+
+def _to_png(fig):
+    """保存到内存"""
+    buf = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(buf, format='png', dpi=100)
+    return buf.getvalue()
+
+CHART_GENERATORS = {
+    "overview": generate_overview_chart,
+    "msg_types": generate_message_types_chart,
+    "top_users": generate_top_users_chart,
+    "top_chats": generate_top_chats_chart,
+    "time_patterns": generate_time_patterns_chart,
+    "msg_length": generate_message_length_chart
+}
+
+def render_chart(stats_type, stats):
+    """根据统计类型生成图表, 返回 PNG 字节"""
+    return CHART_GENERATORS[stats_type](stats)
+
+def warm_up():
+    """渲染进程启动时绘制一张小图, 提前加载字体和渲染器"""
+    fig = Figure(figsize=(1, 1))
+    ax = fig.subplots()
+    ax.set_title(get_label('消息数量'))
+    ax.bar([0], [1])
+    _to_png(fig)
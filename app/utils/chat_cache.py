@@ -0,0 +1,66 @@
+import os
+import time
+import threading
+from cachetools import LRUCache
+from app.models import DBSession, Chat
+
+# 已启用群组集合的最长缓存时间（秒）; webapp 在另一个进程中修改群组状态时, 靠它过期后重新读取
+CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', '30'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '100000'))
+
+_lock = threading.Lock()
+_enabled_chats = None
+_enabled_loaded_at = 0
+# user_id -> (fullname, username), 与数据库中的记录一致
+_users = LRUCache(maxsize=USER_CACHE_SIZE)
+# chat_id -> title
+_chat_titles = {}
+
+
+def is_chat_enabled(chat_id):
+    global _enabled_chats, _enabled_loaded_at
+    with _lock:
+        enabled_chats = _enabled_chats
+        if enabled_chats is None or time.time() - _enabled_loaded_at > CHAT_CACHE_TTL:
+            enabled_chats = None
+    if enabled_chats is None:
+        session = DBSession()
+        try:
+            enabled_chats = {row.id for row in session.query(Chat.id).filter(Chat.enable == True)}
+        finally:
+            session.close()
+        with _lock:
+            _enabled_chats = enabled_chats
+            _enabled_loaded_at = time.time()
+    return chat_id in enabled_chats
+
+
+def invalidate_chat(chat_id=None):
+    """群组被启用、停用或删除后调用, 下次读取时重新加载"""
+    global _enabled_chats
+    with _lock:
+        _enabled_chats = None
+        if chat_id is None:
+            _chat_titles.clear()
+        else:
+            _chat_titles.pop(chat_id, None)
+
+
+def user_changed(user_id, fullname, username):
+    with _lock:
+        return _users.get(user_id) != (fullname, username)
+
+
+def remember_user(user_id, fullname, username):
+    with _lock:
+        _users[user_id] = (fullname, username)
+
+
+def chat_title_changed(chat_id, title):
+    with _lock:
+        return _chat_titles.get(chat_id) != title
+
+
+def remember_chat_title(chat_id, title):
+    with _lock:
+        _chat_titles[chat_id] = title
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# 两次检查文件修改时间的最小间隔（秒）
+CONFIG_CHECK_INTERVAL = float(os.getenv('CONFIG_CHECK_INTERVAL', '1'))
+
+
+class JsonFileCache:
+    """
+    缓存 JSON 文件的解析结果, 文件修改时间变化后自动重新加载
+
+    Args:
+        path: 文件路径
+        build: build(内容) -> 缓存的对象, 用于预先建立索引; 文件不存在时内容为 None
+    """
+
+    def __init__(self, path, build):
+        self.path = path
+        self.build = build
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self._value = build(None)
+
+    def get(self):
+        now = time.time()
+        if now - self._checked_at < CONFIG_CHECK_INTERVAL:
+            return self._value
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._reload(mtime)
+            return self._value
+
+    def _reload(self, mtime):
+        data = None
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                # 文件正在写入或格式错误时保留旧内容, 下次检查时重试
+                logging.error(f"读取 {self.path} 失败: {str(e)}")
+                return
+        self._value = self.build(data)
+        self._mtime = mtime
+
+    def invalidate(self):
+        """本进程写入文件后调用, 下次读取时立即重新加载"""
+        with self._lock:
+            self._checked_at = 0
+            self._mtime = False
+
+
+class Config:
+    def __init__(self, data):
+        self.data = data
+        try:
+            self.enabled = bool(data['enable'])
+            self.admins = set(data['group_admins']) if self.enabled else set()
+        except (TypeError, KeyError):
+            # 与原来的行为一致: 配置缺失或不完整时视为未启用
+            self.enabled = False
+            self.admins = set()
+        # 机器人管理员名单, 不受 enable 影响 (用于查看所有群组的统计)
+        try:
+            self.group_admins = set(data.get('group_admins') or [])
+        except (AttributeError, TypeError):
+            self.group_admins = set()
+
+
+class ChatMembers:
+    def __init__(self, data):
+        self.data = data or {}
+        # user_id -> [(chat_id, chat_title), ...]
+        self.chats_by_user = {}
+        for chat_id, chat in self.data.items():
+            for user_id in chat.get('members', []):
+                self.chats_by_user.setdefault(user_id, []).append((int(chat_id), chat['title']))
@@ -0,0 +1,168 @@
+# coding: utf-8
+"""定时删除消息
+
+所有待删除的消息放在一个按到期时间排序的堆中, 由一个后台线程统一处理, 不再为每条消息创建一个休眠线程.
+
+- 待删除记录批量写入 pending_deletion 表, 重启后由 start() 重新加载, 已过期的立即删除;
+- delete_message 调用按 DELETE_RATE_LIMIT 限速, 遇到 Telegram 的 RetryAfter 时暂停后重试.
+"""
+import os
+import time
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import tuple_
+from telegram.error import RetryAfter
+from app.models import DBSession, PendingDeletion
+from app.utils import metrics
+
+# 每秒最多删除多少条消息
+DELETE_RATE_LIMIT = float(os.getenv('DELETE_RATE_LIMIT', '20'))
+# 待删除记录写入数据库的间隔（秒）
+DELETE_PERSIST_INTERVAL = float(os.getenv('DELETE_PERSIST_INTERVAL', '5'))
+
+
+class DeleteScheduler:
+    def __init__(self, rate_limit=DELETE_RATE_LIMIT, persist_interval=DELETE_PERSIST_INTERVAL):
+        self.rate_limit = rate_limit
+        self.persist_interval = persist_interval
+        self._cond = threading.Condition()
+        self._heap = []
+        self._unsaved = []
+        self._done = []
+        self._bot = None
+        self._thread = None
+        self._stopping = False
+        self._next_delete = 0
+        metrics.register_gauge('delete.pending', lambda: len(self._heap))
+
+    def start(self, bot):
+        """加载上次运行时未完成的删除并启动后台线程"""
+        session = DBSession()
+        try:
+            rows = session.query(PendingDeletion.chat_id, PendingDeletion.message_id, PendingDeletion.due).all()
+        finally:
+            session.close()
+        with self._cond:
+            self._bot = bot
+            for chat_id, message_id, due in rows:
+                heapq.heappush(self._heap, (self._to_timestamp(due), chat_id, message_id))
+            self._start_thread()
+            self._cond.notify()
+        if rows:
+            logging.info(f"已加载 {len(rows)} 条待删除消息")
+
+    def stop(self, timeout=10):
+        """停止后台线程, 未到期的删除保留在数据库中, 下次启动继续"""
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        self._persist()
+
+    def schedule(self, bot, chat_id, message_id, timeout):
+        due = time.time() + timeout
+        with self._cond:
+            if self._bot is None:
+                self._bot = bot
+            heapq.heappush(self._heap, (due, chat_id, message_id))
+            self._unsaved.append((chat_id, message_id, due))
+            self._start_thread()
+            # 新任务比当前等待的更早到期时唤醒线程
+            if self._heap[0][0] == due:
+                self._cond.notify()
+
+    def _start_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='DeleteScheduler', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _to_timestamp(due):
+        return (due - datetime(1970, 1, 1)).total_seconds()
+
+    def _run(self):
+        last_persist = time.time()
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    wait = self.persist_interval
+                    if self._heap:
+                        wait = min(wait, self._heap[0][0] - now)
+                    self._cond.wait(wait)
+                    if time.time() - last_persist >= self.persist_interval:
+                        break
+                if self._stopping:
+                    return
+                due_items = []
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due_items.append(heapq.heappop(self._heap))
+                bot = self._bot
+
+            for item in due_items:
+                if not self._delete(bot, item):
+                    break
+
+            if time.time() - last_persist >= self.persist_interval:
+                self._persist()
+                last_persist = time.time()
+
+    def _delete(self, bot, item):
+        """删除一条消息, 返回 False 表示正在停止, 剩余的消息留待下次"""
+        due, chat_id, message_id = item
+        # 限速: 两次调用之间至少间隔 1 / rate_limit 秒
+        wait = self._next_delete - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._next_delete = time.time() + 1 / self.rate_limit
+        try:
+            bot.delete_message(chat_id=chat_id, message_id=message_id)
+            metrics.incr('delete.done')
+        except RetryAfter as e:
+            # 触发 Telegram 限流, 暂停后重新排队
+            metrics.incr('delete.retry_after')
+            self._next_delete = time.time() + e.retry_after
+            with self._cond:
+                heapq.heappush(self._heap, (time.time() + e.retry_after, chat_id, message_id))
+                return not self._stopping
+        except Exception:
+            pass  # Ignore any errors when trying to delete message
+        with self._cond:
+            self._done.append((chat_id, message_id))
+            return not self._stopping
+
+    def _persist(self):
+        """批量写入新增的待删除记录, 并清除已完成的记录"""
+        with self._cond:
+            unsaved, self._unsaved = self._unsaved, []
+            done, self._done = self._done, []
+        if not unsaved and not done:
+            return
+        done_keys = set(done)
+        unsaved = [row for row in unsaved if (row[0], row[1]) not in done_keys]
+        session = DBSession()
+        try:
+            if done:
+                session.query(PendingDeletion).filter(
+                    tuple_(PendingDeletion.chat_id, PendingDeletion.message_id).in_(done)
+                ).delete(synchronize_session=False)
+            for chat_id, message_id, due in unsaved:
+                session.merge(PendingDeletion(chat_id=chat_id, message_id=message_id,
+                                              due=datetime(1970, 1, 1) + timedelta(seconds=due)))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error(f"保存待删除消息失败: {str(e)}")
+        finally:
+            session.close()
+
+
+delete_scheduler = DeleteScheduler()
@@ -0,0 +1,145 @@
+# coding: utf-8
+"""LLM 请求执行器
+
+所有 LLM 请求在一个后台线程的事件循环中执行, 共用一个保持连接的 httpx.AsyncClient.
+调用方立即得到 concurrent.futures.Future, 不会阻塞 dispatcher 的工作线程;
+并发数由信号量限制, 每个请求 (含排队时间) 有截止时间, 连续失败后熔断一段时间, 期间直接失败.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+import httpx
+from app.utils import metrics
+
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))
+# 连续失败多少次后熔断, 熔断持续多少秒后允许一次试探请求
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '60'))
+
+
+class CircuitOpenError(Exception):
+    """LLM 服务连续失败, 熔断期间拒绝请求"""
+
+
+class LLMClient:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, timeout=LLM_TIMEOUT,
+                 breaker_threshold=LLM_BREAKER_THRESHOLD, breaker_reset=LLM_BREAKER_RESET):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._semaphore = None
+        self._in_flight = 0
+        self._failures = 0
+        self._open_until = 0
+        self._probing = False
+        metrics.register_gauge('llm.in_flight', lambda: self._in_flight)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._loop, ready), name='LLMClient', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self, timeout=10):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result(timeout)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        limits = httpx.Limits(max_connections=self.max_concurrency,
+                              max_keepalive_connections=self.max_concurrency)
+        self._client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        loop.run_forever()
+        loop.close()
+
+    async def _close(self):
+        await self._client.aclose()
+
+    def submit(self, url, payload, headers=None, parse=None, timeout=None):
+        """
+        提交一个 POST 请求
+
+        Args:
+            url, payload, headers: 请求地址、JSON 内容和请求头
+            parse: 在事件循环中处理响应 JSON 的函数, 其返回值作为 Future 的结果
+            timeout: 截止时间（秒）, 默认为 LLM_TIMEOUT
+
+        Returns:
+            concurrent.futures.Future
+        """
+        if not self._allow_request():
+            metrics.incr('llm.rejected')
+            future = concurrent.futures.Future()
+            future.set_exception(CircuitOpenError(f"LLM 请求连续失败 {self._failures} 次, 暂停调用"))
+            return future
+        self.start()
+        coroutine = self._request(url, payload, headers, parse, timeout or self.timeout)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _allow_request(self):
+        with self._lock:
+            if self._failures < self.breaker_threshold:
+                return True
+            # 熔断结束后只放行一个试探请求, 成功后恢复
+            if time.time() >= self._open_until and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def _record(self, success):
+        with self._lock:
+            self._probing = False
+            if success:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                self._open_until = time.time() + self.breaker_reset
+                logging.warning(f"LLM 请求连续失败 {self._failures} 次, 熔断 {self.breaker_reset} 秒")
+
+    async def _request(self, url, payload, headers, parse, timeout):
+        begin = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self._post(url, payload, headers), timeout)
+        except Exception:
+            metrics.incr('llm.failures')
+            self._record(False)
+            raise
+        metrics.observe('llm.seconds', time.perf_counter() - begin)
+        self._record(True)
+        # 响应内容无法解析不计入熔断
+        return parse(result) if parse else result
+
+    async def _post(self, url, payload, headers):
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                response = await self._client.post(url, json=payload, headers=headers)
+                response.raise_for_status()
+                return response.json()
+            finally:
+                self._in_flight -= 1
+
+
+llm_client = LLMClient()
@@ -0,0 +1,97 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import telegram
+from cachetools import TTLCache
+
+# 成员资格缓存时间（秒）, 非成员和查询失败的结果缓存时间更短
+MEMBER_CACHE_TTL = int(os.getenv('MEMBER_CACHE_TTL', '600'))
+NON_MEMBER_CACHE_TTL = int(os.getenv('NON_MEMBER_CACHE_TTL', '60'))
+MEMBER_CACHE_SIZE = int(os.getenv('MEMBER_CACHE_SIZE', '20000'))
+# 并发查询 get_chat_member 的线程数
+MEMBER_CHECK_WORKERS = int(os.getenv('MEMBER_CHECK_WORKERS', '4'))
+
+LEFT_STATUSES = ['left', 'kicked']
+
+_lock = threading.Lock()
+# (chat_id, user_id) -> True / False, 超时或超出容量 (LRU) 后淘汰
+_members = TTLCache(maxsize=MEMBER_CACHE_SIZE, ttl=MEMBER_CACHE_TTL)
+_non_members = TTLCache(maxsize=MEMBER_CACHE_SIZE, ttl=NON_MEMBER_CACHE_TTL)
+_executor = ThreadPoolExecutor(max_workers=MEMBER_CHECK_WORKERS, thread_name_prefix='MemberCheck')
+
+
+def update_member_status(chat_id, user_id, status):
+    """根据最新的成员状态更新缓存"""
+    key = (chat_id, user_id)
+    with _lock:
+        if status in LEFT_STATUSES:
+            _members.pop(key, None)
+            _non_members[key] = False
+        else:
+            _non_members.pop(key, None)
+            _members[key] = True
+
+
+def forget_chat(chat_id):
+    """机器人离开群组时清除该群组的缓存"""
+    with _lock:
+        for cache in (_members, _non_members):
+            for key in [k for k in list(cache.keys()) if k[0] == chat_id]:
+                cache.pop(key, None)
+
+
+def _cached(chat_id, user_id):
+    key = (chat_id, user_id)
+    with _lock:
+        if key in _members:
+            return True
+        if key in _non_members:
+            return False
+    return None
+
+
+def _fetch(bot, chat_id, user_id):
+    try:
+        chat_member = bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+    except telegram.error.BadRequest as e:
+        logging.error(f"获取群组 {chat_id} 成员信息失败: {str(e)}")
+        update_member_status(chat_id, user_id, 'left')
+        return False
+    except telegram.error.Unauthorized as e:
+        logging.error(f"群组 {chat_id} 未授权: {str(e)}")
+        update_member_status(chat_id, user_id, 'left')
+        return False
+    except Exception as e:
+        # 网络等临时错误不缓存
+        logging.error(f"处理群组 {chat_id} 时发生错误: {str(e)}")
+        return False
+    update_member_status(chat_id, user_id, chat_member.status)
+    return chat_member.status not in LEFT_STATUSES
+
+
+def is_chat_member(bot, chat_id, user_id):
+    cached = _cached(chat_id, user_id)
+    if cached is not None:
+        return cached
+    return _fetch(bot, chat_id, user_id)
+
+
+def filter_member_chats(bot, chats, user_id):
+    """从 [(chat_id, chat_title), ...] 中筛选出用户所在的群组, 未命中缓存的群组并发查询"""
+    results = {}
+    misses = []
+    for chat_id, _ in chats:
+        cached = _cached(chat_id, user_id)
+        if cached is None:
+            misses.append(chat_id)
+        else:
+            results[chat_id] = cached
+
+    if len(misses) == 1:
+        results[misses[0]] = _fetch(bot, misses[0], user_id)
+    elif misses:
+        fetched = _executor.map(lambda chat_id: _fetch(bot, chat_id, user_id), misses)
+        results.update(zip(misses, fetched))
+
+    return [chat for chat in chats if results.get(chat[0])]
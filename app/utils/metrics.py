@@ -0,0 +1,42 @@
+import logging
+import threading
+
+# 进程内运行指标: 计数器、采样值统计和按需读取的瞬时值
+_lock = threading.Lock()
+_counters = {}
+_samples = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """记录一次采样, 汇总为次数 / 平均值 / 最大值"""
+    with _lock:
+        count, total, maximum = _samples.get(name, (0, 0, 0))
+        _samples[name] = (count + 1, total + value, max(maximum, value))
+
+
+def register_gauge(name, func):
+    """注册一个瞬时值, 在读取指标时调用 func 获取当前值"""
+    with _lock:
+        _gauges[name] = func
+
+
+def snapshot():
+    with _lock:
+        result = dict(_counters)
+        for name, (count, total, maximum) in _samples.items():
+            result[f'{name}.count'] = count
+            result[f'{name}.avg'] = round(total / count, 3) if count else 0
+            result[f'{name}.max'] = round(maximum, 3)
+        gauges = list(_gauges.items())
+    for name, func in gauges:
+        try:
+            result[name] = func()
+        except Exception as e:
+            logging.error(f"读取指标 {name} 失败: {str(e)}")
+    return result
@@ -0,0 +1,57 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from cachetools import TTLCache
+from app.models import DBSession, ParsedQuery
+
+# 解析结果缓存时间（秒）, 同时保存在数据库中, 重启后仍然有效
+PARSE_CACHE_TTL = int(os.getenv('PARSE_CACHE_TTL', '3600'))
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', '2000'))
+
+_lock = threading.Lock()
+_parsed = TTLCache(maxsize=PARSE_CACHE_SIZE, ttl=PARSE_CACHE_TTL)
+
+
+def get(key):
+    """取出缓存的解析结果, 内存中没有时查询数据库"""
+    with _lock:
+        parsed = _parsed.get(key)
+    if parsed is not None:
+        return json.loads(parsed)
+
+    session = DBSession()
+    try:
+        row = session.query(ParsedQuery).filter(
+            ParsedQuery.key == key, ParsedQuery.expires > datetime.utcnow()).first()
+        parsed = row.value if row else None
+    except Exception as e:
+        logging.error(f"读取查询解析缓存失败: {str(e)}")
+        parsed = None
+    finally:
+        session.close()
+    if parsed is None:
+        return None
+    with _lock:
+        _parsed[key] = parsed
+    return json.loads(parsed)
+
+
+def put(key, parsed):
+    value = json.dumps(parsed, ensure_ascii=False)
+    with _lock:
+        _parsed[key] = value
+
+    now = datetime.utcnow()
+    session = DBSession()
+    try:
+        # 顺便清理过期的记录
+        session.query(ParsedQuery).filter(ParsedQuery.expires <= now).delete(synchronize_session=False)
+        session.merge(ParsedQuery(key=key, value=value, expires=now + timedelta(seconds=PARSE_CACHE_TTL)))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"保存查询解析缓存失败: {str(e)}")
+    finally:
+        session.close()
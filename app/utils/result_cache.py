@@ -0,0 +1,56 @@
+import os
+import threading
+from cachetools import TTLCache
+from app.utils import metrics
+
+# 缓存的搜索结果页数量; 其他进程 (如导入脚本) 写入的消息不会更新版本号, 靠超时兜底
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '1000'))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '600'))
+
+_lock = threading.Lock()
+# (查询条件, 页码, 游标) -> (各群组写入版本, 结果)
+_pages = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+# chat_id -> 写入版本, 群组有新消息、编辑或删除时递增
+_versions = {}
+# 任一群组变化时递增, 用于全局统计
+_global_version = 0
+
+metrics.register_gauge('search.result_cache.size', lambda: len(_pages))
+
+
+def bump_chat_versions(chat_ids):
+    """群组的消息发生变化后调用, 使包含这些群组的缓存结果失效"""
+    global _global_version
+    with _lock:
+        for chat_id in set(chat_ids):
+            _versions[chat_id] = _versions.get(chat_id, 0) + 1
+        _global_version += 1
+
+
+def data_version(chat_id=None):
+    """群组的写入版本, chat_id 为 None 时返回全局版本"""
+    with _lock:
+        return _versions.get(chat_id, 0) if chat_id is not None else _global_version
+
+
+def lookup(key, chat_ids):
+    """
+    查找缓存的结果页
+
+    Returns:
+        tuple: (当前各群组写入版本, 缓存的结果), 未命中时结果为 None;
+               版本号需要在查询数据库之前取得, 并原样传给 store
+    """
+    with _lock:
+        versions = tuple(_versions.get(chat_id, 0) for chat_id in chat_ids)
+        cached = _pages.get(key)
+    if cached is not None and cached[0] == versions:
+        metrics.incr('search.result_cache.hit')
+        return versions, cached[1]
+    metrics.incr('search.result_cache.miss')
+    return versions, None
+
+
+def store(key, versions, result):
+    with _lock:
+        _pages[key] = (versions, result)
@@ -0,0 +1,65 @@
+import os
+import threading
+from cachetools import TTLCache
+from sqlalchemy import func, literal
+
+# 同一查询的总数在翻页期间复用的时间（秒）
+SEARCH_COUNT_TTL = int(os.getenv('SEARCH_COUNT_TTL', '300'))
+# 大于 0 时最多数到该值, 超出后显示为“至少 N 条”; 0 表示精确计数
+SEARCH_COUNT_CAP = int(os.getenv('SEARCH_COUNT_CAP', '0'))
+
+_lock = threading.Lock()
+_totals = TTLCache(maxsize=4096, ttl=SEARCH_COUNT_TTL)
+
+
+class SearchTotal(int):
+    """搜索结果总数, exact 为 False 时表示至少有这么多条"""
+
+    def __new__(cls, value, exact=True):
+        total = super().__new__(cls, value)
+        total.exact = exact
+        return total
+
+    def __str__(self):
+        return f'{int(self)}' if self.exact else f'{int(self)}+'
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+
+def count_results(query, cache_key, offset, fetched, page_size, known_total=None):
+    """
+    获取搜索结果总数
+
+    依次尝试: 翻页期间缓存的总数 -> 当前页未取满时直接推算 -> 执行 COUNT (可设置上限)
+
+    Args:
+        query: 已添加过滤条件的查询
+        cache_key: 规范化后的查询条件, 可哈希
+        offset: 当前页之前的结果条数
+        fetched: 当前页从数据库取出的行数
+        page_size: 每页条数
+        known_total: 搜索会话中保存的总数
+    """
+    with _lock:
+        total = _totals.get(cache_key, known_total)
+    if total is not None and (total.exact or offset + fetched <= total):
+        return total
+
+    if fetched < page_size:
+        # 已经到达最后一页, 不需要 COUNT
+        total = SearchTotal(offset + fetched)
+    elif SEARCH_COUNT_CAP > 0:
+        limited = query.with_entities(literal(1)).limit(SEARCH_COUNT_CAP + 1).subquery()
+        count = query.session.query(func.count()).select_from(limited).scalar()
+        total = SearchTotal(min(count, SEARCH_COUNT_CAP), exact=count <= SEARCH_COUNT_CAP)
+    else:
+        total = SearchTotal(query.count())
+
+    if not total.exact and offset + fetched > total:
+        # 翻页已超过计数上限, 至少还有下一页
+        total = SearchTotal(offset + fetched + 1, exact=False)
+
+    with _lock:
+        _totals[cache_key] = total
+    return total
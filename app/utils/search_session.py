@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import secrets
+import sqlite3
+import logging
+import threading
+from cachetools import TTLCache
+from app.utils.search_count import SearchTotal
+
+# 搜索会话保留时间（秒）, 超时后翻页需要重新搜索
+SEARCH_SESSION_TTL = int(os.getenv('SEARCH_SESSION_TTL', '3600'))
+SEARCH_SESSION_SIZE = int(os.getenv('SEARCH_SESSION_SIZE', '10000'))
+# memory: 保存在进程内存中; sqlite: 保存在本地 SQLite 文件中, 重启后翻页仍然可用
+SEARCH_SESSION_BACKEND = os.getenv('SEARCH_SESSION_BACKEND', 'memory')
+SEARCH_SESSION_DB = os.getenv('SEARCH_SESSION_DB', './config/search_sessions.db')
+
+
+class MemoryStore:
+    """进程内的会话存储, 超时或超出容量后淘汰"""
+
+    def __init__(self, ttl, maxsize):
+        self._lock = threading.Lock()
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, token):
+        with self._lock:
+            data = self._sessions.get(token)
+        return json.loads(data) if data else None
+
+    def set(self, token, session):
+        with self._lock:
+            self._sessions[token] = json.dumps(session)
+
+
+class SqliteStore:
+    """本地 SQLite 文件中的会话存储, 接口与 MemoryStore 相同"""
+
+    def __init__(self, ttl, path):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS search_session (token TEXT PRIMARY KEY, data TEXT, expires REAL)')
+        self._conn.commit()
+
+    def get(self, token):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM search_session WHERE token = ? AND expires > ?', (token, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, token, session):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM search_session WHERE expires <= ?', (now,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO search_session (token, data, expires) VALUES (?, ?, ?)',
+                (token, json.dumps(session), now + self.ttl))
+            self._conn.commit()
+
+
+def _create_store():
+    if SEARCH_SESSION_BACKEND == 'sqlite':
+        try:
+            return SqliteStore(SEARCH_SESSION_TTL, SEARCH_SESSION_DB)
+        except sqlite3.Error as e:
+            logging.error(f"无法打开搜索会话数据库 {SEARCH_SESSION_DB}: {str(e)}, 使用内存存储")
+    return MemoryStore(SEARCH_SESSION_TTL, SEARCH_SESSION_SIZE)
+
+
+_store = _create_store()
+
+
+def create_session(search_type, params, chat_id=None, total=None, cursors=None, chat_ids=()):
+    """
+    保存一次搜索, 返回用于翻页回调的令牌
+
+    Args:
+        search_type: 'search' 或 'nlsearch'
+        params: 完整的查询参数
+        chat_id: 搜索范围限定的群组, None 表示用户所在的全部群组
+        total: 第一页得到的结果总数
+        cursors: {页码: 游标}
+        chat_ids: 第一页实际搜索的群组, total 和 cursors 只对同样的群组有效
+    """
+    token = secrets.token_urlsafe(6)
+    session = {'type': search_type, 'params': params, 'chat_id': chat_id, 'views': {}}
+    update_session(token, session, chat_ids, total, cursors)
+    return token
+
+
+def get_session(token):
+    """取出搜索会话, 不存在或已过期时返回 None"""
+    return _store.get(token)
+
+
+def _view(session, chat_ids):
+    """
+    按可搜索的群组区分的总数和游标
+
+    同一个会话的翻页按钮任何人都可以点击 (包括内联模式发出的消息), 不同用户能搜索的群组不同,
+    结果总数和游标不能混用
+    """
+    key = ','.join(str(chat_id) for chat_id in sorted(set(chat_ids)))
+    return session.setdefault('views', {}).setdefault(key, {'total': None, 'cursors': {}})
+
+
+def session_total(session, chat_ids):
+    """会话中保存的结果总数"""
+    total = _view(session, chat_ids)['total']
+    if not total:
+        return None
+    count, exact = total
+    return SearchTotal(count, exact=exact)
+
+
+def session_cursor(session, chat_ids, page):
+    """会话中保存的某一页的游标"""
+    return _view(session, chat_ids)['cursors'].get(str(page))
+
+
+def update_session(token, session, chat_ids, total=None, cursors=None):
+    """记录翻页时可复用的总数和各页游标"""
+    view = _view(session, chat_ids)
+    if total is not None:
+        view['total'] = [int(total), getattr(total, 'exact', True)]
+    if cursors:
+        view['cursors'].update({str(page): cursor for page, cursor in cursors.items() if cursor})
+    _store.set(token, session)
@@ -1,13 +1,15 @@
 import re
 import functools
 import gettext
-import time
 import json
 import os
-from threading import Thread
+import copy
 from datetime import datetime, timedelta
 from sqlalchemy import func
-from app.models import DBSession, Message, User, Chat
+from app.models import DBSession, Message, User, Chat, stats_rollup
+from app.utils.delete_scheduler import delete_scheduler
+from app.utils.app_context import app_context
+from app.utils.config_store import JsonFileCache, Config, ChatMembers
 
 CONFIG_FILE = './config/.config.json'
 
@@ -34,14 +36,11 @@ def get_text_func():
 # Initialize the translation function once at module level
 _ = get_text_func()
 
-def delay_delete(bot, chat_id, message_id, timeout=None):
+def schedule_delete(bot, chat_id, message_id, timeout=None):
+    """timeout 秒后删除消息, 由 delete_scheduler 统一执行"""
     if timeout is None:
         timeout = DEFAULT_DELETE_TIMEOUT
-    time.sleep(timeout)
-    try:
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except:
-        pass  # Ignore any errors when trying to delete message
+    delete_scheduler.schedule(bot, chat_id, message_id, timeout)
 
 
 def auto_delete(fn=None, *, timeout=None, delete_command=True):
@@ -63,11 +62,11 @@ def auto_delete(fn=None, *, timeout=None, delete_command=True):
             
             # Delete the bot's response message
             if sent_message:
-                Thread(target=delay_delete, args=[bot, sent_message.chat_id, sent_message.message_id, timeout]).start()
+                schedule_delete(bot, sent_message.chat_id, sent_message.message_id, timeout)
                 
                 # Also delete the user's command message if available
                 if user_message_id and user_chat_id:
-                    Thread(target=delay_delete, args=[bot, user_chat_id, user_message_id, timeout]).start()
+                    schedule_delete(bot, user_chat_id, user_message_id, timeout)
                     
             return sent_message
         return wrapper
@@ -96,58 +95,48 @@ def len_non_ascii(data):
 
 
 def get_bot_user_name(bot):
-    return bot.get_me().username
+    return app_context.bot_user(bot).username
 
 
 def get_bot_id(bot):
-    return bot.get_me().id
+    return app_context.bot_user(bot).id
+
+
+_config = JsonFileCache(CONFIG_FILE, Config)
+_chat_members = JsonFileCache(USERBOT_CHAT_MEMBERS_FILE, ChatMembers)
 
 
 def read_config():
-    if not os.path.exists(CONFIG_FILE):
-        return None
-    f = open(CONFIG_FILE)
-    config_dict = json.load(f)
-    f.close()
-    return config_dict
+    return _config.get().data
 
 
 def check_control_permission(from_user_id):
-    try:
-        config = read_config()
-        if config['enable']:
-            if from_user_id in config['group_admins']:
-                return True
-            else:
-                return False
-        else:
-            return None
-    except:
-        return None
+    config = _config.get()
+    if config.enabled:
+        return from_user_id in config.admins
+    return None
+
+
+def is_bot_admin(from_user_id):
+    """是否在 .config.json 的 group_admins 名单中, 与 enable 无关"""
+    return from_user_id in _config.get().group_admins
 
 
 def load_chat_members():
     if not os.path.exists(USERBOT_CHAT_MEMBERS_FILE):
-        with open(USERBOT_CHAT_MEMBERS_FILE, 'w') as f:
-            json.dump({}, f)
-
-    with open(USERBOT_CHAT_MEMBERS_FILE, 'r') as f:
-        chat_members = json.load(f)
-    return chat_members
+        write_chat_members({})
+    # 返回副本, 调用方修改后通过 write_chat_members 写回
+    return copy.deepcopy(_chat_members.get().data)
 
 
 def write_chat_members(chat_members):
     with open(USERBOT_CHAT_MEMBERS_FILE, 'w') as f:
         json.dump(chat_members, f)
+    _chat_members.invalidate()
 
 
 def get_filter_chats(user_id):
-    filter_chats = []
-    chat_members = load_chat_members()
-    for chat_id in chat_members:
-        if user_id in chat_members[chat_id]['members']:
-            filter_chats.append((int(chat_id),chat_members[chat_id]['title']))
-    return filter_chats
+    return list(_chat_members.get().chats_by_user.get(user_id, []))
 
 
 def is_userbot_mode():
@@ -171,13 +160,8 @@ def read_userbot_admin_id():
     return current_id
 
 
-def get_statistics_data(chat_id=None):
-    """获取统计数据，用于生成统计报告
-    
-    Args:
-        chat_id: 如果提供，则只统计该群组的数据
-    """
-    session = DBSession()
+def _live_statistics(session, chat_id=None):
+    """实时扫描消息表统计, 汇总表就绪前使用"""
     stats = {}
     
     # 基础查询 - 根据chat_id过滤
@@ -190,98 +174,115 @@ def get_statistics_data(chat_id=None):
     stats['message_types'] = {t[0]: t[1] for t in msg_types}
     
     # 2. 用户活跃度 - 发送消息最多的前10名用户
-    top_users = base_query.with_entities(Message.from_id, func.count(Message.id).label('count')) \
+    stats['top_users'] = base_query.with_entities(Message.from_id, func.count(Message.id).label('count')) \
                        .group_by(Message.from_id) \
                        .order_by(func.count(Message.id).desc()) \
                        .limit(10).all()
     
-    user_ids = [u[0] for u in top_users]
-    users = session.query(User).filter(User.id.in_(user_ids)).all()
-    user_map = {u.id: u.fullname or u.username or str(u.id) for u in users}
-    
-    stats['top_users'] = [{'id': u[0], 'name': user_map.get(u[0], str(u[0])), 'count': u[1]} for u in top_users]
-    
     # 3. 聊天群组活跃度 - 只在全局统计时显示
     if not chat_id:
-        top_chats = session.query(Message.from_chat, func.count(Message.id).label('count')) \
+        stats['top_chats'] = session.query(Message.from_chat, func.count(Message.id).label('count')) \
                         .group_by(Message.from_chat) \
                         .order_by(func.count(Message.id).desc()) \
                         .limit(10).all()
-        
-        chat_ids = [c[0] for c in top_chats]
-        chats = session.query(Chat).filter(Chat.id.in_(chat_ids)).all()
-        chat_map = {c.id: c.title or str(c.id) for c in chats}
-        
-        stats['top_chats'] = [{'id': c[0], 'name': chat_map.get(c[0], str(c[0])), 'count': c[1]} for c in top_chats]
-    else:
-        # 如果是特定群组，则不需要显示群组活跃度
-        stats['top_chats'] = []
     
     # 4. 时间模式分析
-    # 按小时统计
-    hour_stats = base_query.with_entities(func.extract('hour', Message.date).label('hour'), 
-                              func.count(Message.id).label('count')) \
-                       .group_by('hour') \
-                       .order_by('hour').all()
-    stats['hour_distribution'] = {int(h[0]): h[1] for h in hour_stats}
-    
-    # 按星期几统计
-    weekday_stats = base_query.with_entities(func.extract('dow', Message.date).label('weekday'), 
-                                 func.count(Message.id).label('count')) \
-                          .group_by('weekday') \
-                          .order_by('weekday').all()
-    stats['weekday_distribution'] = {int(w[0]): w[1] for w in weekday_stats}
-    
-    # 按月份统计
-    month_stats = base_query.with_entities(func.extract('month', Message.date).label('month'), 
-                               func.count(Message.id).label('count')) \
-                        .group_by('month') \
-                        .order_by('month').all()
-    stats['month_distribution'] = {int(m[0]): m[1] for m in month_stats}
+    # 小时、星期、月份一次分组查询, 再分别累加
+    hour = func.extract('hour', Message.date)
+    weekday = func.extract('dow', Message.date)
+    month = func.extract('month', Message.date)
+    time_stats = base_query.with_entities(hour, weekday, month, func.count(Message.id)) \
+                       .group_by(hour, weekday, month).all()
+    hour_distribution, weekday_distribution, month_distribution = {}, {}, {}
+    for h, w, m, count in time_stats:
+        if h is None:
+            continue
+        hour_distribution[int(h)] = hour_distribution.get(int(h), 0) + count
+        weekday_distribution[int(w)] = weekday_distribution.get(int(w), 0) + count
+        month_distribution[int(m)] = month_distribution.get(int(m), 0) + count
+    stats['hour_distribution'] = dict(sorted(hour_distribution.items()))
+    stats['weekday_distribution'] = dict(sorted(weekday_distribution.items()))
+    stats['month_distribution'] = dict(sorted(month_distribution.items()))
     
     # 5. 消息长度分布
-    # 创建长度范围分类
-    length_ranges = [
-        (0, 10, '0-10'),
-        (11, 50, '11-50'),
-        (51, 100, '51-100'),
-        (101, 200, '101-200'),
-        (201, 500, '201-500'),
-        (501, float('inf'), '500+')
-    ]
-    
-    length_stats = {}
-    for start, end, label in length_ranges:
-        query = base_query
-        if end == float('inf'):
-            count = query.filter(func.length(Message.text) > start).count()
-        else:
-            count = query.filter(func.length(Message.text) >= start) \
-                        .filter(func.length(Message.text) <= end).count()
-        length_stats[label] = count
+    # 用 CASE 表达式分段, 一次分组查询
+    bucket = stats_rollup.length_bucket_expression(func.length(Message.text))
+    length_counts = dict(base_query.with_entities(bucket, func.count(Message.id)) \
+                         .filter(Message.text.isnot(None)) \
+                         .group_by(bucket).all())
+    length_stats = {label: length_counts.get(label, 0) for _, _, label in stats_rollup.LENGTH_BUCKETS}
     
     stats['message_length'] = length_stats
     
     # 6. 总体统计
     stats['total_messages'] = base_query.count()
-    
     if chat_id:
-        # 如果是特定群组，只统计该群组的用户数
         stats['total_users'] = base_query.with_entities(Message.from_id).distinct().count()
-        stats['total_chats'] = 1  # 只有一个群组
-        
-        # 获取群组名称
-        chat = session.query(Chat).filter(Chat.id == chat_id).first()
-        stats['chat_title'] = chat.title if chat else str(chat_id)
-    else:
-        # 全局统计
-        stats['total_users'] = session.query(func.count(User.id)).scalar()
-        stats['total_chats'] = session.query(func.count(Chat.id)).scalar()
     
     # 7. 最近活跃度
     recent_days = 7
     recent_date = datetime.now() - timedelta(days=recent_days)
     stats['recent_messages'] = base_query.filter(Message.date >= recent_date).count()
+    return stats
+
+
+def _rollup_statistics(session, chat_id=None):
+    """从统计汇总表读取, 开销只与分组数量有关"""
+    daily = stats_rollup.daily_counts(session, chat_id)
+    stats = {
+        'message_types': stats_rollup.type_counts(session, chat_id),
+        'top_users': stats_rollup.top_users(session, chat_id),
+        'hour_distribution': stats_rollup.hour_distribution(session, chat_id),
+        'weekday_distribution': stats_rollup.weekday_distribution(daily),
+        'month_distribution': stats_rollup.month_distribution(daily),
+        'message_length': stats_rollup.length_histogram(session, chat_id),
+        'total_messages': stats_rollup.total_count(session, chat_id),
+        'recent_messages': stats_rollup.count_since(session, datetime.now() - timedelta(days=7), chat_id)
+    }
+    if chat_id:
+        stats['total_users'] = stats_rollup.user_count(session, chat_id)
+    else:
+        stats['top_chats'] = stats_rollup.top_chats(session)
+    return stats
+
+
+def get_statistics_data(chat_id=None):
+    """获取统计数据，用于生成统计报告
     
-    session.close()
-    return stats 
\ No newline at end of file
+    Args:
+        chat_id: 如果提供，则只统计该群组的数据
+    """
+    session = DBSession()
+    try:
+        if stats_rollup.is_ready():
+            stats = _rollup_statistics(session, chat_id)
+        else:
+            stats = _live_statistics(session, chat_id)
+        
+        top_users = stats['top_users']
+        user_ids = [u[0] for u in top_users]
+        users = session.query(User).filter(User.id.in_(user_ids)).all()
+        user_map = {u.id: u.fullname or u.username or str(u.id) for u in users}
+        stats['top_users'] = [{'id': u[0], 'name': user_map.get(u[0], str(u[0])), 'count': u[1]} for u in top_users]
+        
+        if chat_id:
+            # 如果是特定群组，则不需要显示群组活跃度
+            stats['top_chats'] = []
+            stats['total_chats'] = 1  # 只有一个群组
+            
+            # 获取群组名称
+            chat = session.query(Chat).filter(Chat.id == chat_id).first()
+            stats['chat_title'] = chat.title if chat else str(chat_id)
+        else:
+            top_chats = stats['top_chats']
+            chat_ids = [c[0] for c in top_chats]
+            chats = session.query(Chat).filter(Chat.id.in_(chat_ids)).all()
+            chat_map = {c.id: c.title or str(c.id) for c in chats}
+            stats['top_chats'] = [{'id': c[0], 'name': chat_map.get(c[0], str(c[0])), 'count': c[1]} for c in top_chats]
+            
+            # 全局统计
+            stats['total_users'] = session.query(func.count(User.id)).scalar()
+            stats['total_chats'] = session.query(func.count(Chat.id)).scalar()
+        return stats
+    finally:
+        session.close()
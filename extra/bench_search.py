@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""搜索结果分页基准测试
+
+对比逐条查询发送者的旧实现与 JOIN 投影查询 (fetch_result_page) 每页的查询次数和耗时,
+使用临时 SQLite 数据库, 不会影响现有数据.
+
+使用方法: python extra/bench_search.py [消息数量] [重复次数]
+"""
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/bench.db'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert
+from app.models import engine, DBSession, Message, User
+from app.handlers.search_common import fetch_result_page, SEARCH_PAGE_SIZE
+
+CHAT_ID = -1001234567890
+USER_COUNT = 500
+
+query_count = 0
+
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    global query_count
+    query_count += 1
+
+
+def populate(total):
+    session = DBSession()
+    session.execute(insert(User), [
+        {'id': i, 'fullname': f'user {i}', 'username': f'user{i}'} for i in range(USER_COUNT)
+    ])
+    start = datetime(2024, 1, 1)
+    batch = []
+    for i in range(total):
+        batch.append({
+            'id': i, 'link': f'https://t.me/c/1234567890/{i}', 'text': f'message {i} 测试消息',
+            'type': 'text', 'category': '', 'from_id': i % USER_COUNT, 'from_chat': CHAT_ID,
+            'date': start + timedelta(seconds=i)
+        })
+        if len(batch) >= 10000:
+            session.execute(insert(Message), batch)
+            batch = []
+    if batch:
+        session.execute(insert(Message), batch)
+    session.commit()
+    session.close()
+
+
+def legacy_page(query, filter_chats, start, stop):
+    """旧实现: 取出完整的 Message 对象, 每条结果再查询一次发送者"""
+    session = query.session
+    chat_ids = [chat[0] for chat in filter_chats]
+    chat_titles = [chat[1] for chat in filter_chats]
+    messages = []
+    for message in query.order_by(Message.date.desc()).slice(start, stop).all():
+        user = session.query(User).filter_by(id=message.from_id).one()
+        chat_title = chat_titles[chat_ids.index(message.from_chat)]
+        msg_text = message.text if message.type == 'text' else f'[{message.type}] {message.text or ""}'
+        if msg_text == '':
+            continue
+        messages.append({
+            'id': message.id, 'link': message.link, 'text': msg_text, 'date': message.date,
+            'user': user.fullname, 'chat': chat_title, 'type': message.type
+        })
+    return messages
+
+
+def bench(name, func, page, repeat):
+    global query_count
+    filter_chats = [(CHAT_ID, 'bench')]
+    start = (page - 1) * SEARCH_PAGE_SIZE
+    stop = page * SEARCH_PAGE_SIZE
+    elapsed = 0
+    queries = 0
+    for _ in range(repeat):
+        session = DBSession()
+        query = session.query(Message).filter(Message.from_chat.in_([CHAT_ID]))
+        query_count = 0
+        begin = time.perf_counter()
+        func(query, filter_chats, start, stop)
+        elapsed += time.perf_counter() - begin
+        queries = query_count
+        session.close()
+    print(f"{name:<12} page {page:<5} queries/page: {queries:<4} latency: {elapsed / repeat * 1000:.2f} ms")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f"Populating {total} messages...")
+    populate(total)
+    event.listen(engine, 'before_cursor_execute', count_queries)
+    for page in (1, 100):
+        bench('before', legacy_page, page, repeat)
+        bench('after', fetch_result_page, page, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""启动耗时基准测试
+
+在新的 Python 进程中分别导入 main.py、webapp_main.py 等入口模块, 统计导入耗时,
+并检查 matplotlib / numpy 是否在启动时被加载. app.utils.charts 一行是第一次生成统计图时
+才会付出的导入开销 (含字体查找, 字体缓存文件存在时更快).
+使用临时 SQLite 数据库, 不会影响现有数据.
+
+使用方法: python extra/bench_startup.py [重复次数]
+"""
+import os
+import sys
+import json
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['main', 'webapp_main', 'app.handlers.stats_command', 'app.utils.charts']
+
+PROBE = '''
+import sys, time, json
+begin = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'seconds': time.perf_counter() - begin,
+    'matplotlib': 'matplotlib' in sys.modules,
+    'numpy': 'numpy' in sys.modules
+}}))
+'''
+
+
+def measure(module, env):
+    output = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{tempfile.mkdtemp()}/bench.db')
+
+    print(f"{'module':<32}{'min(s)':>10}{'median(s)':>12}  matplotlib  numpy")
+    for module in MODULES:
+        results = [measure(module, env) for _ in range(repeat)]
+        seconds = [r['seconds'] for r in results]
+        print(f"{module:<32}{min(seconds):>10.3f}{statistics.median(seconds):>12.3f}"
+              f"  {str(results[-1]['matplotlib']):<10}  {results[-1]['numpy']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# app.models 在导入时根据 DATABASE_URL 创建引擎和数据表, 测试使用临时的 SQLite 数据库
+os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/test.db'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
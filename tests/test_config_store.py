@@ -0,0 +1,14 @@
+from app.utils.config_store import Config
+
+
+def test_group_admins_apply_without_enable():
+    config = Config({'enable': False, 'group_admins': [114514]})
+    # enable 只控制启停机器人等操作的权限, 管理员名单仍可用于查看所有群组的统计
+    assert config.admins == set()
+    assert config.group_admins == {114514}
+    assert Config({'enable': True, 'group_admins': [1, 2]}).admins == {1, 2}
+
+
+def test_missing_config():
+    for data in (None, {}, {'enable': True}, {'group_admins': None}):
+        assert Config(data).group_admins == set()
@@ -0,0 +1,170 @@
+import io
+import os
+import json
+import signal
+import threading
+import pytest
+from app.models import DBSession, Message, User
+from app.models import importer
+
+# 导入中止时最多等待的秒数, 超过视为卡死
+IMPORT_TIMEOUT = 60
+
+
+def _write_export(path, group_id, count, user_base=0):
+    messages = [{'id': i, 'type': 'message', 'date': '2024-01-01T00:00:00', 'date_unixtime': str(1704067200 + i),
+                 'from': f'user {i % 3}', 'from_id': f'user{user_base + i % 3 + 1}', 'text': f'message {i}'}
+                for i in range(1, count + 1)]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'name': f'group {group_id}', 'type': 'public_supergroup', 'id': group_id,
+                   'messages': messages}, f)
+    return str(path)
+
+
+def _import(paths, **options):
+    """在单独的线程中导入, 避免卡死时测试无法结束"""
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(stats=importer.import_files(paths, **options)),
+                              daemon=True)
+    thread.start()
+    thread.join(IMPORT_TIMEOUT)
+    assert not thread.is_alive(), "导入没有结束"
+    return result['stats']
+
+
+def _count(chat_id):
+    session = DBSession()
+    try:
+        return session.query(Message).filter(Message.from_chat == chat_id).count()
+    finally:
+        session.close()
+
+
+def test_import_files(tmp_path):
+    paths = [_write_export(tmp_path / 'a.json', 9001, 120), _write_export(tmp_path / 'b.json', 9002, 45)]
+    all_stats = _import(paths, processes=2, batch_size=20)
+    assert [(stats.inserted, stats.error, stats.users) for stats in all_stats] == [(120, None, 3), (45, None, 0)]
+    assert _count(-1009001) == 120 and _count(-1009002) == 45
+    assert not any(os.path.exists(f'{path}.checkpoint') for path in paths)
+
+    # 再次导入时全部跳过
+    all_stats = _import(paths, processes=2, batch_size=20)
+    assert [stats.inserted for stats in all_stats] == [0, 0]
+    assert _count(-1009001) == 120
+
+
+class _BrokenWriter(importer.BatchWriter):
+    def open(self):
+        raise RuntimeError("无法连接数据库")
+
+
+def test_writer_failure_aborts(tmp_path, monkeypatch):
+    monkeypatch.setattr(importer, 'create_writer', lambda copy=False: _BrokenWriter())
+    # 批次数超过队列容量, 写入线程退出后解析进程会阻塞在队列上
+    path = _write_export(tmp_path / 'a.json', 9003, 400)
+    stats, = _import([path], processes=1, batch_size=10)
+    assert "无法连接数据库" in stats.error
+    assert stats.finished is not None
+
+
+def _killed_parser(index, file_path, chat_id, resume_id, batch_size):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_parser_killed_aborts(tmp_path, monkeypatch):
+    monkeypatch.setattr(importer, '_parse_file', _killed_parser)
+    path = _write_export(tmp_path / 'a.json', 9004, 10)
+    stats, = _import([path], processes=1)
+    assert "解析进程异常退出" in stats.error
+
+
+def test_resume_adds_users_of_skipped_messages(tmp_path):
+    path = _write_export(tmp_path / 'a.json', 9005, 30, user_base=100)
+    # 上次导入在写入用户之前中止
+    with open(f'{path}.checkpoint', 'w') as f:
+        json.dump({'chat_id': -1009005, 'last_id': 30}, f)
+    stats, = _import([path], processes=1)
+    assert stats.skipped == 30 and stats.inserted == 0
+    assert stats.error is None and stats.users == 3
+
+
+def _reader(text):
+    return importer.ExportReader(io.StringIO(text))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 1 << 20])
+def test_export_reader(monkeypatch, chunk_size):
+    # 分段读取时数字、字符串和嵌套结构都可能在段落末尾被截断
+    monkeypatch.setattr(importer, 'READ_CHUNK_SIZE', chunk_size)
+    messages = [{'id': 12345, 'text': ['前缀 ', {'type': 'bold', 'text': '加粗'}, ' "引号"\\n']},
+                {'id': 12346, 'text': 'x' * 50, 'from_id': 'user42'},
+                {'id': 9, 'reactions': [1, 2.5, None, True]}]
+    text = json.dumps({'name': '群组', 'type': 'private_supergroup', 'id': 1234567890, 'messages': messages},
+                      ensure_ascii=False, indent=1)
+    reader = _reader(text)
+    assert reader.read_header() == {'name': '群组', 'type': 'private_supergroup', 'id': 1234567890}
+    assert list(reader) == messages
+
+
+def test_export_reader_empty_messages():
+    assert list(_reader('{"name": "g", "id": 1, "messages": [ ]}')) == []
+
+
+@pytest.mark.parametrize('text', [
+    '{"name": "g", "id": 1}',
+    '{"name": "g", "id": 1, "messages": [{"id": 1}, {"id": 2',
+    '{"name": "g", "id": 1, "messages": [{"id": 1} {"id": 2}]}',
+])
+def test_export_reader_errors(text):
+    with pytest.raises(importer.ExportError):
+        list(_reader(text))
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / 'a.json.checkpoint')
+    checkpoint = importer.Checkpoint(path, -1001)
+    assert checkpoint.last_id is None
+    # 后面的批次先完成时不推进记录
+    checkpoint.done(1, 200)
+    assert checkpoint.last_id is None and not os.path.exists(path)
+    checkpoint.done(0, 100)
+    assert checkpoint.last_id == 200
+    # 写入失败的批次之后的记录不再推进
+    checkpoint.done(3, 400)
+    checkpoint.done(2, None)
+    assert checkpoint.last_id == 200
+
+    assert importer.Checkpoint(path, -1001).last_id == 200
+    # 文件属于其他群组时从头导入
+    assert importer.Checkpoint(path, -1002).last_id is None
+    checkpoint.remove()
+    assert not os.path.exists(path)
+
+
+def test_copy_text():
+    rows = [[1, 'tab\there', None], [2, 'back\\slash\nnew\rline', '']]
+    assert importer.copy_text(rows).read() == '1\ttab\\there\t\\N\n2\tback\\\\slash\\nnew\\rline\t\n'
+
+
+def test_add_users_keeps_existing():
+    session = DBSession()
+    try:
+        session.add(User(id=777001, fullname='机器人记录的名字', username='bot_name'))
+        session.commit()
+    finally:
+        session.close()
+    users = {user_id: (user_id, f'name {user_id}', f'name {user_id}') for user_id in range(777001, 777004)}
+    assert importer.add_users(users) == 2
+    assert importer.add_users(users) == 0
+    session = DBSession()
+    try:
+        assert session.get(User, 777001).fullname == '机器人记录的名字'
+        assert session.get(User, 777003).fullname == 'name 777003'
+    finally:
+        session.close()
+
+
+def test_copy_falls_back_without_psycopg2():
+    # SQLite 忽略 --copy, 仍使用普通的批量写入
+    assert not importer.use_copy(True)
+    assert isinstance(importer.create_writer(copy=True), importer.SqliteBatchWriter)
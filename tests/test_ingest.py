@@ -0,0 +1,47 @@
+import threading
+from datetime import datetime, timedelta
+from app.models import DBSession, Message
+from app.models.database import StatsType
+from app.models.ingest import IngestQueue
+
+CHAT_ID = -1003
+COUNT = 300
+
+
+def _message(i):
+    return dict(id=i, link=f'https://t.me/c/3/{i}', text=f'ingest {i}', video='', photo='', audio='', voice='',
+                type='text', category='', from_id=1, from_chat=CHAT_ID, date=datetime(2024, 1, 1) + timedelta(seconds=i))
+
+
+def test_ingest_while_other_threads_query():
+    """其他线程同时查询并关闭会话, 不影响写入线程尚未提交的消息"""
+    stop = threading.Event()
+
+    def query():
+        while not stop.is_set():
+            session = DBSession()
+            try:
+                session.query(Message).filter(Message.from_chat == CHAT_ID).count()
+            finally:
+                session.close()
+
+    readers = [threading.Thread(target=query, daemon=True) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    ingest = IngestQueue(batch_size=10, flush_interval=0.01)
+    try:
+        for i in range(COUNT):
+            ingest.put_message(_message(i), (1, 'user', 'user'), (CHAT_ID, 'ingest'))
+        ingest.stop()
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+    session = DBSession()
+    try:
+        assert session.query(Message).filter(Message.from_chat == CHAT_ID).count() == COUNT
+        # 汇总表与消息表一致
+        assert session.get(StatsType, (CHAT_ID, 'text')).count == COUNT
+    finally:
+        session.close()
@@ -0,0 +1,61 @@
+from datetime import datetime
+from concurrent.futures import Future
+import pytest
+import pytz
+from app.handlers import nl_search
+from app.handlers.nl_search import quick_parse
+
+# 北京时间 2024-03-13 (星期三) 10:00
+NOW = pytz.UTC.localize(datetime(2024, 3, 13, 2, 0, 0))
+
+
+@pytest.mark.parametrize('query', [
+    '最近一周', '最近一周 python', '昨天晚上', '昨天晚上 部署', '上周五', '上周五 会议', '去年', '去年 年会',
+    '2024年3月', '2024年3月 发布', '3月5日', '2024-03', '三天前 bug', '两个月', '周末 聚餐', '下午 开会',
+    '星期一', '今晚', '之前 讨论',
+    # 多个时间词或带有用户、群组
+    '昨天 上周', '我 昨天', '他说的',
+])
+def test_time_like_queries_go_to_llm(query):
+    assert quick_parse(query, NOW) is None
+
+
+def test_plain_keywords():
+    assert quick_parse('python docker', NOW) == {
+        'keywords': ['python', 'docker'], 'time_range': None, 'user': None, 'chat': None}
+    # 数字本身不表示时间
+    assert quick_parse('python3 404', NOW)['keywords'] == ['python3', '404']
+
+
+def test_relative_time_with_keywords():
+    parsed = quick_parse('昨天 部署 失败', NOW)
+    assert parsed['keywords'] == ['部署', '失败']
+    # 北京时间 2024-03-12 全天
+    assert parsed['time_range'] == {'start': '2024-03-11 16:00:00', 'end': '2024-03-12 15:59:59'}
+
+
+def test_last_week():
+    parsed = quick_parse('上周', NOW)
+    assert parsed['keywords'] == []
+    assert parsed['time_range'] == {'start': '2024-03-03 16:00:00', 'end': '2024-03-10 15:59:59'}
+
+
+def test_empty_query():
+    assert quick_parse('   ', NOW) is None
+
+
+def test_llm_parse_is_not_cached_on_the_llm_thread(monkeypatch):
+    """LLM 的解析结果由调用方在工作线程中缓存, Future 完成时不访问数据库"""
+    pending = Future()
+    monkeypatch.setattr(nl_search, 'parse_date_with_llm', lambda *args: pending)
+    monkeypatch.setattr(nl_search.parse_cache, 'get', lambda key: None)
+    puts = []
+    monkeypatch.setattr(nl_search.parse_cache, 'put', lambda key, parsed: puts.append(key))
+
+    future, cache_key = nl_search.parse_query('帮我找一下张三说的话', NOW, 1)
+    assert future is pending and cache_key
+    pending.set_result({'keywords': [], 'time_range': None, 'user': '张三', 'chat': None})
+    assert puts == []
+
+    # 预解析的结果不需要缓存
+    assert nl_search.parse_query('python docker', NOW, 1)[1] is None
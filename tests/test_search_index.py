@@ -0,0 +1,124 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql
+from app.models import DBSession, Message
+from app.models import search_index
+from app.models.search_index import tokenize, build_match_terms, keyword_filter, like_filter
+
+CHAT_ID = -1001
+
+TEXTS = [
+    'hello world',
+    'helloworld',
+    'Hello World again',
+    'yellow fellow',
+    'say hello, world!',
+    '中文全文检索',
+    '这是中文 mixed with english',
+    '检索文字',
+    '单',
+    'nothing here',
+]
+
+
+@pytest.fixture(scope='module')
+def session():
+    session = DBSession()
+    rows = [dict(id=i, text=msg_text, from_chat=CHAT_ID, from_id=1, type='text', date=datetime(2024, 1, 1))
+            for i, msg_text in enumerate(TEXTS)]
+    inserted = session.execute(insert(Message).returning(Message._id, Message.text), rows)
+    search_index.index_messages(session, inserted.all())
+    session.commit()
+    yield session
+    session.query(Message).filter(Message.from_chat == CHAT_ID).delete()
+    session.commit()
+    session.close()
+
+
+def test_tokenize():
+    assert tokenize('Hello 中文检索') == ['hel', 'ell', 'llo', '中文', '文检', '检索', '索']
+    # 不足三个字符的拉丁单词不写入索引
+    assert tokenize('hi ok') == []
+    assert tokenize('') == []
+
+
+def test_build_match_terms():
+    assert build_match_terms('中文') == ['"中文"']
+    assert build_match_terms('检') == ['"检"*']
+    # 拉丁文本可能是单词的一部分, 按三字符片段匹配
+    assert build_match_terms('ELLO') == ['"ell"', '"llo"']
+    assert build_match_terms('lolol') == ['"lol"', '"olo"']
+    assert build_match_terms('hi') == []
+    assert build_match_terms('中文 ello') == ['"中文"', '"ell"', '"llo"']
+
+
+def test_fts5_backend_in_use():
+    assert search_index.get_backend().name == 'fts5'
+    assert search_index.get_backend().is_ready()
+    # 拉丁关键词同样先用索引缩小候选集
+    assert 'message_fts' in str(keyword_filter(['ello']))
+    assert 'message_fts' not in str(keyword_filter(['hi']))
+
+
+@pytest.mark.parametrize('keywords', [
+    ['ello'], ['world'], ['llo wor'], ['hello'], ['HELLO'], ['中文'], ['文'], ['检索'], ['文字'], ['单'],
+    ['中文', 'mixed'], ['中文', 'xyz'], ['nothing'], ['ow'], ['ellow'], ['lo, wo'], ['ain'], ['文 mix'],
+])
+def test_index_matches_like(session, keywords):
+    """索引只能缩小候选集, 结果必须与直接 LIKE 一致"""
+    def ids(rule):
+        return sorted(row[0] for row in session.query(Message.id).filter(Message.from_chat == CHAT_ID, rule))
+
+    assert ids(keyword_filter(keywords)) == ids(like_filter(keywords))
+    lowered = [keyword.lower() for keyword in keywords]
+    assert ids(keyword_filter(lowered, ignore_case=True)) == ids(like_filter(lowered, ignore_case=True))
+
+
+def test_ignore_case_uses_ilike():
+    # pg_trgm 索引可以用于 ILIKE, 不能用于 lower(text) LIKE
+    sql = str(like_filter(['kw'], ignore_case=True).compile(dialect=postgresql.dialect()))
+    assert 'ILIKE' in sql and 'lower' not in sql
+
+
+def test_substring_matches(session):
+    def texts(keywords):
+        return {row[0] for row in session.query(Message.text).filter(keyword_filter(keywords))}
+
+    assert 'helloworld' in texts(['world'])
+    assert texts(['ello']) >= {'hello world', 'helloworld', 'Hello World again', 'say hello, world!'}
+    assert texts(['llo wor']) == {'hello world', 'Hello World again'}
+
+
+def test_rebuild_while_bot_writes(session, monkeypatch):
+    """重建期间机器人写入新消息、修改尚未重建的消息, 重建仍能完成, 索引与消息一致"""
+    backend = search_index.get_backend()
+    monkeypatch.setattr(search_index, 'REBUILD_BATCH_SIZE', 2)
+    edited_id = session.query(Message._id).filter(Message.from_chat == CHAT_ID, Message.text == '检索文字').scalar()
+    index_messages = backend.index_messages
+    calls = []
+
+    def index_while_bot_writes(write_session, rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            # 与机器人的写入相同: 新消息随插入建立索引, 修改的消息重建索引
+            inserted = write_session.execute(insert(Message).returning(Message._id, Message.text), [dict(
+                id=100, text='重建期间的新消息', from_chat=CHAT_ID, from_id=1, type='text', date=datetime(2024, 1, 2))])
+            index_messages(write_session, inserted.all())
+            write_session.query(Message).filter(Message._id == edited_id).update({'text': '修改后的内容'})
+            backend.reindex_messages(write_session, [(edited_id, '修改后的内容')])
+        index_messages(write_session, rows)
+
+    monkeypatch.setattr(backend, 'index_messages', index_while_bot_writes)
+    backend.rebuild()
+    monkeypatch.undo()
+    assert backend.is_ready()
+
+    def texts(keywords):
+        return {row[0] for row in session.query(Message.text).filter(Message.from_chat == CHAT_ID,
+                                                                     keyword_filter(keywords))}
+
+    assert texts(['新消息']) == {'重建期间的新消息'}
+    assert texts(['修改后']) == {'修改后的内容'}
+    assert texts(['文字']) == set()
+    assert texts(['中文']) == {'中文全文检索', '这是中文 mixed with english'}
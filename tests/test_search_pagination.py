@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import insert
+from app.models import DBSession, Message
+from app.handlers.search_common import (
+    fetch_result_page, page_cursors, encode_cursor, decode_cursor, CURSOR_AFTER, CURSOR_BEFORE, SEARCH_PAGE_SIZE
+)
+
+CHAT_ID = -1002
+FILTER_CHATS = [(CHAT_ID, 'test')]
+TOTAL = SEARCH_PAGE_SIZE * 3 + 7
+
+
+@pytest.fixture(scope='module')
+def session():
+    session = DBSession()
+    base = datetime(2024, 1, 1)
+    # 每页边界附近的消息没有文本, 不展示但占用一行; 部分消息时间相同, 按 _id 区分
+    rows = [dict(id=i, text='' if i % SEARCH_PAGE_SIZE in (0, 1, SEARCH_PAGE_SIZE - 1) else f'msg {i}',
+                 type='text', from_chat=CHAT_ID, from_id=1, date=base + timedelta(minutes=i // 3))
+            for i in range(TOTAL)]
+    session.execute(insert(Message), rows)
+    session.commit()
+    yield session
+    session.query(Message).filter(Message.from_chat == CHAT_ID).delete()
+    session.commit()
+    session.close()
+
+
+def _query(session):
+    return session.query(Message).filter(Message.from_chat == CHAT_ID)
+
+
+def _page(session, page, cursor=None):
+    start, stop = (page - 1) * SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE
+    messages, _ = fetch_result_page(_query(session), FILTER_CHATS, start, stop, cursor)
+    return messages
+
+
+def test_cursor_round_trip():
+    date = datetime(2024, 5, 6, 7, 8, 9)
+    for direction in (CURSOR_AFTER, CURSOR_BEFORE):
+        assert decode_cursor(encode_cursor(direction, date, 123456)) == (direction, date, 123456)
+    assert decode_cursor('x1.2') is None
+    assert decode_cursor('a') is None
+    assert decode_cursor('') is None
+
+
+def test_hidden_rows_are_returned(session):
+    messages = _page(session, 1)
+    assert len(messages) == SEARCH_PAGE_SIZE
+    assert any(msg['hidden'] for msg in messages)
+
+
+def test_cursor_pages_match_offset_pages(session):
+    pages = (TOTAL + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    offset_pages = [[msg['_id'] for msg in _page(session, page)] for page in range(1, pages + 1)]
+
+    # 向后翻页, 每页都使用上一页生成的游标
+    cursors = page_cursors(1, _page(session, 1))
+    for page in range(2, pages + 1):
+        messages = _page(session, page, cursors[page])
+        assert [msg['_id'] for msg in messages] == offset_pages[page - 1]
+        cursors = page_cursors(page, messages)
+
+    # 再从最后一页向前翻
+    for page in range(pages - 1, 0, -1):
+        messages = _page(session, page, cursors[page])
+        assert [msg['_id'] for msg in messages] == offset_pages[page - 1]
+        cursors = page_cursors(page, messages)
+
+    all_ids = [_id for ids in offset_pages for _id in ids]
+    assert len(all_ids) == len(set(all_ids)) == TOTAL
@@ -0,0 +1,33 @@
+from app.utils.search_session import create_session, get_session, session_total, session_cursor, update_session
+
+
+def test_totals_and_cursors_are_kept_per_chat_set():
+    token = create_session('search', {'keywords': ['hi']}, None, 120, {2: 'a1.2'}, chat_ids=[1, 2])
+
+    session = get_session(token)
+    assert session_total(session, [2, 1]) == 120
+    assert session_cursor(session, [1, 2], 2) == 'a1.2'
+
+    # 另一个用户只能搜索其中一个群组, 不能使用第一个用户的总数和游标
+    assert session_total(session, [1]) is None
+    assert session_cursor(session, [1], 2) is None
+
+    update_session(token, session, [1], 30, {3: 'a3.4'})
+    session = get_session(token)
+    assert session_total(session, [1]) == 30
+    assert session_cursor(session, [1], 3) == 'a3.4'
+    assert session_total(session, [1, 2]) == 120
+    assert session_cursor(session, [1, 2], 3) is None
+
+
+def test_estimated_total_keeps_exact_flag():
+    token = create_session('search', {}, None, None, None, chat_ids=[1])
+    session = get_session(token)
+    assert session_total(session, [1]) is None
+
+    class Estimate(int):
+        exact = False
+
+    update_session(token, session, [1], Estimate(500))
+    total = session_total(get_session(token), [1])
+    assert total == 500 and not total.exact
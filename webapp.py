@@ -3,7 +3,8 @@ import json
 import logging
 from flask import Flask, render_template, jsonify, request, Response
 from sqlalchemy import func, desc, extract
-from app.models import DBSession, Message, User, Chat
+from app.models import DBSession, Message, User, Chat, stats_rollup
+from app.utils.chat_cache import invalidate_chat
 from datetime import datetime, timedelta
 import hmac
 import hashlib
@@ -79,6 +80,50 @@ def verify_telegram_data(init_data):
         logger.error(f"Error verifying Telegram data: {str(e)}")
         return None
 
+def get_live_chat_statistics(session, chat_id):
+    """实时扫描消息表统计, 统计汇总表就绪前使用"""
+    # 基本统计
+    total_messages = session.query(func.count(Message.id)).filter(Message.from_chat == chat_id).scalar() or 0
+    total_users = session.query(func.count(func.distinct(Message.from_id))).filter(Message.from_chat == chat_id).scalar() or 0
+    
+    # 最近7天消息
+    week_ago = datetime.now() - timedelta(days=7)
+    recent_messages = session.query(func.count(Message.id)).filter(
+        Message.from_chat == chat_id,
+        Message.date >= week_ago
+    ).scalar() or 0
+    
+    # 消息类型统计
+    msg_types = {}
+    for type_result in session.query(Message.type, func.count(Message.id)).filter(
+        Message.from_chat == chat_id
+    ).group_by(Message.type).all():
+        msg_types[type_result[0] or 'unknown'] = type_result[1]
+    
+    # 活跃用户
+    top_users = session.query(
+        Message.from_id,
+        func.count(Message.id).label('message_count')
+    ).filter(
+        Message.from_chat == chat_id
+    ).group_by(Message.from_id).order_by(desc('message_count')).limit(10).all()
+    
+    # 按小时和星期分布, 一次分组查询
+    hour = extract('hour', Message.date)
+    day = extract('dow', Message.date)
+    hourly, weekly = {}, {}
+    for h, d, count in session.query(hour, day, func.count(Message.id)).filter(
+        Message.from_chat == chat_id
+    ).group_by(hour, day).all():
+        if h is None:
+            continue
+        hourly[int(h)] = hourly.get(int(h), 0) + count
+        weekly[int(d)] = weekly.get(int(d), 0) + count
+    hourly_rows = hourly.items()
+    weekly_rows = weekly.items()
+    
+    return total_messages, total_users, recent_messages, msg_types, top_users, hourly_rows, weekly_rows
+
 def get_chat_statistics(chat_id):
     """获取群组统计数据"""
     session = DBSession()
@@ -92,37 +137,26 @@ def get_chat_statistics(chat_id):
         
         logger.info(f"Found chat: {chat.title}, enabled: {chat.enable}")
         
-        # 基本统计
-        total_messages = session.query(func.count(Message.id)).filter(Message.from_chat == chat_id).scalar() or 0
-        total_users = session.query(func.count(func.distinct(Message.from_id))).filter(Message.from_chat == chat_id).scalar() or 0
+        if stats_rollup.is_ready():
+            # 从统计汇总表读取
+            total_messages = stats_rollup.total_count(session, chat_id)
+            total_users = stats_rollup.user_count(session, chat_id)
+            recent_messages = stats_rollup.count_since(session, datetime.now() - timedelta(days=7), chat_id)
+            msg_types = stats_rollup.type_counts(session, chat_id)
+            top_users_rows = stats_rollup.top_users(session, chat_id)
+            hourly_rows = stats_rollup.hour_distribution(session, chat_id).items()
+            weekly_rows = stats_rollup.weekday_distribution(stats_rollup.daily_counts(session, chat_id)).items()
+        else:
+            total_messages, total_users, recent_messages, msg_types, top_users_rows, hourly_rows, weekly_rows = \
+                get_live_chat_statistics(session, chat_id)
         
         logger.info(f"Basic stats: total_messages={total_messages}, total_users={total_users}")
         
-        # 最近7天消息
-        week_ago = datetime.now() - timedelta(days=7)
-        recent_messages = session.query(func.count(Message.id)).filter(
-            Message.from_chat == chat_id,
-            Message.date >= week_ago
-        ).scalar() or 0
-        
-        # 消息类型统计
-        msg_types = {}
-        for type_result in session.query(Message.type, func.count(Message.id)).filter(
-            Message.from_chat == chat_id
-        ).group_by(Message.type).all():
-            msg_types[type_result[0] or 'unknown'] = type_result[1]
-        
         # 活跃用户
-        top_users_query = session.query(
-            Message.from_id,
-            func.count(Message.id).label('message_count')
-        ).filter(
-            Message.from_chat == chat_id
-        ).group_by(Message.from_id).order_by(desc('message_count')).limit(10)
-        
+        users = {u.id: u for u in session.query(User).filter(User.id.in_([u[0] for u in top_users_rows]))}
         top_users = []
-        for user_id, count in top_users_query:
-            user = session.query(User).filter(User.id == user_id).first()
+        for user_id, count in top_users_rows:
+            user = users.get(user_id)
             top_users.append({
                 'id': user_id,
                 'name': user.fullname if user else f"User {user_id}",
@@ -134,31 +168,19 @@ def get_chat_statistics(chat_id):
         hourly_stats = {}
         for hour in range(24):
             hourly_stats[hour] = 0
-            
-        for hour_result in session.query(
-            extract('hour', Message.date).label('hour'),
-            func.count(Message.id)
-        ).filter(
-            Message.from_chat == chat_id
-        ).group_by('hour').all():
-            hourly_stats[hour_result[0]] = hour_result[1]
+        for hour, count in hourly_rows:
+            hourly_stats[int(hour)] = count
         
         # 按星期分布
         weekly_stats = {}
         for day in range(1, 8):  # 1-7 (周一到周日)
             weekly_stats[day] = 0
-            
-        for day_result in session.query(
-            extract('dow', Message.date).label('day'),
-            func.count(Message.id)
-        ).filter(
-            Message.from_chat == chat_id
-        ).group_by('day').all():
-            day_of_week = int(day_result[0])
+        for day, count in weekly_rows:
+            day_of_week = int(day)
             # 将星期日(0)转换为7，与前端表示一致
             if day_of_week == 0:
                 day_of_week = 7
-            weekly_stats[day_of_week] = day_result[1]
+            weekly_stats[day_of_week] = count
         
         return {
             'chat_id': chat_id,
@@ -188,6 +210,8 @@ def update_chat_status(chat_id, enable):
         
         chat.enable = enable
         session.commit()
+        # 机器人进程中的缓存会在 CHAT_CACHE_TTL 秒内自动过期
+        invalidate_chat(chat_id)
         return True
     except Exception as e:
         logger.error(f"Error updating chat status: {str(e)}")